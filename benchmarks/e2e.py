@@ -0,0 +1,309 @@
+#!/usr/bin/python3
+'''End-to-end throughput benchmark of server.py and client.py on one machine
+
+A synthetic good run list with random files is served by a local
+`rsync --daemon` standing in for IHEP, files are copied into a tmpfs
+directory standing in for EOS by N real clients coordinated by the real
+server. Clients export metrics that are scraped while they run, the report
+has runs/s, bytes/s, per-stage latencies and peak RSS of the server.
+
+    python3 benchmarks/e2e.py --runs 200 --files-per-run 10 --file-size 1048576 --clients 4
+'''
+import os
+import sys
+import base64
+import json
+import time
+import shutil
+import random
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import urllib.request
+from os.path import abspath, dirname, join
+from typing import Dict, List, Tuple
+
+REPO = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, REPO)
+
+import yaml
+
+from common.checksum import adler32_file
+
+CREDENTIALS = ('bench', 'bench')
+# run is the 5th component of a path without /dybfs, as for P17B
+RUN_PATH = 'rec/P17B/bench/group_{group:03d}/sub/run_{run:06d}'
+STAGES = {
+    'rsync_seconds': 'warden_client_rsync_seconds',
+    'verify_seconds': 'warden_client_verify_seconds',
+    'server_rtt_seconds': 'warden_client_server_rtt_seconds',
+}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def generate_data(root: str, n_runs: int, files_per_run: int, file_size: int, seed: int) -> Tuple[str, int]:
+    '''Random files under root/dybfs and their good run list, returns (list path, total bytes)'''
+    rng = random.Random(seed)
+    good_runs = join(root, 'good_runs.txt')
+    total = 0
+    with open(good_runs, 'w') as f:
+        for run in range(n_runs):
+            run_dir = RUN_PATH.format(group=run // 100, run=run)
+            os.makedirs(join(root, 'dybfs', run_dir), exist_ok=True)
+            for i in range(files_per_run):
+                path = join(run_dir, f'file_{i:04d}.root')
+                # random bytes do not compress, like ROOT files
+                with open(join(root, 'dybfs', path), 'wb') as data:
+                    data.write(rng.getrandbits(8 * file_size).to_bytes(file_size, 'little'))
+                f.write(f'/dybfs/{path} {adler32_file(join(root, "dybfs", path))}\n')
+                total += file_size
+    return good_runs, total
+
+
+def start_rsync_daemon(root: str, port: int) -> subprocess.Popen:
+    conf = join(root, 'rsyncd.conf')
+    with open(conf, 'w') as f:
+        f.write(f'pid file = {join(root, "rsyncd.pid")}\n'
+                'use chroot = no\n'
+                f'[dybfs]\n    path = {join(root, "dybfs")}\n    read only = yes\n')
+    return subprocess.Popen(['rsync', '--daemon', '--no-detach', f'--port={port}',
+                             '--address=127.0.0.1', f'--config={conf}'])
+
+
+def start_server(workdir: str, good_runs: str, eos: str, port: int, extra: Dict) -> subprocess.Popen:
+    os.makedirs(workdir, exist_ok=True)
+    config = {'EOS': eos, 'EOS_DYBFS': eos, 'good_runs': good_runs,
+              'credentials': {'user': CREDENTIALS[0], 'passwd': CREDENTIALS[1]},
+              'state_db': join(workdir, 'warden_state.sqlite')}
+    config.update(extra)
+    with open(join(workdir, 'server_conf.yaml'), 'w') as f:
+        yaml.safe_dump(config, f)
+    return subprocess.Popen([sys.executable, '-m', 'uvicorn', '--app-dir', REPO, '--host', '127.0.0.1',
+                             '--port', str(port), '--log-level', 'warning', 'server:app'], cwd=workdir)
+
+
+def start_client(workdir: str, index: int, server_port: int, rsync_port: int, eos: str,
+                 metrics_port: int, extra: Dict) -> subprocess.Popen:
+    os.makedirs(workdir, exist_ok=True)
+    config = {'login': CREDENTIALS[0], 'passwd': CREDENTIALS[1],
+              'server_address': f'127.0.0.1:{server_port}', 'ihep_host': '127.0.0.1',
+              'ihep_port': rsync_port, 'eos_home': eos, 'metrics_port': metrics_port,
+              'client_id': f'bench-{index}'}
+    config.update(extra)
+    with open(join(workdir, 'client_conf.yaml'), 'w') as f:
+        yaml.safe_dump(config, f)
+    env = dict(os.environ, PYTHONPATH=REPO)
+    return subprocess.Popen([sys.executable, join(REPO, 'client.py'), '-i', str(index)],
+                            cwd=workdir, env=env, stdout=subprocess.DEVNULL)
+
+
+def wait_for_server(port: int, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            fetch(f'http://127.0.0.1:{port}/runs/remained/total')
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'Server did not start on port {port} in {timeout} s')
+
+
+def fetch(url: str) -> str:
+    # the server challenges without a realm, urllib auth handlers need one
+    token = base64.b64encode(':'.join(CREDENTIALS).encode('utf-8')).decode('ascii')
+    request = urllib.request.Request(url, headers={'Authorization': f'Basic {token}'})
+    with urllib.request.urlopen(request, timeout=5) as response:
+        return response.read().decode('utf-8')
+
+
+def parse_histograms(text: str) -> Dict[str, Dict[str, object]]:
+    '''{name: {'buckets': [(le, cumulative count)], 'sum': s, 'count': n}} of Prometheus text'''
+    histograms: Dict[str, Dict[str, object]] = dict()
+    for line in text.splitlines():
+        if line.startswith('#') or not line.strip():
+            continue
+        series, value = line.rsplit(' ', 1)
+        name = series.split('{', 1)[0]
+        for suffix in ('_bucket', '_sum', '_count'):
+            if name.endswith(suffix):
+                entry = histograms.setdefault(name[:-len(suffix)], {'buckets': [], 'sum': 0.0, 'count': 0})
+                if suffix == '_bucket':
+                    le = series.split('le="', 1)[1].split('"', 1)[0]
+                    entry['buckets'].append((float('inf') if le == '+Inf' else float(le), float(value)))
+                else:
+                    entry[suffix[1:]] += float(value)
+    return histograms
+
+
+def merge_histograms(scrapes: List[str], name: str) -> Dict[str, object]:
+    merged = {'buckets': dict(), 'sum': 0.0, 'count': 0}
+    for text in scrapes:
+        entry = parse_histograms(text).get(name)
+        if not entry:
+            continue
+        for le, count in entry['buckets']:
+            merged['buckets'][le] = merged['buckets'].get(le, 0) + count
+        merged['sum'] += entry['sum']
+        merged['count'] += entry['count']
+    merged['buckets'] = sorted(merged['buckets'].items())
+    return merged
+
+
+def quantile(histogram: Dict[str, object], q: float) -> float:
+    '''Quantile interpolated within buckets, like histogram_quantile()'''
+    count = histogram['count']
+    if not count:
+        return 0.0
+    rank = q * count
+    lower, below = 0.0, 0
+    for le, cumulative in histogram['buckets']:
+        if cumulative >= rank:
+            if le == float('inf'):
+                return lower
+            in_bucket = cumulative - below
+            return lower + (le - lower) * ((rank - below) / in_bucket if in_bucket else 0)
+        lower, below = le, cumulative
+    return lower
+
+
+def summarize_stage(histogram: Dict[str, object]) -> Dict[str, float]:
+    count = histogram['count']
+    return {'count': int(count),
+            'mean': histogram['sum'] / count if count else 0.0,
+            'p50': quantile(histogram, 0.5),
+            'p90': quantile(histogram, 0.9),
+            'p99': quantile(histogram, 0.99)}
+
+
+def server_memory(pid: int) -> Dict[str, float]:
+    '''Current and peak RSS of a process in MB'''
+    memory = dict()
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in ('VmRSS', 'VmHWM'):
+                memory[key] = int(value.split()[0]) / 1024
+    return {'rss_mb': memory.get('VmRSS', 0.0), 'peak_rss_mb': memory.get('VmHWM', 0.0)}
+
+
+class Scraper:
+    '''Keeps the last metrics of every client, clients exit as soon as runs are over'''
+    def __init__(self, ports: List[int], interval: float):
+        self.ports = ports
+        self.interval = interval
+        self.last: Dict[int, str] = dict()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def _loop(self):
+        while not self.stopped.wait(self.interval):
+            self.scrape()
+
+    def scrape(self):
+        for port in self.ports:
+            try:
+                self.last[port] = fetch(f'http://127.0.0.1:{port}/metrics')
+            except OSError:
+                pass
+
+    def stop(self) -> List[str]:
+        self.stopped.set()
+        self.thread.join()
+        return list(self.last.values())
+
+
+def run_benchmark(args) -> Dict[str, object]:
+    if shutil.which('rsync') is None:
+        raise SystemExit('rsync is required for the benchmark')
+    workdir = abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix='warden_bench_')
+    # tmpfs keeps EOS out of the measurement
+    eos_root = tempfile.mkdtemp(prefix='warden_bench_eos_', dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+    eos = join(eos_root, 'dybfs')
+    os.makedirs(eos)
+
+    print(f'Generating {args.runs} runs x {args.files_per_run} files x {args.file_size} bytes in {workdir}')
+    good_runs, total_bytes = generate_data(workdir, args.runs, args.files_per_run, args.file_size, args.seed)
+
+    rsync_port, server_port = free_port(), free_port()
+    metrics_ports = [free_port() for _ in range(args.clients)]
+    processes = []
+    try:
+        processes.append(start_rsync_daemon(workdir, rsync_port))
+        server = start_server(join(workdir, 'server'), good_runs, eos, server_port,
+                              json.loads(args.server_options))
+        processes.append(server)
+        wait_for_server(server_port)
+
+        scraper = Scraper(metrics_ports, args.scrape_interval)
+        start = time.monotonic()
+        clients = [start_client(join(workdir, f'client_{i}'), i, server_port, rsync_port, eos, port,
+                                json.loads(args.client_options))
+                   for i, port in enumerate(metrics_ports)]
+        processes.extend(clients)
+        exit_codes = [client.wait() for client in clients]
+        elapsed = time.monotonic() - start
+        client_metrics = scraper.stop()
+
+        server_metrics = fetch(f'http://127.0.0.1:{server_port}/metrics')
+        copied = int(fetch(f'http://127.0.0.1:{server_port}/runs/copied/total'))
+        memory = server_memory(server.pid)
+    finally:
+        for process in reversed(processes):
+            if process.poll() is None:
+                process.terminate()
+        for process in processes:
+            process.wait()
+        shutil.rmtree(eos_root, ignore_errors=True)
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    server_histograms = parse_histograms(server_metrics)
+    report = {
+        'runs': args.runs,
+        'files_per_run': args.files_per_run,
+        'file_size': args.file_size,
+        'clients': args.clients,
+        'client_exit_codes': exit_codes,
+        'runs_copied': copied,
+        'elapsed_seconds': elapsed,
+        'runs_per_second': copied / elapsed,
+        'bytes_per_second': total_bytes * copied / args.runs / elapsed,
+        'stages': {stage: summarize_stage(merge_histograms(client_metrics, name))
+                   for stage, name in STAGES.items()},
+        'server': {'lease_seconds': summarize_stage(server_histograms.get(
+                       'warden_lease_seconds', {'buckets': [], 'sum': 0.0, 'count': 0})),
+                   **memory},
+    }
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=100, help='Number of synthetic runs')
+    parser.add_argument('--files-per-run', type=int, default=10)
+    parser.add_argument('--file-size', type=int, default=1024 * 1024, help='Size of every file in bytes')
+    parser.add_argument('--clients', type=int, default=2, help='Number of client processes')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of file contents')
+    parser.add_argument('--server-options', default='{}', help='JSON of extra server_conf.yaml keys')
+    parser.add_argument('--client-options', default='{}', help='JSON of extra client_conf.yaml keys')
+    parser.add_argument('--scrape-interval', type=float, default=0.5,
+                        help='Seconds between scrapes of client metrics')
+    parser.add_argument('--workdir', help='Directory for data and logs, temporary if not set')
+    parser.add_argument('--keep', action='store_true', help='Keep data and logs after the benchmark')
+    parser.add_argument('-o', '--output', type=abspath, help='Save JSON report to this path')
+    args = parser.parse_args()
+
+    report = run_benchmark(args)
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
@@ -0,0 +1,248 @@
+#!/usr/bin/python3
+'''Load test of the server HTTP endpoints, in process and without rsync
+
+A synthetic good run list is loaded into server.py directly, then `--clients`
+concurrent workers lease runs with /runs/next and finalize them with
+/runs/finalize, a share of them as IntegrityFailed with long `failed_files`
+lists. Requests go through the ASGI app in the same event loop, so latency is
+the time spent in handlers plus the web framework. Reports p50/p99 latency and
+throughput per endpoint and the lag of the event loop, i.e. how long handlers
+block it, optionally with a profile of the whole run.
+
+    python3 benchmarks/loadtest.py --runs 20000 --clients 200 --fail-ratio 0.05 --failed-files 1000 --profile cprofile
+
+Needs httpx, which FastAPI uses for its test client.
+'''
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import cProfile
+import pstats
+from os.path import abspath, dirname, join
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+REPO = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, REPO)
+
+import httpx
+from loguru import logger
+
+import server
+from common import wire
+from common.store import RunStore
+
+CREDENTIALS = ('bench', 'bench')
+RUN_PATH = 'rec/P17B/bench/group_{group:03d}/sub/run_{run:06d}'
+
+
+def good_run_list(n_runs: int, files_per_run: int) -> Dict[str, List[Tuple[str, str]]]:
+    '''run -> [(path, adler32)], as load_good_run_list returns it'''
+    return {f'run_{run:06d}': [(f'{RUN_PATH.format(group=run // 100, run=run)}/file_{i:04d}.root',
+                                f'{(run * files_per_run + i) & 0xffffffff:08x}')
+                               for i in range(files_per_run)]
+            for run in range(n_runs)}
+
+
+def prepare_server(args, state_db: str):
+    '''What server.init does, with the good run list from memory and no signal handlers'''
+    server.config = {'EOS': '/eos', 'EOS_DYBFS': '/eos/dybfs', 'state_db': state_db,
+                     **json.loads(args.server_options)}
+    server.Auth.login, server.Auth.passwd = CREDENTIALS
+    server.store = RunStore(state_db)
+    server.runs = server.new_run_queue()
+    server.runs.update(good_run_list(args.runs, args.files_per_run))
+    sharded = server.shard_large_runs(server.runs, server.config.get('shard_max_files'))
+    with server.store.transaction():
+        server.store.add_runs((run, pathes) for run, pathes in server.runs.items()
+                              if not server.is_shard(run))
+        for run, (pathes, shards) in sharded.items():
+            server.store.add_run(run, pathes, server.SHARDED)
+            server.store.add_shards(run, ((shard, pathes.start, pathes.stop) for shard, pathes in shards))
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def summarize(latencies: List[float], elapsed: float) -> Dict[str, float]:
+    return {'requests': len(latencies),
+            'per_second': len(latencies) / elapsed,
+            'p50_ms': percentile(latencies, 0.5) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+            'max_ms': max(latencies, default=0.0) * 1000}
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.loop_lag: List[float] = []
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.finalized = 0
+
+    async def request(self, client: httpx.AsyncClient, endpoint: str, method: str, url: str, **kwargs):
+        start = time.perf_counter()
+        response = await client.request(method, url, **kwargs)
+        self.latencies[endpoint].append(time.perf_counter() - start)
+        if response.status_code >= 400 and response.status_code != 410:
+            self.errors[f'{endpoint} {response.status_code}'] += 1
+        return response
+
+    def message(self, run: str, files: List[List[str]]) -> Dict[str, object]:
+        if files and self.rng.random() < self.args.fail_ratio:
+            failed = self.rng.sample(files, min(len(files), self.args.failed_files))
+            return {'run': run, 'status': server.Status.IntegrityFailed.value, 'failed_files': failed}
+        # Status is an Enum of auto() values, they go over the wire as in ClientMessage.json()
+        return {'run': run, 'status': server.Status.Done.value, 'transferred_files': len(files),
+                'transferred_bytes': len(files) * self.args.file_size}
+
+    async def worker(self, client: httpx.AsyncClient, index: int):
+        headers = {'X-Warden-Client': f'loadtest-{index}'}
+        if self.args.wire == 'compact':
+            headers['Accept'] = wire.MEDIA_TYPE
+        params = {'count': self.args.prefetch} if self.args.prefetch else None
+        while True:
+            response = await self.request(client, '/runs/next', 'GET', '/runs/next',
+                                          params=params, headers=headers)
+            if response.status_code != 200:
+                return
+            if wire.MEDIA_TYPE in response.headers.get('content-type', ''):
+                leased = wire.loads(response.content)
+            else:
+                leased = response.json()
+            for lease in leased.get('runs', [leased]):
+                if self.args.think:
+                    await asyncio.sleep(self.rng.expovariate(1 / self.args.think))
+                message = self.message(lease['run'], lease['files'])
+                if self.args.wire == 'compact':
+                    body = {'content': wire.dumps(message), 'headers': {'Content-Type': wire.MEDIA_TYPE}}
+                else:
+                    body = {'json': message}
+                await self.request(client, '/runs/finalize', 'POST', '/runs/finalize', **body)
+                self.finalized += 1
+
+    async def watch_loop(self, interval: float = 0.01):
+        '''Lag of the event loop: how much later than asked a sleep returns'''
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.loop_lag.append(time.perf_counter() - start - interval)
+
+    async def run(self) -> float:
+        transport = httpx.ASGITransport(app=server.app)
+        limits = httpx.Limits(max_connections=None)
+        async with httpx.AsyncClient(transport=transport, base_url='http://warden', auth=CREDENTIALS,
+                                     limits=limits, timeout=None) as client:
+            watcher = asyncio.create_task(self.watch_loop())
+            start = time.perf_counter()
+            await asyncio.gather(*(self.worker(client, i) for i in range(self.args.clients)))
+            elapsed = time.perf_counter() - start
+            watcher.cancel()
+        return elapsed
+
+    def report(self, elapsed: float) -> Dict[str, object]:
+        all_latencies = [latency for latencies in self.latencies.values() for latency in latencies]
+        return {'runs': self.args.runs,
+                'files_per_run': self.args.files_per_run,
+                'clients': self.args.clients,
+                'elapsed_seconds': elapsed,
+                'finalized': self.finalized,
+                'finalized_per_second': self.finalized / elapsed,
+                'copied_runs': len(server.copied_runs),
+                'failed_files': len(server.total_failed_files),
+                'spurious_files': len(server.total_failed_files.spurious_files),
+                'errors': dict(self.errors),
+                'endpoints': {endpoint: summarize(latencies, elapsed)
+                              for endpoint, latencies in self.latencies.items()},
+                'total': summarize(all_latencies, elapsed),
+                'loop_lag': {'p50_ms': percentile(self.loop_lag, 0.5) * 1000,
+                             'p99_ms': percentile(self.loop_lag, 0.99) * 1000,
+                             'max_ms': max(self.loop_lag, default=0.0) * 1000}}
+
+
+def run_profiled(test: LoadTest, args) -> float:
+    if args.profile == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            raise SystemExit('pyinstrument is not installed, use --profile cprofile')
+        profiler = Profiler(async_mode='enabled')
+        profiler.start()
+        try:
+            elapsed = asyncio.run(test.run())
+        finally:
+            profiler.stop()
+        if args.profile_output:
+            with open(args.profile_output, 'w') as f:
+                f.write(profiler.output_html())
+        print(profiler.output_text(unicode=True, color=False), file=sys.stderr)
+        return elapsed
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        elapsed = asyncio.run(test.run())
+    finally:
+        profiler.disable()
+    if args.profile_output:
+        profiler.dump_stats(args.profile_output)
+    stats = pstats.Stats(profiler, stream=sys.stderr)
+    stats.sort_stats(args.profile_sort).print_stats(args.profile_top)
+    return elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5000, help='Number of synthetic runs')
+    parser.add_argument('--files-per-run', type=int, default=200)
+    parser.add_argument('--file-size', type=int, default=1024**3,
+                        help='Size of a file reported in transferred_bytes')
+    parser.add_argument('--clients', type=int, default=100, help='Number of concurrent workers')
+    parser.add_argument('--prefetch', type=int, default=0, help='Lease runs in batches of that many')
+    parser.add_argument('--think', type=float, default=0.0,
+                        help='Mean seconds a worker holds a run before finalizing it')
+    parser.add_argument('--fail-ratio', type=float, default=0.05,
+                        help='Share of runs finalized as IntegrityFailed')
+    parser.add_argument('--failed-files', type=int, default=100,
+                        help='Number of files in failed_files of an IntegrityFailed run')
+    parser.add_argument('--wire', choices=('json', 'compact'), default='json',
+                        help='Encoding of leases and finalize reports')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--server-options', default='{}', help='JSON of server configuration keys')
+    parser.add_argument('--log-level', default='ERROR',
+                        help='Level of server logs printed to stderr, logging costs are part of latency')
+    parser.add_argument('--profile', choices=('cprofile', 'pyinstrument'), help='Profile the whole run')
+    parser.add_argument('--profile-output', type=abspath,
+                        help='Save cProfile stats or pyinstrument HTML to this path')
+    parser.add_argument('--profile-sort', default='tottime', help='pstats sort key of printed stats')
+    parser.add_argument('--profile-top', type=int, default=30, help='Number of printed functions')
+    parser.add_argument('-o', '--output', type=abspath, help='Save JSON report to this path')
+    args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level=args.log_level)
+
+    with tempfile.TemporaryDirectory(prefix='warden_loadtest_') as tmp:
+        t0 = time.perf_counter()
+        prepare_server(args, join(tmp, 'warden_state.sqlite'))
+        print(f'Loaded {args.runs} runs x {args.files_per_run} files in {time.perf_counter() - t0:.1f} s',
+              file=sys.stderr)
+        test = LoadTest(args)
+        elapsed = run_profiled(test, args) if args.profile else asyncio.run(test.run())
+        server.store.close()
+
+    report = test.report(elapsed)
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
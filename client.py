@@ -5,24 +5,43 @@ import sys
 from os.path import abspath
 import subprocess
 import time
+import signal
+import socket
+import threading
+from collections import deque
+from contextlib import suppress
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import quote
 from tempfile import NamedTemporaryFile
 import argparse
+import shutil
 
 import yaml
 import requests
 from retrying import retry
 from loguru import logger
 
-from common.models import ClientMessage, Status
+from common.models import ClientMessage, Status, FileState, ProgressReport
+from common.checksum import adler32_file, checksum_matches, pool_from_config
+from common.tuning import RsyncTuner, parse_stats
+from common import metrics, wire
 
-RSYNC_VERBOSE_COMMAND = '''rsync -h --progress -avzp --ignore-existing --files-from={filelist}  rsync://{ihep_host}:/dybfs {eos_home}'''
-RSYNC_SILENT_COMMAND = '''rsync -avzp --ignore-existing --files-from={filelist}  rsync://{ihep_host}:/dybfs {eos_home}'''
-RSYNC_REWRITE_COMMAND = '''rsync -h --progress -avzp --files-from={filelist}  rsync://{ihep_host}:/dybfs {eos_home}'''
+# rsync_options is -z, or options chosen by RsyncTuner
+RSYNC_VERBOSE_COMMAND = '''rsync -h --progress -avp {rsync_options} --ignore-existing --files-from={filelist}  rsync://{ihep_host}:/dybfs {eos_home}'''
+RSYNC_SILENT_COMMAND = '''rsync -avp {rsync_options} --ignore-existing --files-from={filelist}  rsync://{ihep_host}:/dybfs {eos_home}'''
+RSYNC_REWRITE_COMMAND = '''rsync -h --progress -avp {rsync_options} --files-from={filelist}  rsync://{ihep_host}:/dybfs {eos_home}'''
+# Pipelined mode: rsync reports every received file on stdout. Having %b in
+# the format makes rsync log a file after it is received, not before.
+RSYNC_DONE_MARKER = 'WARDEN_DONE:'
+RSYNC_PIPELINED_COMMAND = '''rsync -avp {rsync_options} --ignore-existing --out-format=''' + RSYNC_DONE_MARKER + '''%b:%n --files-from={filelist}  rsync://{ihep_host}:/dybfs {eos_home}'''
+# metadata only, sizes of files at IHEP to confirm copies within EOS
+RSYNC_LIST_COMMAND = '''rsync --list-only {rsync_options} --files-from={filelist}  rsync://{ihep_host}:/dybfs'''
+RSYNC_PIPELINED_REWRITE_COMMAND = '''rsync -avp {rsync_options} --out-format=''' + RSYNC_DONE_MARKER + '''%b:%n --files-from={filelist}  rsync://{ihep_host}:/dybfs {eos_home}'''
 
 def get_config():
     try:
         with open(abspath("client_conf.yaml"), 'r') as f:
-            config = yaml.load(f)
+            config = yaml.safe_load(f)
     except FileNotFoundError:
         logger.info('Failed to find config, trying environmetal vars')
         config = dict()
@@ -34,12 +53,53 @@ def get_config():
     return config
 
 def compute_adler(path):
-    s = subprocess.check_output(f"xrdadler32 {path}".split()).decode()
-    # subporcess returns "cksum path", need to extract cksum
-    return s.split()[0]
+    # same output as `xrdadler32 path`, without forking a process per file
+    return adler32_file(path)
+
+def rsync_env():
+    '''Environment of rsync processes, numbers it prints are parsed in the C locale'''
+    return dict(os.environ, LC_ALL='C')
+
+def file_size(path):
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return 0
+
+# bodies are serialized by pydantic, tell the server they are JSON
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
+METRICS = metrics.Registry()
+RUNS = METRICS.counter('warden_client_runs_total', 'Runs copied by the client', ['status'])
+RUN_BYTES = METRICS.histogram('warden_client_run_bytes', 'Bytes of verified files per run',
+                              buckets=metrics.RUN_BYTES_BUCKETS)
+RSYNC_SECONDS = METRICS.histogram('warden_client_rsync_seconds', 'Wall time of an rsync process',
+                                  buckets=metrics.RUN_SECONDS_BUCKETS)
+VERIFY_SECONDS = METRICS.histogram('warden_client_verify_seconds',
+                                   'Wall time of checksum verification after rsync ended',
+                                   buckets=metrics.RUN_SECONDS_BUCKETS)
+LOCAL_COPIES = METRICS.counter('warden_client_local_copies_total',
+                               'Files copied within EOS from the same content under another path')
+LOCAL_COPY_BYTES = METRICS.counter('warden_client_local_copy_bytes_total', 'Bytes copied within EOS')
+CHECKSUM_THROUGHPUT = METRICS.gauge('warden_client_checksum_mbytes_per_second',
+                                    'Checksum throughput of the last verified batch, MB/s')
+SERVER_RTT = METRICS.histogram('warden_client_server_rtt_seconds', 'Round trip time of requests to the server')
+
+class NoMoreRuns(Exception):
+    '''Server has handed out all runs'''
+
+class EOSUnavailable(Exception):
+    '''EOS FUSE mount is detached'''
+
+class ServerNotReady(requests.exceptions.RequestException):
+    '''Server kept answering it is loading runs'''
+
+def retriable(exception):
+    '''Requests worth sending again, a server stuck loading runs is not asked more'''
+    return not isinstance(exception, ServerNotReady)
 
 def eos_is_up(eos_prefix):
-    try: 
+    try:
         gen = os.walk(eos_prefix)
         # get /eos node
         next(gen)
@@ -48,13 +108,61 @@ def eos_is_up(eos_prefix):
         return True
     except StopIteration as e:
         logger.critical(f'EOS FUSE mount is not avaliable at {eos_prefix}!')
-        os.exit(1)
+        return False
+
+class EOSProbe:
+    '''EOS liveness check shared by all workers, walks the mount at most once per `ttl` seconds'''
+    def __init__(self, eos_prefix, ttl=30):
+        self.eos_prefix = eos_prefix
+        self.ttl = ttl
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def check(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._checked_at is not None and now - self._checked_at < self.ttl:
+                return
+            if not eos_is_up(self.eos_prefix):
+                raise EOSUnavailable(self.eos_prefix)
+            self._checked_at = now
 
-@logger.catch
-def get_new_run(server, credentials):
-    @retry(wait_fixed=2000, stop_max_attempt_number=5)
+def make_session(pool_size, client_id=None, wire_format='json'):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    # lets the server keep handing out runs of the same directory to this client
+    session.headers['X-Warden-Client'] = client_id or socket.gethostname()
+    if wire_format == 'compact':
+        # servers without the compact encoding keep answering with JSON
+        session.headers['Accept'] = f'{wire.MEDIA_TYPE}, application/json;q=0.5'
+    session.hooks['response'].append(lambda response, *args, **kwargs:
+                                     SERVER_RTT.observe(response.elapsed.total_seconds()))
+    return session
+
+def request_runs(session, url, max_wait=30, max_retries=300, **kwargs):
+    '''GET /runs/next, waiting while the server answers it is still loading runs
+
+    Raises ServerNotReady after `max_retries` such answers.
+    '''
+    for _ in range(max_retries):
+        response = session.get(url, **kwargs)
+        retry_after = response.headers.get('Retry-After')
+        if response.status_code != requests.codes.SERVICE_UNAVAILABLE or retry_after is None:
+            return response
+        logger.debug(f'Server is loading runs, asking again in {retry_after} s')
+        try:
+            time.sleep(min(float(retry_after), max_wait))
+        except ValueError:
+            time.sleep(max_wait)
+    logger.critical(f'Server is still loading runs after {max_retries} attempts, giving up')
+    raise ServerNotReady('Server did not finish loading runs')
+
+@logger.catch(exclude=NoMoreRuns)
+def get_new_run(session, server, credentials):
+    @retry(wait_fixed=2000, stop_max_attempt_number=5, retry_on_exception=retriable)
     def _new():
-        response = requests.get('http://'+server+"/runs/next", auth=credentials)
+        response = request_runs(session, 'http://'+server+"/runs/next", auth=credentials)
         response.raise_for_status()
         return response
 
@@ -63,44 +171,584 @@ def get_new_run(server, credentials):
     except requests.exceptions.HTTPError as e:
         if e.response.status_code == requests.codes.GONE:
             logger.success(f'No more runs to copy, we are done!')
-            sys.exit(0)
+            raise NoMoreRuns()
         else:
             logger.critical(f'Unexpected HTTP error {e}')
-        raise 
+        raise
     except requests.exceptions.RequestException as e:
         logger.critical('''Failed to get response from server,
                           shutdown the process {}'''.format(os.getpid()))
         raise
-    json = response.json()
+    return parse_run(decode(response))
+
+def decode(response):
+    '''Body of a JSON or compact response'''
+    if wire.MEDIA_TYPE in response.headers.get('Content-Type', ''):
+        return wire.loads(response.content)
+    return response.json()
+
+def parse_run(json):
     run, pathes_n_cksums = json['run'], json['files']
     pathes = [path for path, _ in pathes_n_cksums]
     cksums = [cksum for _, cksum in pathes_n_cksums]
-    return run, pathes, cksums
+    # leased before by a client that did not finish it
+    resumed = json.get('resumed', False)
+    # path -> [(source, size)] of the same content already in EOS, if the server has a dedup index
+    copies = dict()
+    for path, source, size in json.get('copies', ()):
+        copies.setdefault(path, []).append((source, size))
+    # already in EOS under their names, found by the server but not checksummed yet
+    present = set(json.get('present', ()))
+    return run, pathes, cksums, resumed, copies, present
+
+@logger.catch(exclude=NoMoreRuns)
+def get_new_runs(session, server, credentials, count):
+    '''Lease a batch of up to `count` runs'''
+    @retry(wait_fixed=2000, stop_max_attempt_number=5, retry_on_exception=retriable)
+    def _new():
+        response = request_runs(session, 'http://'+server+"/runs/next", params={'count': count}, auth=credentials)
+        response.raise_for_status()
+        return response
+
+    try:
+        response = _new()
+    except requests.exceptions.HTTPError as e:
+        if e.response.status_code == requests.codes.GONE:
+            raise NoMoreRuns()
+        logger.critical(f'Unexpected HTTP error {e}')
+        raise
+    return [parse_run(entry) for entry in decode(response)['runs']]
+
+class HeartbeatSender:
+    '''Background thread renewing leases of all runs held by this client'''
+    def __init__(self, session, server, credentials, interval=60):
+        self.session = session
+        self.server = server
+        self.credentials = credentials
+        self.interval = interval
+        self.runs = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._loop, name='warden-heartbeat', daemon=True)
+        self.thread.start()
+
+    def add(self, run):
+        with self.lock:
+            self.runs.add(run)
+
+    def discard(self, run):
+        with self.lock:
+            self.runs.discard(run)
+
+    def _send(self, run):
+        try:
+            response = self.session.post('http://'+self.server+f"/runs/{quote(run, safe='')}/heartbeat",
+                                         auth=self.credentials)
+            if response.status_code == requests.codes.NOT_FOUND:
+                logger.warning(f'Lease of {run} expired on server, it may be copied twice')
+                self.discard(run)
+            else:
+                response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            logger.warning(f'Failed to send heartbeat for {run}: {e}')
+
+    def _loop(self):
+        while not self.stopped.wait(self.interval):
+            with self.lock:
+                runs = list(self.runs)
+            for run in runs:
+                self._send(run)
+
+    def stop(self):
+        self.stopped.set()
+
+class RunPrefetcher:
+    '''Local queue of leased runs shared by workers
+
+    Keeps up to `size` runs leased ahead so the next rsync starts right after
+    the previous one ends. The queue is refilled in background once a run is
+    taken from it; `size` bounds how much work one client can hold.
+    '''
+    def __init__(self, session, server, credentials, size, heartbeats):
+        self.session = session
+        self.server = server
+        self.credentials = credentials
+        self.size = size
+        self.heartbeats = heartbeats
+        self.queue = deque()
+        self.exhausted = False
+        self.lock = threading.Lock()
+        self._refill_lock = threading.Lock()
+
+    def _refill(self):
+        # only one refill request at a time, others just wait for its result
+        with self._refill_lock:
+            with self.lock:
+                missing = self.size - len(self.queue)
+                if missing <= 0 or self.exhausted:
+                    return
+            try:
+                batch = get_new_runs(self.session, self.server, self.credentials, missing)
+            except NoMoreRuns:
+                batch = []
+                with self.lock:
+                    self.exhausted = True
+            for run, *_ in batch or []:
+                self.heartbeats.add(run)
+            with self.lock:
+                self.queue.extend(batch or [])
+            if batch:
+                logger.debug(f'Prefetched {len(batch)} runs')
+
+    def get(self):
+        with self.lock:
+            empty = not self.queue
+        if empty:
+            self._refill()
+        with self.lock:
+            if not self.queue:
+                if self.exhausted:
+                    logger.success(f'No more runs to copy, we are done!')
+                    raise NoMoreRuns()
+                raise RuntimeError('Failed to lease runs from server')
+            entry = self.queue.popleft()
+            should_refill = not self.exhausted
+        if should_refill:
+            threading.Thread(target=self._refill, daemon=True).start()
+        return entry
 
 @retry(wait_fixed=2000, stop_max_attempt_number=5)
-def finalize_run(server, credentials, message):
-    response = requests.post('http://'+server+"/runs/finalize", auth=credentials, data=message.json())
+def finalize_run(session, server, credentials, message, wire_format='json'):
+    if wire_format == 'compact':
+        payload = message.dict()
+        payload['status'] = message.status.value
+        headers, data = {'Content-Type': wire.MEDIA_TYPE}, wire.dumps(payload)
+    else:
+        headers, data = JSON_HEADERS, message.json()
+    response = session.post('http://'+server+"/runs/finalize", auth=credentials,
+                            headers=headers, data=data)
     response.raise_for_status()
     return response
 
-def event_loop(config):
-    credentials = (config['login'], config['passwd'])
-    server = config['server_address']
-    ihep_host = config['ihep_host']
-    eos_home = config['eos_home']
+class ProgressReporter:
+    '''Sends states of files of a run to the server in batches while the run is copied
+
+    Reports are sent every `batch` files or `interval` seconds, whichever comes
+    first; failed reports are kept and sent with the next one.
+    '''
+    def __init__(self, session, server, credentials, run, eos_home, batch=500, interval=10):
+        self.session = session
+        self.url = 'http://'+server+f"/runs/{quote(run, safe='')}/progress"
+        self.credentials = credentials
+        self.run = run
+        self.eos_home = eos_home
+        self.batch = batch
+        self.interval = interval
+        self.files = []
+        self.cksums = dict()
+        self.last_sent = time.monotonic()
+        self.lock = threading.Lock()
+        # totals of verified files for the finalize report
+        self.verified_files = 0
+        self.verified_bytes = 0
+
+    def add(self, path, state, size=None, cksum=None):
+        with self.lock:
+            self.files.append((path, state, size))
+            if cksum is not None:
+                self.cksums[path] = cksum
+            due = (len(self.files) >= self.batch
+                   or time.monotonic() - self.last_sent >= self.interval)
+        if due:
+            self.flush()
+
+    def checked(self, path, cksum, future):
+        '''Report result of a checksum `future` of a file, returns its size or None if it did not match'''
+        if checksum_matches(future, cksum):
+            size = file_size(os.path.join(self.eos_home, path))
+            with self.lock:
+                self.verified_files += 1
+                self.verified_bytes += size
+            self.add(path, FileState.Verified, size, cksum)
+            return size
+        self.add(path, FileState.Failed)
+        return None
+
+    def flush(self):
+        with self.lock:
+            files, self.files = self.files, []
+            cksums, self.cksums = self.cksums, dict()
+            self.last_sent = time.monotonic()
+        if not files:
+            return
+        try:
+            response = self.session.post(self.url, auth=self.credentials, headers=JSON_HEADERS,
+                                         data=ProgressReport(files=files, cksums=cksums).json())
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            logger.warning(f'Failed to report progress of {self.run}: {e}')
+            with self.lock:
+                self.files[:0] = files
+                self.cksums.update(cksums)
 
+def collect(futures, verification_pool, progress=None, throughput=False):
+    '''Wait for (path, cksum, future) entries, return mismatched ones
 
-    # path like /eos
-    eos_prefix = '/' + eos_home.split('/')[1]
+    With `progress` every result is reported as soon as it is ready. With
+    `throughput` all checksums are computed while waiting, so their rate is
+    recorded.
+    '''
+    if progress is None:
+        with VERIFY_SECONDS.time():
+            return verification_pool.collect(futures)
+    entries = {future: (path, cksum) for path, cksum, future in futures}
+    wrong = []
+    verified_bytes = 0
+    start = time.monotonic()
+    for future in as_completed(entries):
+        path, cksum = entries[future]
+        size = progress.checked(path, cksum, future)
+        if size is None:
+            wrong.append((path, cksum))
+        else:
+            verified_bytes += size
+    seconds = time.monotonic() - start
+    VERIFY_SECONDS.observe(seconds)
+    if throughput and seconds > 0 and verified_bytes:
+        CHECKSUM_THROUGHPUT.set(verified_bytes / seconds / 1e6)
+    return wrong
+
+def parse_list_only(lines):
+    '''path -> size of `rsync --list-only` lines: "-rw-r--r--  1,234,567 2020/01/01 00:00:00 path"'''
+    sizes = dict()
+    for line in lines:
+        fields = line.split(None, 4)
+        if len(fields) < 5 or not fields[0].startswith('-'):
+            # directories and links
+            continue
+        try:
+            # rsync runs in the C locale, digits are grouped by commas
+            sizes[fields[4]] = int(fields[1].replace(',', ''))
+        except ValueError:
+            continue
+    return sizes
+
+def transfer_and_verify(rsync_command, pathes, cksums, eos_home, verification_pool, progress=None,
+                        output=None):
+    '''Run rsync and checksum every file as soon as rsync reports it received
+
+    Files rsync did not report (e.g. skipped by --ignore-existing) are checked
+    after rsync exits, as are again files whose early checksums did not match.
+    Other lines of rsync output are appended to `output`. Returns list of
+    (path, cksum) with wrong checksums.
+    '''
+    pending = dict(zip(pathes, cksums))
+    futures = []
+    start = time.monotonic()
+    rsync_process = subprocess.Popen(rsync_command.split(), stdout=subprocess.PIPE,
+                                     universal_newlines=True, bufsize=1, env=rsync_env())
+    for line in rsync_process.stdout:
+        line = line.rstrip('\n')
+        if not line.startswith(RSYNC_DONE_MARKER):
+            logger.debug(f'rsync: {line}')
+            if output is not None:
+                output.append(line)
+            continue
+        _, path = line[len(RSYNC_DONE_MARKER):].split(':', 1)
+        cksum = pending.pop(path, None)
+        if cksum is None:
+            # directories created on the way are reported as well
+            continue
+        futures.append((path, cksum, verification_pool.submit(os.path.join(eos_home, path))))
+        if progress is not None:
+            progress.add(path, FileState.Transferred)
+    rsync_process.wait()
+    RSYNC_SECONDS.observe(time.monotonic() - start)
+    logger.debug(f'Rsync is done, {len(futures)} files already queued for verification')
+
+    final = [(path, cksum, verification_pool.submit(os.path.join(eos_home, path)))
+            for path, cksum in pending.items()]
+    # rsync reports a file before it renames its temporary file, an early checksum
+    # may have read the previous file or none at all
+    rechecked = 0
+    for path, cksum, future in futures:
+        if checksum_matches(future, cksum):
+            final.append((path, cksum, future))
+        else:
+            final.append((path, cksum, verification_pool.submit(os.path.join(eos_home, path))))
+            rechecked += 1
+    if rechecked:
+        logger.debug(f'Checking {rechecked} files again, they did not match before rsync exited')
+    return collect(final, verification_pool, progress)
 
-    temp, rsync_process = None, None
-    
-    while True:
-        eos_is_up(eos_prefix)
-        run, pathes, cksums = get_new_run(server, credentials)
+class ClientEngine:
+    '''Copies up to `concurrency` runs at once in a single process
+
+    Every worker thread leases a run and drives its own rsync process, while
+    the HTTP session, EOS probe and verification pool are shared. The number of
+    workers is re-read from config on SIGHUP, or from `control_file` if set.
+    '''
+    def __init__(self, config, concurrency=None):
+        self.config = config
+        self.credentials = (config['login'], config['passwd'])
+        self.server = config['server_address']
+        self.ihep_host = config['ihep_host']
+        self.ihep_port = config.get('ihep_port')
+        self.eos_home = config['eos_home']
+        self.pipelined = bool(config.get('pipelined', False))
+        self.rsync_streams = max(1, int(config.get('rsync_streams', 1)))
+        self.local_copies = bool(config.get('local_copies', True))
+        self.local_copy_mode = config.get('local_copy_mode', 'copy')
+        self.tuner = RsyncTuner.from_config(config) if config.get('rsync_tuning') else None
+        if self.tuner is not None:
+            for key in self.tuner.state():
+                METRICS.gauge(f'warden_client_tuning_{key}', f'{key} chosen by rsync tuning',
+                              callback=lambda key=key: self.tuner.state()[key])
+        if config.get('metrics_port'):
+            metrics.serve(METRICS, int(config['metrics_port']))
+        self.control_file = config.get('control_file')
+        self._control_mtime = None
+
+        # path like /eos
+        eos_prefix = '/' + self.eos_home.split('/')[1]
+        self.probe = EOSProbe(eos_prefix, ttl=int(config.get('eos_probe_interval', 30)))
+        self.verification_pool = pool_from_config(config)
+        self.wire_format = config.get('wire_format', 'json')
+        self.session = make_session(int(config.get('max_concurrency', 16)), config.get('client_id'),
+                                    self.wire_format)
+        self.heartbeats = HeartbeatSender(self.session, self.server, self.credentials,
+                                          int(config.get('heartbeat_interval', 60)))
+        prefetch = int(config.get('prefetch', 0))
+        self.prefetcher = None
+        if prefetch:
+            self.prefetcher = RunPrefetcher(self.session, self.server, self.credentials,
+                                            prefetch, self.heartbeats)
+
+        self.target = int(concurrency or config.get('concurrency', 1))
+        self.workers = dict()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.exit_code = 0
+        self._reload_requested = False
+
+    def resize(self, target):
+        target = max(0, int(target))
+        with self.lock:
+            if target != self.target:
+                logger.info(f'Changing number of concurrent runs {self.target} -> {target}')
+            self.target = target
+            for index in range(target):
+                worker = self.workers.get(index)
+                if worker is None or not worker.is_alive():
+                    worker = threading.Thread(target=self._worker, args=(index,),
+                                              name=f'warden-worker-{index}', daemon=True)
+                    self.workers[index] = worker
+                    worker.start()
+
+    def stop(self, exit_code):
+        with self.lock:
+            self.exit_code = max(self.exit_code, exit_code)
+            self.stopped.set()
+
+    def _should_stop(self, index):
+        with self.lock:
+            return self.stopped.is_set() or index >= self.target
+
+    def _worker(self, index):
+        logger.debug(f'Worker {index} started')
+        while not self._should_stop(index):
+            try:
+                self.probe.check()
+                run, pathes, cksums, resumed, copies, present = self.next_run()
+                try:
+                    self.process_run(run, pathes, cksums, resumed, copies, present)
+                finally:
+                    self.heartbeats.discard(run)
+            except NoMoreRuns:
+                self.stop(0)
+            except EOSUnavailable:
+                self.stop(1)
+            except Exception:
+                logger.exception(f'Worker {index} failed, shutting down the client')
+                self.stop(1)
+        logger.debug(f'Worker {index} stopped')
+
+    def next_run(self):
+        if self.prefetcher is not None:
+            return self.prefetcher.get()
+        lease = get_new_run(self.session, self.server, self.credentials)
+        self.heartbeats.add(lease[0])
+        return lease
+
+    def process_run(self, run, pathes, cksums, resumed=False, copies=None, present=None):
+        if resumed:
+            logger.info(f'Resuming {run}, {len(pathes)} files are not verified yet')
+        else:
+            logger.info(f'Starting new copy process for {run}')
+        progress = ProgressReporter(self.session, self.server, self.credentials, run, self.eos_home,
+                                    int(self.config.get('progress_batch', 500)),
+                                    float(self.config.get('progress_interval', 10)))
+        copied_bytes = 0
+        if present:
+            pathes, cksums, copied_bytes = self.verify_present(run, pathes, cksums, present, progress)
+        if copies and self.local_copies:
+            pathes, cksums, _, local_bytes = self.copy_local(run, pathes, cksums, copies, progress)
+            copied_bytes += local_bytes
+        # a single rsync is one TCP stream, split big runs over several of them
+        if self.tuner is not None:
+            n_streams = self.tuner.acquire(len(pathes))
+        else:
+            n_streams = min(self.rsync_streams, len(pathes)) or 1
+        stats = []
+        try:
+            if not pathes:
+                # everything was copied within EOS
+                wrong_checksums_files = []
+            elif n_streams == 1:
+                wrong_checksums_files = self.transfer(run, pathes, cksums, resumed, progress, stats)
+            else:
+                logger.debug(f'Copying {run} in {n_streams} rsync streams')
+                with ThreadPoolExecutor(max_workers=n_streams) as streams:
+                    results = streams.map(lambda k: self.transfer(run, pathes[k::n_streams], cksums[k::n_streams],
+                                                                  resumed, progress, stats),
+                                          range(n_streams))
+                    wrong_checksums_files = [entry for wrong in results for entry in wrong]
+        finally:
+            if self.tuner is not None:
+                self.tuner.release(n_streams)
+        if self.tuner is not None and stats:
+            # streams run side by side, the run took as long as the slowest one
+            self.tuner.observe(run, stats, max(s['seconds'] for s in stats), n_streams)
+
+        # server counts transferred files from progress reports, send them first
+        progress.flush()
+        # files copied within EOS are verified through the same reporter, sizes were taken then
+        transferred_files, transferred_bytes = progress.verified_files, progress.verified_bytes
+        RUN_BYTES.observe(transferred_bytes - copied_bytes)
+
+        n_wrong_files = len(wrong_checksums_files)
+        if n_wrong_files:
+            logger.warning(f'{n_wrong_files} files with wrong checksums, sending to server for resubmit')
+            msg = ClientMessage(run=run,
+                                status=Status.IntegrityFailed,
+                                failed_files=wrong_checksums_files,
+                                transferred_files=transferred_files,
+                                transferred_bytes=transferred_bytes)
+        else:
+            logger.info(f'Zero files failed checksums')
+            msg = ClientMessage(run=run, status=Status.Done,
+                                transferred_files=transferred_files,
+                                transferred_bytes=transferred_bytes)
+
+        finalize_run(session=self.session, server=self.server,
+                     credentials=self.credentials, message=msg, wire_format=self.wire_format)
+        RUNS.inc(status=msg.status.name)
+
+    def verify_present(self, run, pathes, cksums, present, progress):
+        '''Checksum files the server found in EOS instead of copying them again
+
+        Files with wrong checksums are removed, so rsync copies them again.
+        Returns pathes and cksums left for rsync and bytes of verified files.
+        '''
+        futures = [(path, cksum, self.verification_pool.submit(os.path.join(self.eos_home, path)))
+                   for path, cksum in zip(pathes, cksums) if path in present]
+        wrong = set(collect(futures, self.verification_pool, progress))
+        for path, _ in wrong:
+            # rsync --ignore-existing would keep the bad file
+            with suppress(OSError):
+                os.remove(os.path.join(self.eos_home, path))
+        verified = {path for path, cksum, _ in futures if (path, cksum) not in wrong}
+        verified_bytes = sum(file_size(os.path.join(self.eos_home, path)) for path in verified)
+        if verified:
+            logger.info(f'{len(verified)} files of {run} already in EOS have correct checksums, '
+                        f'{len(wrong)} are copied again')
+        left = [(path, cksum) for path, cksum in zip(pathes, cksums) if path not in verified]
+        return [path for path, _ in left], [cksum for _, cksum in left], verified_bytes
+
+    def copy_local(self, run, pathes, cksums, copies, progress):
+        '''Copy files whose content is already in EOS from there instead of IHEP
+
+        A source is used only if its size equals the size of the file at IHEP,
+        copies are verified like transferred files. Returns pathes and cksums
+        left for rsync, and the number and bytes of files copied locally.
+        '''
+        candidates = dict()
+        for path in pathes:
+            for source, size in copies.get(path, ()):
+                if file_size(os.path.join(self.eos_home, source)) == size:
+                    candidates.setdefault(path, []).append((source, size))
+        if not candidates:
+            return pathes, cksums, 0, 0
+        remote_sizes = self.remote_sizes(list(candidates))
+        futures, sizes = [], dict()
+        for path, cksum in zip(pathes, cksums):
+            source = next((source for source, size in candidates.get(path, ())
+                           if remote_sizes.get(path) == size), None)
+            if source is None:
+                continue
+            try:
+                self.copy_within_eos(source, path)
+            except OSError as e:
+                logger.debug(f'Failed to copy {source} to {path} in EOS: {e}')
+                continue
+            sizes[path] = remote_sizes[path]
+            futures.append((path, cksum, self.verification_pool.submit(os.path.join(self.eos_home, path))))
+        wrong = set(collect(futures, self.verification_pool, progress))
+        for path, _ in wrong:
+            # rsync --ignore-existing would keep the bad copy
+            with suppress(OSError):
+                os.remove(os.path.join(self.eos_home, path))
+        copied = {path for path, cksum, _ in futures if (path, cksum) not in wrong}
+        copied_bytes = sum(sizes[path] for path in copied)
+        LOCAL_COPIES.inc(len(copied))
+        LOCAL_COPY_BYTES.inc(copied_bytes)
+        if copied:
+            logger.info(f'Copied {len(copied)} files of {run} within EOS, {copied_bytes / 1024**3:.2f} GiB '
+                        f'not transferred from IHEP')
+        left = [(path, cksum) for path, cksum in zip(pathes, cksums) if path not in copied]
+        return [path for path, _ in left], [cksum for _, cksum in left], len(copied), copied_bytes
+
+    def remote_sizes(self, pathes):
+        '''path -> size of files at IHEP from rsync --list-only, no data is transferred'''
+        rsync_options = f'--port={self.ihep_port}' if self.ihep_port else ''
+        ihep_host = self.ihep_host
+        with NamedTemporaryFile(mode='w+t') as temp:
+            temp.write('\n'.join(pathes) + '\n')
+            temp.flush()
+            filelist = temp.name
+            rsync_command = RSYNC_LIST_COMMAND.format(**locals())
+            result = subprocess.run(rsync_command.split(), stdout=subprocess.PIPE,
+                                    stderr=subprocess.DEVNULL, universal_newlines=True, env=rsync_env())
+        return parse_list_only(result.stdout.splitlines())
+
+    def copy_within_eos(self, source, path):
+        '''Copy or hardlink `source` to `path`, the file appears under its name only when complete'''
+        target = os.path.join(self.eos_home, path)
+        directory, name = os.path.split(target)
+        os.makedirs(directory, exist_ok=True)
+        # hidden like rsync temporary files, so a crash never leaves a partial file under its name
+        temp = os.path.join(directory, f'.{name}.warden')
+        if self.local_copy_mode == 'hardlink':
+            with suppress(FileNotFoundError):
+                os.remove(temp)
+            os.link(os.path.join(self.eos_home, source), temp)
+        else:
+            shutil.copyfile(os.path.join(self.eos_home, source), temp)
+        os.replace(temp, target)
+
+    def transfer(self, run, pathes, cksums, resumed=False, progress=None, stats=None):
+        '''Copy files with one rsync process and verify them, returns (path, cksum) with wrong checksums
+
+        With tuning enabled rsync --stats of the process are appended to `stats`.
+        '''
+        ihep_host, eos_home = self.ihep_host, self.eos_home
+        rsync_options = self.tuner.options() if self.tuner is not None else '-z'
+        if self.ihep_port:
+            rsync_options += f' --port={self.ihep_port}'
+        output = [] if self.tuner is not None else None
         temp =  NamedTemporaryFile(mode='w+t')
         logger.debug(f'Created temporaty file {temp.name} to fill with pathes to transfer in {run}')
-        
+
         # prepare the file list for rsync process
         for path in pathes:
             temp.write(path+'\n')
@@ -108,49 +756,116 @@ def event_loop(config):
         temp.seek(0)
 
         filelist = temp.name
-        if "failed" in run:
-            rsync_command = RSYNC_REWRITE_COMMAND.format(**locals())
+        # files of a resumed run may be partially written, --ignore-existing would keep them
+        rewrite = "failed" in run or resumed
+        if self.pipelined:
+            template = RSYNC_PIPELINED_REWRITE_COMMAND if rewrite else RSYNC_PIPELINED_COMMAND
         else:
-            rsync_command = RSYNC_VERBOSE_COMMAND.format(**locals())
+            template = RSYNC_REWRITE_COMMAND if rewrite else RSYNC_VERBOSE_COMMAND
+        rsync_command = template.format(**locals())
 
-
-        logger.info(f'Starting new copy process for {run}')
         logger.debug(f'Executing {rsync_command}')
-        rsync_process = subprocess.Popen(rsync_command.split())
+        start = time.monotonic()
+        if self.pipelined:
+            wrong_checksums_files = transfer_and_verify(rsync_command, pathes, cksums,
+                                                        eos_home, self.verification_pool, progress,
+                                                        output)
+            temp.close()
+            # includes checksums of files rsync skipped, close enough for tuning
+            self._add_stats(stats, output, time.monotonic() - start)
+            return wrong_checksums_files
+
+        if output is None:
+            rsync_process = subprocess.Popen(rsync_command.split(), env=rsync_env())
+        else:
+            rsync_process = subprocess.Popen(rsync_command.split(), stdout=subprocess.PIPE,
+                                             universal_newlines=True, env=rsync_env())
+            for line in rsync_process.stdout:
+                # --progress prints lines for every file, only the --stats summary at the end is kept
+                if output or line.startswith('Number of files'):
+                    output.append(line)
 
-        # WILL BLOCK EXECUTION UNTIL RSYNC ENDS 
+        # WILL BLOCK EXECUTION UNTIL RSYNC ENDS
         logger.debug(f'Blocking till rsync finishes')
         waiter = rsync_process.wait()
+        RSYNC_SECONDS.observe(time.monotonic() - start)
         logger.debug(f'Rsync is done!')
+        self._add_stats(stats, output, time.monotonic() - start)
         # when rsync terminate, close temporary file
         temp.close()
         # compute and compare checksums:
         logger.debug(f'Computing checksums')
-        wrong_checksums_files = []
-        for path, cksum in zip(pathes, cksums):
-            path_in_eos = os.path.join(eos_home, path)
-            if compute_adler(path_in_eos) != cksum:
-                wrong_checksums_files.append((path, cksum))
+        futures = [(path, cksum, self.verification_pool.submit(os.path.join(eos_home, path)))
+                   for path, cksum in zip(pathes, cksums)]
+        return collect(futures, self.verification_pool, progress, throughput=True)
 
-        n_wrong_files = len(wrong_checksums_files)
-        if n_wrong_files:
-            logger.warning(f'{n_wrong_files} files with wrong checksums, sending to server for resubmit')
-            msg = ClientMessage(run=run,
-                                status=Status.IntegrityFailed,
-                                failed_files=wrong_checksums_files)
-        else:
-            logger.info(f'Zero files failed checksums')
-            msg = ClientMessage(run=run, status=Status.Done)
+    @staticmethod
+    def _add_stats(stats, output, seconds):
+        if stats is None or output is None:
+            return
+        try:
+            entry = parse_stats(output)
+        except ValueError as e:
+            # only this sample is lost, the run itself is fine
+            logger.warning(f'Failed to parse rsync --stats: {e}')
+            return
+        entry['seconds'] = seconds
+        # list.append is atomic, streams of a run share the list
+        stats.append(entry)
+
+    def _request_reload(self, signum=signal.SIGHUP, frame=None):
+        self._reload_requested = True
+
+    def _reload(self):
+        self._reload_requested = False
+        try:
+            config = get_config()
+        except Exception:
+            logger.exception('Failed to reload config, keeping current concurrency')
+            return
+        self.resize(config.get('concurrency', self.target))
+
+    def _poll_control_file(self):
+        if not self.control_file or not os.path.exists(self.control_file):
+            return
+        mtime = os.path.getmtime(self.control_file)
+        if mtime == self._control_mtime:
+            return
+        self._control_mtime = mtime
+        try:
+            with open(self.control_file) as f:
+                target = int(f.read().strip())
+        except ValueError:
+            logger.warning(f'Control file {self.control_file} must contain a number of concurrent runs')
+            return
+        self.resize(target)
 
-        finalize_run(server=server, credentials=credentials, message=msg)
+    def run(self):
+        signal.signal(signal.SIGHUP, self._request_reload)
+        self._poll_control_file()
+        self.resize(self.target)
+        while not self.stopped.wait(timeout=1):
+            if self._reload_requested:
+                self._reload()
+            self._poll_control_file()
 
+        logger.info('Waiting for runs in progress to finish')
+        for worker in list(self.workers.values()):
+            worker.join()
+        self.heartbeats.stop()
+        self.verification_pool.shutdown()
+        return self.exit_code
 
+def event_loop(config, concurrency=None):
+    engine = ClientEngine(config, concurrency)
+    sys.exit(engine.run())
 
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', type=int, nargs=1, help='Index of process, for systemd')
+    parser.add_argument('-n', '--concurrency', type=int, help='Number of runs copied concurrently')
     args = parser.parse_args()
     i = args.i
 
@@ -162,5 +877,4 @@ if __name__ == "__main__":
     logger.add(logpath, backtrace=True, diagnose=True, rotation='500 MB')
 
     config = get_config()
-    event_loop(config)
-    
+    event_loop(config, args.concurrency)
@@ -0,0 +1,77 @@
+'''Common layout of the memory-mapped binary files, the manifest and the snapshot
+
+A file is a fixed header ending with section offsets, CRC32 of the header
+and sections aligned to 8 bytes, all integers little-endian. Strings are
+kept in one UTF-8 section and referred to by (offset, length).
+'''
+import os
+import mmap
+import zlib
+import struct
+from typing import List, Sequence, Tuple, Type
+
+HEADER_CRC = struct.Struct('<I')
+
+
+def align(offset: int) -> int:
+    return (offset + 7) & ~7
+
+
+class StringTable:
+    '''UTF-8 strings of a file being written'''
+    def __init__(self):
+        self.data = bytearray()
+
+    def intern(self, s: str) -> Tuple[int, int]:
+        '''(offset, length) of `s` appended to the table'''
+        encoded = s.encode('utf-8')
+        offset = len(self.data)
+        self.data.extend(encoded)
+        return offset, len(encoded)
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+
+def write_file(path: str, header: struct.Struct, fields: Sequence, sections: List[bytes]):
+    '''Write `sections` to `path` atomically after a header of `fields` and their offsets'''
+    offsets = []
+    offset = align(header.size + HEADER_CRC.size)
+    for section in sections:
+        offsets.append(offset)
+        offset = align(offset + len(section))
+
+    packed = header.pack(*fields, *offsets)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(packed)
+        f.write(HEADER_CRC.pack(zlib.crc32(packed)))
+        for offset, section in zip(offsets, sections):
+            f.write(b'\x00' * (offset - f.tell()))
+            f.write(section)
+    os.replace(tmp_path, path)
+
+
+def map_file(path: str, kind: str, error: Type[Exception]) -> mmap.mmap:
+    '''Read-only map of a whole file, raises `error` if it is empty'''
+    with open(path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            raise error(f'{path} is too short to be a {kind}')
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def read_header(buf, header: struct.Struct, magic: bytes, version: int, path: str, kind: str,
+                error: Type[Exception]) -> tuple:
+    '''Fields of a header after its magic and version, raises `error` unless the header is intact'''
+    if len(buf) < header.size + HEADER_CRC.size:
+        raise error(f'{path} is too short to be a {kind}')
+    packed = buf[:header.size]
+    file_magic, file_version, *fields = header.unpack(packed)
+    if file_magic != magic:
+        raise error(f'{path} is not a {kind}')
+    if file_version != version:
+        raise error(f'{path} has {kind} version {file_version}, expected {version}')
+    crc, = HEADER_CRC.unpack_from(buf, header.size)
+    if crc != zlib.crc32(packed):
+        raise error(f'{path} header checksum mismatch')
+    return tuple(fields)
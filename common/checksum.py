@@ -0,0 +1,85 @@
+import os
+import mmap
+import zlib
+from typing import Iterable, List, Tuple
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, ProcessPoolExecutor
+
+# 4 MiB reads keep the FUSE client busy without bloating memory per reader
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def format_adler(value: int) -> str:
+    '''Format checksum the same way xrdadler32 does: 8 zero-padded hex digits'''
+    return '{:08x}'.format(value & 0xffffffff)
+
+
+def adler32_file(path: str, chunk_size: int = DEFAULT_CHUNK_SIZE, use_mmap: bool = False) -> str:
+    '''Streaming Adler-32 of a file, byte-identical to `xrdadler32` output'''
+    value = zlib.adler32(b'')
+    with open(path, 'rb') as f:
+        if use_mmap:
+            size = os.fstat(f.fileno()).st_size
+            # mmap of an empty file is not allowed
+            if size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    view = memoryview(mm)
+                    try:
+                        for offset in range(0, size, chunk_size):
+                            value = zlib.adler32(view[offset:offset+chunk_size], value)
+                    finally:
+                        view.release()
+            return format_adler(value)
+
+        buf = bytearray(chunk_size)
+        view = memoryview(buf)
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            value = zlib.adler32(view[:n], value)
+    return format_adler(value)
+
+
+class VerificationPool:
+    '''Bounded pool of readers computing Adler-32 checksums of transferred files
+
+    `workers` is the maximal number of files read concurrently. `mode` is either
+    "thread" (zlib releases the GIL on large buffers) or "process".
+    '''
+    def __init__(self, workers: int = 4, mode: str = 'thread',
+                 chunk_size: int = DEFAULT_CHUNK_SIZE, use_mmap: bool = False):
+        if mode not in ('thread', 'process'):
+            raise ValueError(f'Unknown verification pool mode {mode}')
+        self.workers = workers
+        self.mode = mode
+        self.chunk_size = chunk_size
+        self.use_mmap = use_mmap
+        executor_cls = ThreadPoolExecutor if mode == 'thread' else ProcessPoolExecutor
+        self.executor: Executor = executor_cls(max_workers=workers)
+
+    def submit(self, path: str) -> Future:
+        return self.executor.submit(adler32_file, path, self.chunk_size, self.use_mmap)
+
+    @staticmethod
+    def collect(futures: Iterable[Tuple[str, str, Future]]) -> List[Tuple[str, str]]:
+        '''Wait for submitted (path, cksum, future) entries, return mismatched ones'''
+        return [(path, cksum) for path, cksum, future in futures
+                if not checksum_matches(future, cksum)]
+
+    def shutdown(self, wait: bool = True):
+        self.executor.shutdown(wait=wait)
+
+
+def checksum_matches(future: Future, cksum: str) -> bool:
+    '''Missing or unreadable files count as mismatches'''
+    try:
+        return future.result() == cksum
+    except OSError:
+        return False
+
+
+def pool_from_config(config) -> VerificationPool:
+    return VerificationPool(workers=int(config.get('verify_workers', 4)),
+                            mode=config.get('verify_mode', 'thread'),
+                            chunk_size=int(config.get('verify_chunk_size', DEFAULT_CHUNK_SIZE)),
+                            use_mmap=bool(config.get('verify_mmap', False)))
@@ -0,0 +1,140 @@
+import time
+import string
+import resource
+from array import array
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+
+def split_entry(line: str, groupby_idx: int) -> Tuple[str, str, str]:
+    '''Split "/dybfs/path cksum" line of a good run list into (run, path, cksum)'''
+    path, cksum = line.split(' ')
+    # trim '/dybfs/', necessary for rsync to read files to copy from list
+    path = path.lstrip('/').partition('/')[2]
+    run = path.split('/')[groupby_idx]
+    return run, path, cksum.rstrip('\n')
+
+
+def pack_cksum(cksum: str) -> int:
+    '''32-bit value of a hex checksum, raises ValueError for anything else'''
+    # int() also takes signs, underscores and '0x'
+    if not 0 < len(cksum) <= 8 or cksum.strip(string.hexdigits):
+        raise ValueError(f'{cksum!r} is not an Adler-32 checksum')
+    return int(cksum, 16)
+
+
+def unpack_cksum(value: int) -> str:
+    # xrdadler32 prints 8 zero-padded hex digits
+    return '{:08x}'.format(value)
+
+
+class RunBlock:
+    '''Files of a run stored compactly
+
+    Directories are ids in a prefix table shared by all runs, checksums are
+    32-bit integers and basenames are joined into a single string. Tuples of
+    (path, cksum) are built only when the run is iterated, i.e. handed out.
+    '''
+    __slots__ = ('prefixes', 'dir_ids', 'cksums', '_names', '_names_list')
+
+    def __init__(self, prefixes: List[str]):
+        self.prefixes = prefixes
+        self.dir_ids = array('I')
+        self.cksums = array('I')
+        self._names = ''
+        self._names_list: List[str] = []
+
+    def append(self, dir_id: int, name: str, cksum: int):
+        if self._names_list is None:
+            # run is split in the list, unfreeze it
+            self._names_list = self.names()
+        self.dir_ids.append(dir_id)
+        self._names_list.append(name)
+        self.cksums.append(cksum)
+
+    def freeze(self):
+        '''Join basenames into one string once the run is fully loaded'''
+        if self._names_list is not None:
+            self._names = '\n'.join(self._names_list)
+            self._names_list = None
+
+    def names(self) -> List[str]:
+        if self._names_list is not None:
+            return self._names_list
+        return self._names.split('\n')
+
+    def __iter__(self) -> Iterator[Tuple[str, str]]:
+        prefixes = self.prefixes
+        for dir_id, name, cksum in zip(self.dir_ids, self.names(), self.cksums):
+            yield prefixes[dir_id] + name, unpack_cksum(cksum)
+
+    def __len__(self) -> int:
+        return len(self.cksums)
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def build_blocks(lines: Iterable[str], groupby_idx: int = 5,
+                 invalid: Optional[List[str]] = None) -> Tuple[Dict[str, RunBlock], List[str]]:
+    '''Pack good run list lines into per-run blocks, returns blocks and shared prefix table
+
+    Malformed lines and lines with checksums that are not 8 hex digits are
+    skipped and, if `invalid` is given, appended to it for the caller to report.
+    '''
+    prefixes: List[str] = []
+    prefix_ids: Dict[str, int] = dict()
+    good_runs: Dict[str, RunBlock] = dict()
+    # runs whose lines are spread over the list, frozen only once all lines are read
+    spread = set()
+    current_run, block = None, None
+    for entry in lines:
+        try:
+            run, path, cksum = split_entry(entry, groupby_idx)
+            packed = pack_cksum(cksum)
+        except (ValueError, IndexError):
+            if invalid is not None:
+                invalid.append(entry.rstrip('\n'))
+            continue
+        # prefix keeps trailing '/', so path is prefix + name
+        cut = path.rfind('/') + 1
+        prefix = path[:cut]
+        dir_id = prefix_ids.get(prefix)
+        if dir_id is None:
+            dir_id = prefix_ids[prefix] = len(prefixes)
+            prefixes.append(prefix)
+        if block is None or run != current_run:
+            # runs are usually contiguous in the list, pack the previous one
+            if block is not None and current_run not in spread:
+                block.freeze()
+            current_run = run
+            block = good_runs.get(run)
+            if block is None:
+                block = good_runs[run] = RunBlock(prefixes)
+            else:
+                # appending unfreezes it, unfreezing again for every later line is quadratic
+                spread.add(run)
+        block.append(dir_id, path[cut:], packed)
+
+    for block in good_runs.values():
+        block.freeze()
+    return good_runs, prefixes
+
+
+def load_good_run_list(good_run_list: str, groupby_idx: int = 5) -> Dict[str, RunBlock]:
+    '''Read good run list in one pass into compact per-run blocks'''
+    # imported here: the manifest writer uses this module on IHEP nodes without loguru
+    from loguru import logger
+    start = time.monotonic()
+    invalid: List[str] = []
+    with open(good_run_list, 'r') as f:
+        good_runs, prefixes = build_blocks(f, groupby_idx, invalid)
+    if invalid:
+        logger.error(f'Skipped {len(invalid)} malformed lines of {good_run_list}, '
+                     f'e.g. {invalid[:3]}, their files are not copied')
+    n_files = sum(len(block) for block in good_runs.values())
+    logger.info(f'Loaded {n_files} files in {len(good_runs)} runs from {good_run_list} '
+                f'in {time.monotonic() - start:.1f} s, {len(prefixes)} distinct directories, '
+                f'peak RSS {peak_rss_mb():.0f} MB')
+    return good_runs
@@ -0,0 +1,80 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+from loguru import logger
+
+
+class Inventory:
+    '''Files transferred to EOS, with file and byte totals per run
+
+    Fed by finalize reports of clients, so answering totals never touches EOS.
+    Can be overwritten from a scan of the destination with `reconcile`.
+    '''
+    def __init__(self):
+        self.per_run: Dict[str, Tuple[int, int]] = dict()
+        self.files = 0
+        self.bytes = 0
+
+    def record(self, run: str, n_files: int, n_bytes: int):
+        '''Set totals of a run, reporting the same run again replaces its totals'''
+        old_files, old_bytes = self.per_run.get(run, (0, 0))
+        self.per_run[run] = (n_files, n_bytes)
+        self.files += n_files - old_files
+        self.bytes += n_bytes - old_bytes
+
+    def reconcile(self, per_run: Dict[str, Tuple[int, int]]):
+        self.per_run = dict(per_run)
+        self.files = sum(n_files for n_files, _ in self.per_run.values())
+        self.bytes = sum(n_bytes for _, n_bytes in self.per_run.values())
+
+    def totals(self) -> Dict[str, int]:
+        return {'runs': len(self.per_run), 'files': self.files, 'bytes': self.bytes}
+
+    def run(self, run: str) -> Dict[str, int]:
+        n_files, n_bytes = self.per_run[run]
+        return {'run': run, 'files': n_files, 'bytes': n_bytes}
+
+
+def _list_dir(path: str) -> Tuple[List[Tuple[str, int]], List[str]]:
+    files, dirs = [], []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        files.append((entry.path, entry.stat(follow_symlinks=False).st_size))
+                except OSError:
+                    # file removed while listing
+                    continue
+    except OSError as e:
+        logger.warning(f'Failed to list {path}: {e}')
+    return files, dirs
+
+
+def scan_tree(root: str, workers: int = 8) -> Iterator[Tuple[str, int]]:
+    '''Walk `root` listing directories in parallel, yields (path relative to root, size)'''
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {pool.submit(_list_dir, root)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, dirs = future.result()
+                pending.update(pool.submit(_list_dir, path) for path in dirs)
+                for path, size in files:
+                    yield os.path.relpath(path, root), size
+
+
+def summarize(entries: Iterable[Tuple[str, int]], groupby_idx: int) -> Dict[str, Tuple[int, int]]:
+    '''Per-run (files, bytes) of (path, size) entries, run is the `groupby_idx` path component'''
+    per_run: Dict[str, Tuple[int, int]] = dict()
+    for path, size in entries:
+        tokens = path.split('/')
+        if len(tokens) <= groupby_idx + 1:
+            # not deep enough to belong to any run
+            continue
+        n_files, n_bytes = per_run.get(tokens[groupby_idx], (0, 0))
+        per_run[tokens[groupby_idx]] = (n_files + 1, n_bytes + size)
+    return per_run
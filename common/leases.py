@@ -0,0 +1,72 @@
+import heapq
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+
+class Lease:
+    __slots__ = ('leased_at', 'deadline', 'pathes')
+
+    def __init__(self, leased_at: datetime, deadline: datetime, pathes: Any):
+        self.leased_at = leased_at
+        self.deadline = deadline
+        self.pathes = pathes
+
+
+class LeaseTable:
+    '''Runs in process ordered by lease deadline
+
+    Deadlines live in a min-heap, so expiring leases costs O(log n) per
+    expired run instead of a scan over every run in process. A heartbeat pushes
+    a new deadline, outdated heap entries are dropped when they surface.
+    '''
+    def __init__(self, ttl: timedelta):
+        self.ttl = ttl
+        self._leases: Dict[str, Lease] = dict()
+        self._deadlines: List[Tuple[datetime, str]] = []
+
+    def add(self, run: str, pathes: Any, leased_at: Optional[datetime] = None):
+        now = datetime.now()
+        lease = Lease(leased_at or now, now + self.ttl, pathes)
+        self._leases[run] = lease
+        heapq.heappush(self._deadlines, (lease.deadline, run))
+
+    def heartbeat(self, run: str) -> datetime:
+        '''Extend the lease of a run, raises KeyError if it is not leased'''
+        lease = self._leases[run]
+        lease.deadline = datetime.now() + self.ttl
+        heapq.heappush(self._deadlines, (lease.deadline, run))
+        return lease.deadline
+
+    def pop(self, run: str) -> Tuple[datetime, Any]:
+        '''Remove the lease, returns (leased_at, pathes)'''
+        lease = self._leases.pop(run)
+        return lease.leased_at, lease.pathes
+
+    def expired(self, now: Optional[datetime] = None) -> List[Tuple[str, Any]]:
+        '''Remove and return (run, pathes) of leases past their deadline'''
+        now = now or datetime.now()
+        expired = []
+        while self._deadlines and self._deadlines[0][0] < now:
+            deadline, run = heapq.heappop(self._deadlines)
+            lease = self._leases.get(run)
+            # stale entry: lease is gone or was extended by a heartbeat
+            if lease is None or lease.deadline != deadline:
+                continue
+            del self._leases[run]
+            expired.append((run, lease.pathes))
+        if len(self._deadlines) > 2 * len(self._leases) + 64:
+            self._compact()
+        return expired
+
+    def _compact(self):
+        self._deadlines = [(lease.deadline, run) for run, lease in self._leases.items()]
+        heapq.heapify(self._deadlines)
+
+    def items(self) -> Iterator[Tuple[str, Tuple[datetime, Any]]]:
+        return ((run, (lease.leased_at, lease.pathes)) for run, lease in self._leases.items())
+
+    def __contains__(self, run: str) -> bool:
+        return run in self._leases
+
+    def __len__(self) -> int:
+        return len(self._leases)
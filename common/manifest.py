@@ -0,0 +1,173 @@
+'''Binary manifest of a good run list with checksums
+
+The manifest is memory-mapped by the server, so neither startup nor run
+lookup depends on the size of the list. Layout, all integers little-endian:
+
+    header      magic, version, counts, fingerprint of the source text list,
+                offsets of sections, CRC32 of the header itself
+    runs        (name offset, name length, first file, number of files)
+    prefixes    (offset, length) of deduplicated directory prefixes
+    dir_ids     u32 prefix id of every file
+    name_offs   u64 offsets of file basenames, one extra entry for the end
+    cksums      u32 Adler-32 of every file
+    strings     UTF-8 run names, prefixes and basenames
+
+Files of a run are stored contiguously.
+'''
+import os
+import sys
+import zlib
+import struct
+from array import array
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+from common.binfile import StringTable, map_file, read_header, write_file
+from common.goodruns import build_blocks, unpack_cksum
+
+MAGIC = b'RWMANIF\x00'
+VERSION = 1
+
+HEADER = struct.Struct('<8sHHIIQQI6Q')
+RUN = struct.Struct('<QIII')
+PREFIX = struct.Struct('<QI')
+
+# bytes from both ends of the source list used to fingerprint it
+SAMPLE_SIZE = 64 * 1024
+
+
+class ManifestError(ValueError):
+    '''Manifest is corrupted, of unknown version or does not match the good run list'''
+
+
+def source_fingerprint(path: str) -> Tuple[int, int]:
+    '''(size, crc32 of head and tail) of a text good run list, cheap for any size'''
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        crc = zlib.crc32(f.read(SAMPLE_SIZE))
+        f.seek(max(0, size - SAMPLE_SIZE))
+        crc = zlib.crc32(f.read(SAMPLE_SIZE), crc)
+    return size, crc
+
+
+def _typed(buf, typecode: str) -> array:
+    out = array(typecode)
+    out.frombytes(buf)
+    if sys.byteorder != 'little':
+        out.byteswap()
+    return out
+
+
+def write_manifest(path: str, lines: Iterable[str], groupby_idx: int = 5, source: str = None) -> List[str]:
+    '''Write manifest of good run list `lines` to `path` atomically
+
+    `source` is the text good run list the manifest is built for, servers
+    reject the manifest if that list changed. Returns malformed lines left out.
+    '''
+    invalid: List[str] = []
+    blocks, prefixes = build_blocks(lines, groupby_idx, invalid)
+    source_size, source_crc = source_fingerprint(source) if source else (0, 0)
+
+    strings = StringTable()
+    intern = strings.intern
+
+    # basenames go last and contiguous, so a name ends where the next one starts
+    prefixes_table = bytearray()
+    for prefix in prefixes:
+        prefixes_table += PREFIX.pack(*intern(prefix))
+
+    runs_table = bytearray()
+    first = 0
+    for run, block in blocks.items():
+        runs_table += RUN.pack(*intern(run), first, len(block))
+        first += len(block)
+
+    dir_ids, name_offs, cksums = array('I'), array('Q'), array('I')
+    for block in blocks.values():
+        dir_ids.extend(block.dir_ids)
+        cksums.extend(block.cksums)
+        for name in block.names():
+            name_offs.append(intern(name)[0])
+    name_offs.append(len(strings))
+
+    sections = [bytes(runs_table), bytes(prefixes_table)]
+    for typed in (dir_ids, name_offs, cksums):
+        if sys.byteorder != 'little':
+            typed.byteswap()
+        sections.append(typed.tobytes())
+    sections.append(bytes(strings.data))
+
+    write_file(path, HEADER, (MAGIC, VERSION, groupby_idx, len(blocks), len(prefixes), len(cksums),
+                              source_size, source_crc), sections)
+    return invalid
+
+
+class ManifestRun:
+    '''Files of a run in a manifest, decoded only when iterated'''
+    __slots__ = ('manifest', 'first', 'n_files')
+
+    def __init__(self, manifest: 'Manifest', first: int, n_files: int):
+        self.manifest = manifest
+        self.first = first
+        self.n_files = n_files
+
+    def __iter__(self) -> Iterator[Tuple[str, str]]:
+        m = self.manifest
+        for i in range(self.first, self.first + self.n_files):
+            name = m.string(m.name_offs[i], m.name_offs[i+1] - m.name_offs[i])
+            yield m.prefixes[m.dir_ids[i]] + name, unpack_cksum(m.cksums[i])
+
+    def __len__(self) -> int:
+        return self.n_files
+
+
+class Manifest:
+    '''Memory-mapped manifest, sections are used in place without copying'''
+    def __init__(self, path: str):
+        self.path = path
+        self.mm = map_file(path, 'manifest', ManifestError)
+        self._parse_header()
+
+    def _parse_header(self):
+        mm = self.mm
+        (self.groupby_idx, self.n_runs, n_prefixes, self.n_files, self.source_size, self.source_crc,
+         *offsets) = read_header(mm, HEADER, MAGIC, VERSION, self.path, 'manifest', ManifestError)
+
+        off_runs, off_prefixes, off_dir_ids, off_name_offs, off_cksums, off_strings = offsets
+        if len(mm) < off_strings:
+            raise ManifestError(f'{self.path} is truncated')
+        view = memoryview(mm)
+        self.strings = view[off_strings:]
+        if sys.byteorder == 'little':
+            self.dir_ids = view[off_dir_ids:off_dir_ids + 4*self.n_files].cast('I')
+            self.name_offs = view[off_name_offs:off_name_offs + 8*(self.n_files+1)].cast('Q')
+            self.cksums = view[off_cksums:off_cksums + 4*self.n_files].cast('I')
+        else:
+            self.dir_ids = _typed(view[off_dir_ids:off_dir_ids + 4*self.n_files], 'I')
+            self.name_offs = _typed(view[off_name_offs:off_name_offs + 8*(self.n_files+1)], 'Q')
+            self.cksums = _typed(view[off_cksums:off_cksums + 4*self.n_files], 'I')
+
+        self.prefixes: List[str] = [self.string(*PREFIX.unpack_from(mm, off_prefixes + i*PREFIX.size))
+                                    for i in range(n_prefixes)]
+        self.run_index: Dict[str, Tuple[int, int]] = dict()
+        for i in range(self.n_runs):
+            name_off, name_len, first, n_files = RUN.unpack_from(mm, off_runs + i*RUN.size)
+            self.run_index[self.string(name_off, name_len)] = (first, n_files)
+
+    def string(self, offset: int, length: int) -> str:
+        return str(self.strings[offset:offset+length], 'utf-8')
+
+    def is_stale(self, source: str) -> bool:
+        '''True if text good run list `source` is not the one the manifest was built from'''
+        if not self.source_size:
+            return False
+        return source_fingerprint(source) != (self.source_size, self.source_crc)
+
+    def __getitem__(self, run: str) -> ManifestRun:
+        return ManifestRun(self, *self.run_index[run])
+
+    def __contains__(self, run: str) -> bool:
+        return run in self.run_index
+
+    def runs(self) -> Dict[str, ManifestRun]:
+        return {run: ManifestRun(self, first, n_files)
+                for run, (first, n_files) in self.run_index.items()}
@@ -1,4 +1,4 @@
-from typing import Optional, List, Tuple
+from typing import Dict, Optional, List, Tuple
 from enum import Enum, auto
 from pydantic import BaseModel
 
@@ -11,3 +11,18 @@ class ClientMessage(BaseModel):
     run: str
     status: Status
     failed_files: Optional[List[Tuple[str, str]]] = None
+    # files of the run verified in EOS and their total size
+    transferred_files: Optional[int] = None
+    transferred_bytes: Optional[int] = None
+
+class FileState(Enum):
+    Pending = auto()
+    Transferred = auto()
+    Verified = auto()
+    Failed = auto()
+
+class ProgressReport(BaseModel):
+    # (path, state, size in bytes if known)
+    files: List[Tuple[str, FileState, Optional[int]]]
+    # path -> Adler-32 of verified files, indexed by servers keeping a content index
+    cksums: Dict[str, str] = dict()
@@ -0,0 +1,121 @@
+'''Files of queued runs that are already in the destination
+
+Used at server startup, so files copied before a crash or by hand are not
+copied again. Only directories holding files of queued runs are
+listed, `workers` runs at a time, instead of walking the whole destination.
+'''
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from loguru import logger
+
+from common.checksum import VerificationPool, checksum_matches
+
+
+class RunPresence(NamedTuple):
+    run: str
+    n_files: int
+    # (path, size) of files of the run found in the destination
+    present: List[Tuple[str, int]]
+    # checksums of present files were compared and match
+    verified: bool = False
+
+    @property
+    def complete(self) -> bool:
+        return len(self.present) == self.n_files
+
+    @property
+    def n_bytes(self) -> int:
+        return sum(size for _, size in self.present)
+
+
+def list_files(directory: str) -> Dict[str, int]:
+    '''name -> size of regular files in `directory`, empty if it does not exist'''
+    files = dict()
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                # rsync writes into hidden temporary files and renames them when complete
+                if entry.name.startswith('.'):
+                    continue
+                try:
+                    if entry.is_file(follow_symlinks=False):
+                        files[entry.name] = entry.stat(follow_symlinks=False).st_size
+                except OSError:
+                    continue
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning(f'Failed to list {directory}: {e}')
+    return files
+
+
+def verified(root: str, found: List[Tuple[str, str, int]], pool: VerificationPool,
+             window: int) -> List[Tuple[str, int]]:
+    '''(path, size) of found (path, cksum, size) files with matching checksums, `window` files in flight'''
+    matched: List[Tuple[str, int]] = []
+    in_flight: deque = deque()
+
+    def collect_one():
+        path, cksum, size, future = in_flight.popleft()
+        if checksum_matches(future, cksum):
+            matched.append((path, size))
+
+    for path, cksum, size in found:
+        in_flight.append((path, cksum, size, pool.submit(os.path.join(root, path))))
+        if len(in_flight) >= window:
+            collect_one()
+    while in_flight:
+        collect_one()
+    return matched
+
+
+class Reconciler:
+    '''Checks runs against the destination `root`
+
+    A file is present if it exists under its final name, like rsync
+    --ignore-existing decides. With `pool` its checksum must match too and
+    presences are `verified`, otherwise nothing is known about the content of
+    present files and clients still have to checksum them.
+    '''
+    def __init__(self, root: str, workers: int = 8, pool: Optional[VerificationPool] = None,
+                 window: int = 64):
+        self.root = root
+        self.workers = workers
+        self.pool = pool
+        self.window = window
+
+    def check(self, run: str, pathes: Any) -> Optional[RunPresence]:
+        files = list(pathes)
+        listings: Dict[str, Dict[str, int]] = dict()
+        found = []
+        for path, cksum in files:
+            directory, _, name = path.rpartition('/')
+            if directory not in listings:
+                listings[directory] = list_files(os.path.join(self.root, directory))
+            size = listings[directory].get(name)
+            if size is not None:
+                found.append((path, cksum, size))
+        if not found:
+            return None
+        if self.pool is not None:
+            presence = RunPresence(run, len(files), verified(self.root, found, self.pool, self.window), True)
+        else:
+            presence = RunPresence(run, len(files), [(path, size) for path, _, size in found])
+        return presence if presence.present else None
+
+    def runs(self, runs: Iterable[Tuple[str, Any]]) -> Iterator[RunPresence]:
+        '''Presence of runs with at least one file in the destination, in order of completion'''
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = set()
+            for run, pathes in runs:
+                pending.add(executor.submit(self.check, run, pathes))
+                if len(pending) >= 2 * self.workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    yield from filter(None, (future.result() for future in done))
+            for future in pending:
+                presence = future.result()
+                if presence is not None:
+                    yield presence
@@ -0,0 +1,156 @@
+import heapq
+import itertools
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+RETRY_PREFIX = 'failed_'
+
+
+def is_retry(run: str) -> bool:
+    '''Runs of files that failed verification, resubmitted by the server'''
+    return run.startswith(RETRY_PREFIX)
+
+
+def count_files(pathes: Any) -> int:
+    return len(pathes)
+
+
+class RunQueue:
+    '''Runs waiting for a client, handed out by priority
+
+    Retry runs go first, then the heaviest runs, so the longest transfers do
+    not end up at the tail of the campaign. Behaves as a dict of run -> file
+    list, but `popitem` returns the run with the highest priority. Entries are
+    kept in a heap with lazy deletion, removing a run only drops it from the
+    dict and its heap entry is skipped when it surfaces.
+
+    With `group` set, runs are also queued by group, e.g. parent directory,
+    and `popitem(client)` prefers the group of the previous run of that client.
+    '''
+    def __init__(self, weight: Callable[[str, Any], int] = None,
+                 group: Callable[[str, Any], str] = None):
+        self.weight = weight or (lambda run, pathes: count_files(pathes))
+        self.group = group
+        self._runs: Dict[str, Any] = dict()
+        # run -> (priority, seq) of its live heap entry
+        self._keys: Dict[str, Tuple[Tuple[int, int], int]] = dict()
+        self._heap: List[Tuple[Tuple[int, int], int, str]] = []
+        self._groups: Dict[str, List[Tuple[Tuple[int, int], int, str]]] = dict()
+        self._run_groups: Dict[str, str] = dict()
+        self._client_groups: Dict[str, str] = dict()
+        self._seq = itertools.count()
+
+    def priority(self, run: str, pathes: Any) -> Tuple[int, int]:
+        # heapq is a min-heap: retries (0) before regular runs (1), heavier first
+        return (0 if is_retry(run) else 1, -self.weight(run, pathes))
+
+    def __setitem__(self, run: str, pathes: Any):
+        group = self.group(run, pathes) if self.group is not None else None
+        self._push(run, pathes, self.priority(run, pathes), group)
+
+    def _push(self, run: str, pathes: Any, priority: Tuple[int, int], group: Optional[str]):
+        key = (priority, next(self._seq))
+        self._runs[run] = pathes
+        self._keys[run] = key
+        entry = (*key, run)
+        heapq.heappush(self._heap, entry)
+        if self.group is not None:
+            self._run_groups[run] = group
+            heapq.heappush(self._groups.setdefault(group, []), entry)
+
+    def restore(self, entries: Iterable[Tuple[str, Any, Tuple[int, int], Optional[str]]]):
+        '''Queue (run, pathes, priority, group) entries weighed before, e.g. saved in a snapshot'''
+        for run, pathes, priority, group in entries:
+            if self.group is not None and group is None:
+                group = self.group(run, pathes)
+            self._push(run, pathes, priority, group)
+
+    def keys(self) -> List[Tuple[str, Tuple[int, int], Optional[str]]]:
+        '''(run, priority, group) of queued runs in the order they were queued, for `restore`'''
+        return [(run, priority, self._run_groups.get(run))
+                for run, (priority, _) in sorted(self._keys.items(), key=lambda item: item[1][1])]
+
+    @property
+    def client_groups(self) -> Dict[str, str]:
+        '''Group of the previous run of every client'''
+        return self._client_groups
+
+    def update(self, runs: Any):
+        items = runs.items() if hasattr(runs, 'items') else runs
+        for run, pathes in items:
+            self[run] = pathes
+
+    def __getitem__(self, run: str) -> Any:
+        return self._runs[run]
+
+    def __delitem__(self, run: str):
+        del self._runs[run]
+        del self._keys[run]
+        self._run_groups.pop(run, None)
+
+    def pop(self, run: str, *default) -> Any:
+        if run not in self._runs:
+            if default:
+                return default[0]
+            raise KeyError(run)
+        pathes = self._runs[run]
+        del self[run]
+        return pathes
+
+    def _live(self, heap: List[Tuple[Tuple[int, int], int, str]]):
+        '''Head of `heap` after dropping entries of removed or re-queued runs'''
+        while heap:
+            priority, seq, run = heap[0]
+            if self._keys.get(run) == (priority, seq):
+                return heap[0]
+            heapq.heappop(heap)
+        return None
+
+    def popitem(self, client: Optional[str] = None) -> Tuple[str, Any]:
+        '''Remove and return (run, pathes) of the next run, raises KeyError if empty'''
+        head = self._live(self._heap)
+        if head is None:
+            raise KeyError('popitem(): run queue is empty')
+        if self.group is not None and client is not None and not is_retry(head[2]):
+            group = self._client_groups.get(client)
+            group_head = self._live(self._groups.get(group, []))
+            if group_head is not None:
+                head = group_head
+        run = head[2]
+        group = self._run_groups.get(run)
+        pathes = self.pop(run)
+        if group is not None:
+            if client is not None:
+                self._client_groups[client] = group
+            if self._live(self._groups[group]) is None:
+                del self._groups[group]
+        if len(self._heap) > 2 * len(self._runs) + 64:
+            self._compact()
+        return run, pathes
+
+    def _compact(self):
+        self._heap = [(*self._keys[run], run) for run in self._runs]
+        heapq.heapify(self._heap)
+        if self.group is not None:
+            self._groups = dict()
+            for entry in self._heap:
+                self._groups.setdefault(self._run_groups[entry[2]], []).append(entry)
+            for heap in self._groups.values():
+                heapq.heapify(heap)
+
+    def peek(self, limit: int) -> List[Tuple[str, Tuple[int, int]]]:
+        '''(run, priority) of the first `limit` runs in the order they will be handed out'''
+        entries = heapq.nsmallest(limit, (entry for entry in self._heap
+                                          if self._keys.get(entry[2]) == entry[:2]))
+        return [(run, priority) for priority, _, run in entries]
+
+    def items(self) -> Iterator[Tuple[str, Any]]:
+        return iter(self._runs.items())
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._runs)
+
+    def __contains__(self, run: str) -> bool:
+        return run in self._runs
+
+    def __len__(self) -> int:
+        return len(self._runs)
@@ -0,0 +1,48 @@
+from itertools import islice
+from typing import Any, Iterator, List, Tuple
+
+# shard k of run R is leased as "R#k", clients must quote it in URLs
+SHARD_SEP = '#'
+
+
+def is_shard(run: str) -> bool:
+    return SHARD_SEP in run
+
+
+def parent_run(run: str) -> str:
+    '''Run a shard belongs to, the run itself if it is not a shard'''
+    return run.split(SHARD_SEP, 1)[0]
+
+
+def shard_bounds(n_files: int, max_files: int) -> List[Tuple[int, int]]:
+    '''(start, stop) of the fewest shards of at most `max_files` files, sizes differ by one at most'''
+    n_shards = -(-n_files // max_files)
+    base, extra = divmod(n_files, n_shards)
+    bounds, start = [], 0
+    for k in range(n_shards):
+        stop = start + base + (k < extra)
+        bounds.append((start, stop))
+        start = stop
+    return bounds
+
+
+class RunShard:
+    '''Slice of the file list of a run, read from the parent list when iterated'''
+    __slots__ = ('parent', 'start', 'stop')
+
+    def __init__(self, parent: Any, start: int, stop: int):
+        self.parent = parent
+        self.start = start
+        self.stop = stop
+
+    def __iter__(self) -> Iterator[Tuple[str, str]]:
+        return islice(iter(self.parent), self.start, self.stop)
+
+    def __len__(self) -> int:
+        return self.stop - self.start
+
+
+def split_run(run: str, pathes: Any, max_files: int) -> List[Tuple[str, RunShard]]:
+    '''Shards of a run with more than `max_files` files, leased independently'''
+    return [(f'{run}{SHARD_SEP}{k}', RunShard(pathes, start, stop))
+            for k, (start, stop) in enumerate(shard_bounds(len(pathes), max_files))]
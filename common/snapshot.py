@@ -0,0 +1,129 @@
+'''Binary snapshot of the scheduler state for fast restarts
+
+The state store decides which runs are queued or leased, but rebuilding the
+queue from it weighs every run again, which reads file counts, run sizes and,
+with client affinity, the first file of every run. The snapshot keeps those
+keys, so a restart memory-maps it and queues runs without touching their file
+lists. Runs the snapshot does not know, e.g. queued after it was written, are
+weighed as usual. Layout, all integers little-endian:
+
+    header      magic, version, counts, creation time, fingerprint of the
+                scheduling settings, offsets of sections, CRC32 of the header
+    runs        (name offset, name length, retry, weight, number of files,
+                group id or -1, lease time or 0 for queued runs)
+    groups      (offset, length) of group names
+    clients     (name offset, name length, group id) of the last group of a client
+    strings     UTF-8 names
+'''
+import zlib
+import struct
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from common.binfile import StringTable, map_file, read_header, write_file
+
+MAGIC = b'RWSNAPS\x00'
+VERSION = 1
+
+HEADER = struct.Struct('<8sHHIIIdI4Q')
+RUN = struct.Struct('<QIBqIid')
+STRING = struct.Struct('<QI')
+CLIENT = struct.Struct('<QIi')
+
+
+class SnapshotError(ValueError):
+    '''Snapshot is corrupted, of unknown version or made with other scheduling settings'''
+
+
+class SnapshotRun(NamedTuple):
+    run: str
+    # RunQueue.priority: (0 for retries, minus weight)
+    priority: Tuple[int, int]
+    n_files: int
+    group: Optional[str]
+    # lease time for runs in process, None for queued runs
+    leased_at: Optional[float]
+
+
+def settings_fingerprint(*settings) -> int:
+    return zlib.crc32(repr(settings).encode('utf-8'))
+
+
+def write_snapshot(path: str, runs: Iterable[SnapshotRun], client_groups: Dict[str, str],
+                   fingerprint: int, created_at: float):
+    '''Write snapshot of `runs` to `path` atomically'''
+    strings = StringTable()
+    intern = strings.intern
+
+    group_ids: Dict[str, int] = dict()
+    groups_table = bytearray()
+
+    def group_id(group: Optional[str]) -> int:
+        if group is None:
+            return -1
+        gid = group_ids.get(group)
+        if gid is None:
+            gid = group_ids[group] = len(group_ids)
+            groups_table.extend(STRING.pack(*intern(group)))
+        return gid
+
+    runs_table = bytearray()
+    n_runs = 0
+    for entry in runs:
+        retry, weight = entry.priority
+        runs_table += RUN.pack(*intern(entry.run), retry, weight, entry.n_files,
+                               group_id(entry.group), entry.leased_at or 0.0)
+        n_runs += 1
+
+    clients_table = bytearray()
+    for client, group in client_groups.items():
+        clients_table += CLIENT.pack(*intern(client), group_id(group))
+
+    sections = [bytes(runs_table), bytes(groups_table), bytes(clients_table), bytes(strings.data)]
+    write_file(path, HEADER, (MAGIC, VERSION, 0, n_runs, len(group_ids), len(client_groups),
+                              created_at, fingerprint), sections)
+
+
+class Snapshot:
+    '''Memory-mapped snapshot, runs are decoded when iterated'''
+    def __init__(self, path: str, fingerprint: Optional[int] = None):
+        self.path = path
+        self.mm = map_file(path, 'snapshot', SnapshotError)
+        try:
+            self._parse_header(fingerprint)
+        except SnapshotError:
+            self.close()
+            raise
+
+    def _parse_header(self, fingerprint: Optional[int]):
+        mm = self.mm
+        (_, self.n_runs, n_groups, n_clients, self.created_at, self.fingerprint,
+         *offsets) = read_header(mm, HEADER, MAGIC, VERSION, self.path, 'snapshot', SnapshotError)
+        if fingerprint is not None and fingerprint != self.fingerprint:
+            raise SnapshotError(f'{self.path} was written with other scheduling settings')
+
+        self.off_runs, off_groups, off_clients, off_strings = offsets
+        if (len(mm) < off_strings or off_groups < self.off_runs + self.n_runs * RUN.size
+                or off_clients < off_groups + n_groups * STRING.size):
+            raise SnapshotError(f'{self.path} is truncated')
+        self.strings = memoryview(mm)[off_strings:]
+        self.groups: List[str] = [self.string(*STRING.unpack_from(mm, off_groups + i*STRING.size))
+                                  for i in range(n_groups)]
+        self.client_groups: Dict[str, str] = dict()
+        for i in range(n_clients):
+            name_off, name_len, gid = CLIENT.unpack_from(mm, off_clients + i*CLIENT.size)
+            self.client_groups[self.string(name_off, name_len)] = self.groups[gid]
+
+    def string(self, offset: int, length: int) -> str:
+        return str(self.strings[offset:offset+length], 'utf-8')
+
+    def runs(self) -> Iterator[SnapshotRun]:
+        groups = self.groups
+        for name_off, name_len, retry, weight, n_files, gid, leased_at in RUN.iter_unpack(
+                self.mm[self.off_runs:self.off_runs + self.n_runs * RUN.size]):
+            yield SnapshotRun(self.string(name_off, name_len), (retry, weight), n_files,
+                              groups[gid] if gid >= 0 else None, leased_at or None)
+
+    def close(self):
+        # memoryviews of the map must be released before it can be closed
+        self.strings = None
+        self.mm.close()
@@ -0,0 +1,398 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+# states of a run in the store
+QUEUED = 0
+LEASED = 1
+DONE = 2
+# run split into shards, done once all of its shards are done
+SHARDED = 3
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    name TEXT PRIMARY KEY,
+    state INTEGER NOT NULL,
+    n_files INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_state ON runs(state);
+CREATE TABLE IF NOT EXISTS files (
+    run TEXT NOT NULL,
+    path TEXT NOT NULL,
+    cksum TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_run ON files(run);
+CREATE TABLE IF NOT EXISTS leases (
+    run TEXT PRIMARY KEY,
+    leased_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS failures (
+    path TEXT NOT NULL,
+    cksum TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (path, cksum)
+);
+CREATE TABLE IF NOT EXISTS failure_reports (
+    failure INTEGER NOT NULL,
+    reported_at REAL NOT NULL,
+    client TEXT,
+    run TEXT
+);
+CREATE INDEX IF NOT EXISTS failure_reports_failure ON failure_reports(failure);
+CREATE TABLE IF NOT EXISTS inventory (
+    run TEXT PRIMARY KEY,
+    files INTEGER NOT NULL,
+    bytes INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS shards (
+    name TEXT PRIMARY KEY,
+    parent TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    stop INTEGER NOT NULL,
+    files INTEGER,
+    bytes INTEGER
+);
+CREATE INDEX IF NOT EXISTS shards_parent ON shards(parent);
+CREATE TABLE IF NOT EXISTS file_progress (
+    run TEXT NOT NULL,
+    path TEXT NOT NULL,
+    state INTEGER NOT NULL,
+    size INTEGER,
+    PRIMARY KEY (run, path)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+'''
+
+CONTENTS_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS contents (
+    cksum TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (cksum, size)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+'''
+
+
+class Database:
+    '''SQLite database in WAL mode shared by threads of the server'''
+    schema = ''
+
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False,
+                                    isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(self.schema)
+        self._lock = threading.RLock()
+        self._depth = 0
+
+    @contextmanager
+    def transaction(self):
+        '''Group several updates in one commit, nested calls join the outer one'''
+        with self._lock:
+            if self._depth == 0:
+                self.conn.execute('BEGIN')
+            self._depth += 1
+            try:
+                yield self.conn
+            except BaseException:
+                self._depth -= 1
+                if self._depth == 0:
+                    self.conn.execute('ROLLBACK')
+                raise
+            self._depth -= 1
+            if self._depth == 0:
+                self.conn.execute('COMMIT')
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+    def get_meta(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        with self._lock:
+            row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key: str, value):
+        with self.transaction() as conn:
+            conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, str(value)))
+
+
+class RunStore(Database):
+    '''Crash-safe server state kept in SQLite in WAL mode
+
+    Every state transition of a run is a small transaction, so the state on
+    disk is always consistent with what the server has handed out.
+    '''
+    schema = SCHEMA
+
+    def populated(self) -> bool:
+        return self.get_meta('populated') == '1'
+
+    def mark_populated(self):
+        '''The whole good run list is saved, restarts restore from the store instead of importing it'''
+        self.set_meta('populated', 1)
+
+    def add_runs(self, runs: Iterable[Tuple[str, Iterable[Tuple[str, str]]]], state: int = QUEUED,
+                 with_files: bool = True, batch: Optional[int] = None):
+        '''Insert (run, files) pairs, used for initial good run list import
+
+        Without `with_files` only run names are stored, for runs whose file
+        lists are kept elsewhere, e.g. in a manifest. With `batch` the runs are
+        committed every `batch` files, so other threads using the store wait
+        for a short transaction only. Call `mark_populated` once all
+        runs are added.
+        '''
+        runs = iter(runs)
+        while True:
+            n_rows = 0
+            with self.transaction():
+                for run, files in runs:
+                    self.add_run(run, files, state, with_files)
+                    n_rows += 1 + len(files)
+                    if batch and n_rows >= batch:
+                        break
+                else:
+                    return
+
+    def add_run(self, run: str, files: Iterable[Tuple[str, str]], state: int = QUEUED,
+                with_files: bool = True) -> bool:
+        '''Insert a run unless the store knows it already, its state and files are kept then'''
+        with self.transaction() as conn:
+            files = list(files) if with_files else files
+            added = conn.execute('INSERT OR IGNORE INTO runs (name, state, n_files) VALUES (?, ?, ?)',
+                                 (run, state, len(files))).rowcount
+            if added and with_files:
+                conn.executemany('INSERT INTO files (run, path, cksum) VALUES (?, ?, ?)',
+                                 ((run, path, cksum) for path, cksum in files))
+        return bool(added)
+
+    def add_shards(self, parent: str, shards: Iterable[Tuple[str, int, int]]):
+        '''Queue (name, start, stop) slices of the file list of `parent`, known shards are kept'''
+        with self.transaction() as conn:
+            for name, start, stop in shards:
+                conn.execute('INSERT OR IGNORE INTO runs (name, state, n_files) VALUES (?, ?, ?)',
+                             (name, QUEUED, stop - start))
+                conn.execute('INSERT OR IGNORE INTO shards (name, parent, start, stop) '
+                             'VALUES (?, ?, ?, ?)', (name, parent, start, stop))
+
+    def shard_bounds(self, name: str) -> Tuple[int, int]:
+        with self._lock:
+            return self.conn.execute('SELECT start, stop FROM shards WHERE name = ?',
+                                     (name,)).fetchone()
+
+    def record_shard(self, name: str, n_files: int, n_bytes: int):
+        with self.transaction() as conn:
+            conn.execute('UPDATE shards SET files = ?, bytes = ? WHERE name = ?',
+                         (n_files, n_bytes, name))
+
+    def pending_shards(self, parent: str) -> int:
+        '''Number of shards of `parent` that are not done yet'''
+        with self._lock:
+            row = self.conn.execute('SELECT count(*) FROM shards JOIN runs ON shards.name = runs.name '
+                                    'WHERE parent = ? AND state != ?', (parent, DONE)).fetchone()
+        return row[0]
+
+    def shard_totals(self, parent: str) -> Tuple[int, int]:
+        '''(files, bytes) reported by all shards of `parent`'''
+        with self._lock:
+            row = self.conn.execute('SELECT coalesce(sum(files), 0), coalesce(sum(bytes), 0) '
+                                    'FROM shards WHERE parent = ?', (parent,)).fetchone()
+        return row[0], row[1]
+
+    def record_progress(self, run: str, files: Iterable[Tuple[str, int, Optional[int]]]):
+        '''Save (path, state, size) of files of a run, files not recorded are pending'''
+        with self.transaction() as conn:
+            conn.executemany('INSERT OR REPLACE INTO file_progress (run, path, state, size) '
+                             'VALUES (?, ?, ?, ?)', ((run, path, state, size) for path, state, size in files))
+
+    def file_states(self, run: str) -> Dict[str, int]:
+        with self._lock:
+            rows = self.conn.execute('SELECT path, state FROM file_progress WHERE run = ?',
+                                     (run,)).fetchall()
+        return dict(rows)
+
+    def progress(self, run: str) -> Dict[int, Tuple[int, int]]:
+        '''(files, bytes) per recorded state of files of a run'''
+        with self._lock:
+            rows = self.conn.execute('SELECT state, count(*), coalesce(sum(size), 0) FROM file_progress '
+                                     'WHERE run = ? GROUP BY state', (run,)).fetchall()
+        return {state: (n_files, n_bytes) for state, n_files, n_bytes in rows}
+
+    def _set_state(self, run: str, state: int):
+        with self.transaction() as conn:
+            conn.execute('UPDATE runs SET state = ? WHERE name = ?', (state, run))
+            if state != LEASED:
+                conn.execute('DELETE FROM leases WHERE run = ?', (run,))
+
+    def lease(self, run: str, leased_at: datetime):
+        with self.transaction() as conn:
+            self._set_state(run, LEASED)
+            conn.execute('INSERT OR REPLACE INTO leases (run, leased_at) VALUES (?, ?)',
+                         (run, leased_at.timestamp()))
+
+    def requeue(self, run: str):
+        self._set_state(run, QUEUED)
+
+    def done(self, run: str):
+        self._set_state(run, DONE)
+
+    def record_failures(self, files: Iterable[Tuple[str, str]], run: Optional[str] = None,
+                        client: Optional[str] = None, reported_at: Optional[float] = None,
+                        history: Optional[int] = None):
+        '''Count a failure of every file, the report refers to the failures row instead of the path
+
+        Only the last `history` reports of a file are kept, older ones are deleted.
+        '''
+        reported_at = reported_at or datetime.now().timestamp()
+        with self.transaction() as conn:
+            for path, cksum in files:
+                failure, count = conn.execute('INSERT INTO failures (path, cksum, count) VALUES (?, ?, 1) '
+                                              'ON CONFLICT (path, cksum) DO UPDATE SET count = count + 1 '
+                                              'RETURNING rowid, count', (path, cksum)).fetchone()
+                conn.execute('INSERT INTO failure_reports (failure, reported_at, client, run) '
+                             'VALUES (?, ?, ?, ?)', (failure, reported_at, client, run))
+                if history is not None and count > history:
+                    conn.execute('DELETE FROM failure_reports WHERE failure = ? AND rowid NOT IN '
+                                 '(SELECT rowid FROM failure_reports WHERE failure = ? '
+                                 'ORDER BY rowid DESC LIMIT ?)', (failure, failure, history))
+
+    def failures(self) -> Dict[Tuple[str, str], int]:
+        with self._lock:
+            rows = self.conn.execute('SELECT path, cksum, count FROM failures').fetchall()
+        return {(path, cksum): count for path, cksum, count in rows}
+
+    def failure_reports(self, history: Optional[int] = None
+                        ) -> List[Tuple[str, str, float, Optional[str], Optional[str]]]:
+        '''(path, cksum, reported_at, client, run) of the last `history` reports of every file, oldest first'''
+        with self._lock:
+            if history is None:
+                return self.conn.execute('SELECT f.path, f.cksum, r.reported_at, r.client, r.run '
+                                         'FROM failure_reports r JOIN failures f ON f.rowid = r.failure '
+                                         'ORDER BY r.rowid').fetchall()
+            return self.conn.execute('SELECT f.path, f.cksum, r.reported_at, r.client, r.run FROM '
+                                     '(SELECT rowid, failure, reported_at, client, run, row_number() OVER '
+                                     '(PARTITION BY failure ORDER BY rowid DESC) AS age '
+                                     'FROM failure_reports) r JOIN failures f ON f.rowid = r.failure '
+                                     'WHERE r.age <= ? ORDER BY r.rowid', (history,)).fetchall()
+
+    def record_inventory(self, run: str, n_files: int, n_bytes: int):
+        with self.transaction() as conn:
+            conn.execute('INSERT OR REPLACE INTO inventory (run, files, bytes) VALUES (?, ?, ?)',
+                         (run, n_files, n_bytes))
+
+    def replace_inventory(self, per_run: Dict[str, Tuple[int, int]]):
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM inventory')
+            conn.executemany('INSERT INTO inventory (run, files, bytes) VALUES (?, ?, ?)',
+                             ((run, n_files, n_bytes) for run, (n_files, n_bytes) in per_run.items()))
+
+    def inventory(self) -> Dict[str, Tuple[int, int]]:
+        with self._lock:
+            rows = self.conn.execute('SELECT run, files, bytes FROM inventory').fetchall()
+        return {run: (n_files, n_bytes) for run, n_files, n_bytes in rows}
+
+    def files(self, run: str) -> List[Tuple[str, str]]:
+        with self._lock:
+            return self.conn.execute('SELECT path, cksum FROM files WHERE run = ? ORDER BY rowid',
+                                     (run,)).fetchall()
+
+    def states(self, runs: Iterable[str]) -> Dict[str, int]:
+        '''run -> state of those of `runs` the store knows'''
+        runs = list(runs)
+        found: Dict[str, int] = dict()
+        with self._lock:
+            for i in range(0, len(runs), 500):
+                batch = runs[i:i + 500]
+                found.update(self.conn.execute('SELECT name, state FROM runs WHERE name IN '
+                                               f'({",".join("?" * len(batch))})', batch).fetchall())
+        return found
+
+    def state(self, run: str) -> Optional[int]:
+        with self._lock:
+            row = self.conn.execute('SELECT state FROM runs WHERE name = ?', (run,)).fetchone()
+        return row[0] if row else None
+
+    def n_files(self, run: str) -> int:
+        with self._lock:
+            row = self.conn.execute('SELECT n_files FROM runs WHERE name = ?', (run,)).fetchone()
+        return row[0] if row else 0
+
+    def runs(self, state: int) -> Iterator[str]:
+        '''Names of runs in given state, in insertion order'''
+        with self._lock:
+            rows = self.conn.execute('SELECT name FROM runs WHERE state = ? ORDER BY rowid',
+                                     (state,)).fetchall()
+        return (name for name, in rows)
+
+    def run_counts(self, state: int) -> List[Tuple[str, int]]:
+        '''(name, number of files) of runs in given state, in insertion order'''
+        with self._lock:
+            return self.conn.execute('SELECT name, n_files FROM runs WHERE state = ? ORDER BY rowid',
+                                     (state,)).fetchall()
+
+    def leases(self) -> Dict[str, datetime]:
+        with self._lock:
+            rows = self.conn.execute('SELECT run, leased_at FROM leases').fetchall()
+        return {run: datetime.fromtimestamp(leased_at) for run, leased_at in rows}
+
+
+class ContentIndex(Database):
+    '''Adler-32 checksums and sizes of files verified in EOS
+
+    Kept apart from the run store, so contents copied for earlier good run
+    lists are still found when a new one starts with an empty `state_db`.
+    '''
+    schema = CONTENTS_SCHEMA
+
+    def add(self, entries: Iterable[Tuple[str, int, str]]):
+        '''Index (cksum, size, path) of files verified in EOS, the first path of a content is kept'''
+        with self.transaction() as conn:
+            conn.executemany('INSERT OR IGNORE INTO contents (cksum, size, path) VALUES (?, ?, ?)', entries)
+
+    def find(self, cksums: Iterable[str]) -> Dict[str, List[Tuple[int, str]]]:
+        '''cksum -> [(size, path)] of indexed files with any of `cksums`'''
+        cksums = list(set(cksums))
+        found: Dict[str, List[Tuple[int, str]]] = dict()
+        with self._lock:
+            # stay below the limit of SQLite host parameters
+            for i in range(0, len(cksums), 500):
+                batch = cksums[i:i + 500]
+                rows = self.conn.execute('SELECT cksum, size, path FROM contents WHERE cksum IN '
+                                         f'({",".join("?" * len(batch))})', batch).fetchall()
+                for cksum, size, path in rows:
+                    found.setdefault(cksum, []).append((size, path))
+        return found
+
+    def __len__(self):
+        with self._lock:
+            return self.conn.execute('SELECT count(*) FROM contents').fetchone()[0]
+
+
+class StoredRun:
+    '''File list of a run that is read from the store only when needed'''
+    __slots__ = ('store', 'run', 'n_files')
+
+    def __init__(self, store: RunStore, run: str, n_files: Optional[int] = None):
+        self.store = store
+        self.run = run
+        # known when runs are restored in bulk, saves a query per run
+        self.n_files = n_files
+
+    def __iter__(self):
+        return iter(self.store.files(self.run))
+
+    def __len__(self):
+        if self.n_files is None:
+            return self.store.n_files(self.run)
+        return self.n_files
@@ -0,0 +1,152 @@
+import re
+import threading
+from typing import Dict, Iterable, List, Optional
+
+from loguru import logger
+
+# "Total bytes received: 1,234,567" of rsync run with --no-human-readable in the C locale,
+# rounded -h values and other separators do not match
+STATS_LINE = re.compile(r'^(Total transferred file size|Total bytes sent|Total bytes received)'
+                        r':\s+(\d[\d,]*)(?: bytes)?$')
+STATS_KEYS = {'Total transferred file size': 'transferred',
+              'Total bytes sent': 'sent',
+              'Total bytes received': 'received'}
+
+# runs moving less data are dominated by connection setup, they say nothing about bandwidth
+DEFAULT_MIN_SAMPLE_BYTES = 256 * 1024 * 1024
+
+
+def parse_stats(lines: Iterable[str]) -> Dict[str, int]:
+    '''Byte counters of rsync --stats output'''
+    stats = dict()
+    for line in lines:
+        match = STATS_LINE.match(line.strip())
+        if match:
+            name, number = match.groups()
+            stats[STATS_KEYS[name]] = int(number.replace(',', ''))
+    return stats
+
+
+class RsyncTuner:
+    '''Adjusts rsync options of a client from throughput achieved by finished runs
+
+    - compression (-z) is dropped when it does not shrink the data, e.g. for
+      ROOT files, and probed again every `probe_every` runs;
+    - the number of rsync streams per run is hill-climbed within
+      [min_streams, max_streams] towards higher throughput, and all runs of
+      the client together use at most `host_streams` streams;
+    - `bwlimit` in KiB/s is the limit of the whole client, split between the
+      streams running at the moment.
+    '''
+    def __init__(self, min_streams: int = 1, max_streams: int = 4, host_streams: Optional[int] = None,
+                 bwlimit: Optional[int] = None, compress: bool = True, min_compress_ratio: float = 1.05,
+                 probe_every: int = 20, tolerance: float = 0.05,
+                 min_sample_bytes: int = DEFAULT_MIN_SAMPLE_BYTES):
+        self.min_streams = max(1, min_streams)
+        self.max_streams = max(self.min_streams, max_streams)
+        self.host_streams = host_streams
+        self.bwlimit = bwlimit
+        self.compress = compress
+        self.min_compress_ratio = min_compress_ratio
+        self.probe_every = probe_every
+        self.tolerance = tolerance
+        self.min_sample_bytes = min_sample_bytes
+
+        self.streams = self.min_streams
+        self.active = 0
+        self.throughput: Optional[float] = None
+        self.compress_ratio: Optional[float] = None
+        self._direction = 1
+        self._last_throughput: Optional[float] = None
+        self._runs_without_compression = 0
+        self._probing = False
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config) -> 'RsyncTuner':
+        return cls(min_streams=int(config.get('tuning_min_streams', 1)),
+                   max_streams=int(config.get('tuning_max_streams', 4)),
+                   host_streams=config.get('tuning_host_streams'),
+                   bwlimit=config.get('bwlimit'),
+                   compress=bool(config.get('compress', True)),
+                   min_compress_ratio=float(config.get('tuning_min_compress_ratio', 1.05)),
+                   probe_every=int(config.get('tuning_probe_every', 20)))
+
+    def acquire(self, n_files: int) -> int:
+        '''Number of streams for the next run, to be given back with `release`'''
+        with self.lock:
+            n_streams = min(self.streams, n_files) or 1
+            if self.host_streams:
+                n_streams = max(1, min(n_streams, int(self.host_streams) - self.active))
+            self.active += n_streams
+            if not self.compress and self._runs_without_compression >= self.probe_every:
+                self._probing = True
+                self._runs_without_compression = 0
+            return n_streams
+
+    def release(self, n_streams: int):
+        with self.lock:
+            self.active -= n_streams
+
+    def options(self) -> str:
+        '''rsync options for a stream starting now'''
+        with self.lock:
+            # exact byte counts, the commands also pass -h for people reading logs
+            options = ['--stats', '--no-human-readable']
+            if self.compress or self._probing:
+                options.append('-z')
+            if self.bwlimit:
+                options.append(f'--bwlimit={max(1, int(self.bwlimit) // max(1, self.active))}')
+            return ' '.join(options)
+
+    def observe(self, run: str, stats: List[Dict[str, int]], seconds: float, n_streams: int):
+        '''Account rsync --stats of all streams of a finished run copied in `seconds`'''
+        transferred = sum(s.get('transferred', 0) for s in stats)
+        received = sum(s.get('received', 0) for s in stats)
+        if not transferred or seconds <= 0:
+            return
+        with self.lock:
+            compressed = self.compress or self._probing
+            if compressed and received:
+                self.compress_ratio = transferred / received
+                self._tune_compression(run)
+            elif not compressed:
+                self._runs_without_compression += 1
+            if transferred >= self.min_sample_bytes:
+                self.throughput = transferred / seconds
+                self._tune_streams(run, n_streams)
+
+    def _tune_compression(self, run: str):
+        enable = self.compress_ratio >= self.min_compress_ratio
+        if enable != self.compress:
+            logger.info(f'Tuning: compression ratio {self.compress_ratio:.2f} in {run}, '
+                        f'{"enabling" if enable else "disabling"} rsync compression')
+        self.compress = enable
+        self._probing = False
+
+    def _tune_streams(self, run: str, n_streams: int):
+        last = self._last_throughput
+        self._last_throughput = self.throughput
+        if last is not None:
+            if self.throughput < last * (1 - self.tolerance):
+                # the last step made it worse, go back
+                self._direction = -self._direction
+            elif self.throughput <= last * (1 + self.tolerance):
+                return
+        streams = min(self.max_streams, max(self.min_streams, n_streams + self._direction))
+        if streams == n_streams:
+            # hit a bound, look the other way next time
+            self._direction = -self._direction
+        if streams != self.streams:
+            logger.info(f'Tuning: {self.throughput / 1024**2:.1f} MiB/s with {n_streams} streams in {run}, '
+                        f'using {streams} streams per run')
+        self.streams = streams
+
+    def state(self) -> Dict[str, float]:
+        with self.lock:
+            return {'streams': self.streams,
+                    'active_streams': self.active,
+                    'compress': int(self.compress),
+                    'compress_ratio': self.compress_ratio or 0,
+                    'throughput_bytes': self.throughput or 0,
+                    'bwlimit_kib': int(self.bwlimit or 0)}
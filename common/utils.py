@@ -1,16 +1,111 @@
-from collections import Counter
-from typing import Set
-
-class FailedFiles(Counter): 
-    def __init__(self, *args, spurious_treshold=4, **kwargs): 
-        self.spurious_files: Set[str] = set() 
-        self.integrity_failed_counter: int = 0 
-        self.spurious_treshold: int = spurious_treshold 
- 
-        super().__init__(*args, **kwargs) 
- 
-    def update(self, *args, **mapping): 
-        super().update(*args, **mapping) 
-        for key, count in self.items(): 
-            if count > self.spurious_treshold: 
-                self.spurious_files.add(key) 
+import time
+from collections import deque
+from datetime import datetime
+from itertools import islice
+from typing import Deque, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+# (path, cksum) as reported by clients in ClientMessage.failed_files
+FailedFile = Tuple[str, str]
+
+
+class FailureReport(NamedTuple):
+    reported_at: float
+    client: Optional[str]
+    run: Optional[str]
+
+
+class FailureRecord:
+    __slots__ = ('count', 'first_reported', 'reports')
+
+    def __init__(self, history_limit: int):
+        self.count = 0
+        self.first_reported: Optional[float] = None
+        # only the latest reports, the count keeps all of them
+        self.reports: Deque[FailureReport] = deque(maxlen=history_limit)
+
+
+class FailedFiles:
+    '''Checksum failures per file and files reported too often to be resubmitted
+
+    A file becomes spurious once it is reported more than `spurious_treshold`
+    times. Counts only grow, so a report of k files checks only those k files
+    for crossing the threshold, and spurious files are kept in the order they
+    crossed it for paging.
+    '''
+    def __init__(self, spurious_treshold: int = 4, history_limit: int = 10):
+        self.spurious_treshold = spurious_treshold
+        self.history_limit = history_limit
+        self.records: Dict[FailedFile, FailureRecord] = dict()
+        self.spurious_files: Set[FailedFile] = set()
+        self._spurious_order: List[FailedFile] = []
+        self.integrity_failed_counter: int = 0
+
+    def report(self, files: Iterable[FailedFile], run: Optional[str] = None, client: Optional[str] = None,
+               reported_at: Optional[float] = None) -> List[FailedFile]:
+        '''Account one failure of every file, returns files that became spurious with it'''
+        report = FailureReport(reported_at or time.time(), client, run)
+        crossed = []
+        for key in files:
+            key = tuple(key)
+            record = self._record(key)
+            record.count += 1
+            self._add_report(record, report)
+            if self._check(key, record):
+                crossed.append(key)
+        return crossed
+
+    def restore(self, counts: Dict[FailedFile, int],
+                reports: Iterable[Tuple[str, str, float, Optional[str], Optional[str]]]):
+        '''Load counts and (path, cksum, reported_at, client, run) history saved by the store'''
+        for key, count in counts.items():
+            self._record(key).count = count
+        for path, cksum, reported_at, client, run in reports:
+            self._add_report(self._record((path, cksum)), FailureReport(reported_at, client, run))
+        for key, record in self.records.items():
+            self._check(key, record)
+
+    def _record(self, key: FailedFile) -> FailureRecord:
+        record = self.records.get(key)
+        if record is None:
+            record = self.records[key] = FailureRecord(self.history_limit)
+        return record
+
+    @staticmethod
+    def _add_report(record: FailureRecord, report: FailureReport):
+        if record.first_reported is None:
+            record.first_reported = report.reported_at
+        record.reports.append(report)
+
+    def _check(self, key: FailedFile, record: FailureRecord) -> bool:
+        if record.count > self.spurious_treshold and key not in self.spurious_files:
+            self.spurious_files.add(key)
+            self._spurious_order.append(key)
+            return True
+        return False
+
+    def page(self, offset: int, limit: int, spurious_only: bool = True) -> List[FailedFile]:
+        '''Files in the order they became spurious or, for all failed files, were first reported'''
+        if spurious_only:
+            return self._spurious_order[offset:offset + limit]
+        return list(islice(self.records, offset, offset + limit))
+
+    def describe(self, key: FailedFile, history: bool = False) -> Dict[str, object]:
+        record = self.records[key]
+        info = {'path': key[0], 'cksum': key[1], 'count': record.count,
+                'spurious': key in self.spurious_files,
+                'first_reported': _datetime(record.first_reported),
+                'last_reported': _datetime(record.reports[-1].reported_at) if record.reports else None}
+        if history:
+            info['history'] = [{'reported_at': _datetime(report.reported_at), 'client': report.client,
+                                'run': report.run} for report in record.reports]
+        return info
+
+    def __contains__(self, key: FailedFile) -> bool:
+        return key in self.records
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+
+def _datetime(timestamp: Optional[float]) -> Optional[datetime]:
+    return datetime.fromtimestamp(timestamp) if timestamp is not None else None
@@ -0,0 +1,202 @@
+'''Compact encoding of run leases and finalize reports
+
+Same documents as the JSON API, but lists of (path, cksum) pairs under
+FILE_KEYS are taken out of the JSON and stored as binary blocks: paths are
+front-coded against the previous path, so the directory prefix shared by the
+files of a run is stored once, and Adler-32 checksums are packed into 4
+bytes. The whole payload is then deflated.
+
+    MAGIC | codec | body
+    body  = varint(len(header)) header {varint(len(block)) block}
+    block = varint(n) flags varint(len(suffixes)) shared*n suffixes cksums
+
+with `shared` the length of the prefix taken from the previous path as
+uint16, path suffixes and unpacked checksums joined by newlines.
+
+where the header is the JSON document with file lists replaced by
+{"$files": index of the block}.
+'''
+import json
+import zlib
+import struct
+from typing import Any, List, Sequence, Tuple
+
+MEDIA_TYPE = 'application/x-warden-compact'
+MAGIC = b'WRD1'
+RAW, DEFLATE = 0, 1
+DEFAULT_LEVEL = 1
+# keys of documents holding (path, cksum) lists
+FILE_KEYS = ('files', 'failed_files')
+PLACEHOLDER = '$files'
+# checksums are packed only when they are 8 lowercase hex digits
+PACKED_CKSUMS = 1
+MAX_SHARED = 0xffff
+
+
+class WireError(ValueError):
+    pass
+
+
+def _write_varint(out: bytearray, value: int):
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data: memoryview, pos: int) -> Tuple[int, int]:
+    value = shift = 0
+    while True:
+        try:
+            byte = data[pos]
+        except IndexError:
+            raise WireError('Truncated payload') from None
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def _packable(cksums: Sequence[str]) -> bool:
+    try:
+        return all(len(cksum) == 8 and f'{int(cksum, 16):08x}' == cksum for cksum in cksums)
+    except ValueError:
+        return False
+
+
+def _shared_prefix(previous: str, path: str) -> int:
+    # files of a run mostly share their directory
+    directory = path.rpartition('/')[0]
+    if directory and previous.startswith(directory + '/'):
+        return len(directory) + 1
+    shared, limit = 0, min(len(previous), len(path))
+    while shared < limit and previous[shared] == path[shared]:
+        shared += 1
+    return shared
+
+
+def encode_files(files: Sequence[Tuple[str, str]]) -> bytes:
+    out = bytearray()
+    cksums = [cksum for _, cksum in files]
+    packed = _packable(cksums)
+    shared, suffixes, previous = [], [], ''
+    for path, _ in files:
+        n_shared = min(_shared_prefix(previous, path), MAX_SHARED)
+        shared.append(n_shared)
+        suffixes.append(path[n_shared:])
+        previous = path
+    # paths come from line-based good run lists, they never hold a newline
+    suffix_bytes = '\n'.join(suffixes).encode('utf-8')
+    _write_varint(out, len(files))
+    out.append(PACKED_CKSUMS if packed else 0)
+    _write_varint(out, len(suffix_bytes))
+    out += struct.pack(f'>{len(shared)}H', *shared)
+    out += suffix_bytes
+    if packed:
+        out += struct.pack(f'>{len(cksums)}I', *(int(cksum, 16) for cksum in cksums))
+    else:
+        out += '\n'.join(cksums).encode('utf-8')
+    return bytes(out)
+
+
+def decode_files(block: bytes) -> List[Tuple[str, str]]:
+    data = memoryview(block)
+    n, pos = _read_varint(data, 0)
+    if not n:
+        return []
+    try:
+        flags = data[pos]
+        suffix_length, pos = _read_varint(data, pos + 1)
+        shared = struct.unpack_from(f'>{n}H', data, pos)
+        pos += 2 * n
+        suffixes = bytes(data[pos:pos + suffix_length]).decode('utf-8').split('\n')
+        pos += suffix_length
+        if flags & PACKED_CKSUMS:
+            cksums = [f'{value:08x}' for value in struct.unpack_from(f'>{n}I', data, pos)]
+        else:
+            cksums = bytes(data[pos:]).decode('utf-8').split('\n')
+    except (IndexError, struct.error, UnicodeDecodeError):
+        raise WireError('Truncated file list') from None
+    if len(suffixes) != n or len(cksums) != n:
+        raise WireError('Truncated file list')
+    paths, previous = [], ''
+    for n_shared, suffix in zip(shared, suffixes):
+        previous = previous[:n_shared] + suffix
+        paths.append(previous)
+    return list(zip(paths, cksums))
+
+
+def _extract(document: Any, blocks: List[bytes]) -> Any:
+    '''Copy of `document` with file lists replaced by placeholders of their blocks'''
+    if isinstance(document, dict):
+        result = dict()
+        for key, value in document.items():
+            if key in FILE_KEYS and isinstance(value, (list, tuple)):
+                blocks.append(encode_files(value))
+                result[key] = {PLACEHOLDER: len(blocks) - 1}
+            else:
+                result[key] = _extract(value, blocks)
+        return result
+    if isinstance(document, (list, tuple)):
+        return [_extract(value, blocks) for value in document]
+    return document
+
+
+def _restore(document: Any, blocks: List[bytes]) -> Any:
+    if isinstance(document, dict):
+        if len(document) == 1 and PLACEHOLDER in document:
+            try:
+                return decode_files(blocks[document[PLACEHOLDER]])
+            except (IndexError, TypeError):
+                raise WireError(f'No file list block {document[PLACEHOLDER]}') from None
+        return {key: _restore(value, blocks) for key, value in document.items()}
+    if isinstance(document, list):
+        return [_restore(value, blocks) for value in document]
+    return document
+
+
+def dumps(document: Any, level: int = DEFAULT_LEVEL) -> bytes:
+    '''Encode a JSON-compatible document, `level` 0 disables compression'''
+    blocks: List[bytes] = []
+    header = json.dumps(_extract(document, blocks), separators=(',', ':')).encode('utf-8')
+    body = bytearray()
+    for part in (header, *blocks):
+        _write_varint(body, len(part))
+        body += part
+    if level:
+        return MAGIC + bytes([DEFLATE]) + zlib.compress(bytes(body), level)
+    return MAGIC + bytes([RAW]) + bytes(body)
+
+
+def loads(payload: bytes) -> Any:
+    '''Decode a payload of `dumps`, file lists come back as lists of (path, cksum) tuples'''
+    if payload[:len(MAGIC)] != MAGIC or len(payload) <= len(MAGIC):
+        raise WireError('Not a compact wire payload')
+    codec = payload[len(MAGIC)]
+    body = payload[len(MAGIC) + 1:]
+    if codec == DEFLATE:
+        try:
+            body = zlib.decompress(body)
+        except zlib.error as e:
+            raise WireError(f'Corrupted payload: {e}') from None
+    elif codec != RAW:
+        raise WireError(f'Unknown codec {codec}')
+    data = memoryview(body)
+    parts, pos = [], 0
+    while pos < len(data):
+        length, pos = _read_varint(data, pos)
+        parts.append(bytes(data[pos:pos + length]))
+        pos += length
+    if not parts:
+        raise WireError('Empty payload')
+    try:
+        header = json.loads(parts[0])
+    except ValueError as e:
+        raise WireError(f'Corrupted header: {e}') from None
+    return _restore(header, parts[1:])
+
+
+def accepts(accept: str) -> bool:
+    '''Whether an Accept header asks for the compact encoding'''
+    return MEDIA_TYPE in (accept or '')
@@ -1,5 +1,9 @@
 from __future__ import print_function
 import os
+import glob
+import math
+import heapq
+import sqlite3
 import argparse
 
 try:
@@ -9,10 +13,69 @@ except ImportError:
 
 DYB_LUSTRE_P17B = "/dybfs/rec/P17B/rec/"
 
+
+class DoneIndex:
+    """SQLite index of files that already have a checksum in job outputs
+
+    Outputs are only appended to, so each of them is read from the offset
+    where the previous resubmit stopped. Size and mtime of a file are taken
+    when its checksum is indexed, a file that changed since is not done.
+    """
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS done "
+                        "(path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, cksum TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS outputs "
+                        "(name TEXT PRIMARY KEY, offset INTEGER)")
+
+    def update(self, outputs):
+        """Index checksum lines appended to `outputs` since the last update"""
+        n_new = 0
+        for output in outputs:
+            row = self.db.execute("SELECT offset FROM outputs WHERE name = ?", (output,)).fetchone()
+            offset = row[0] if row else 0
+            if offset > os.path.getsize(output):
+                # output was recreated, read it again
+                offset = 0
+            with open(output, 'r') as f:
+                f.seek(offset)
+                data = f.read()
+            # a job may be killed in the middle of a line, keep it for later
+            end = data.rfind('\n') + 1
+            rows = []
+            for line in data[:end].splitlines():
+                tokens = line.split()
+                if len(tokens) != 2:
+                    continue
+                cksum, path = tokens
+                size, mtime = file_stat(path)
+                if size is not None:
+                    rows.append((path, size, mtime, cksum))
+            with self.db:
+                self.db.executemany("INSERT OR REPLACE INTO done VALUES (?, ?, ?, ?)", rows)
+                self.db.execute("INSERT OR REPLACE INTO outputs VALUES (?, ?)",
+                                (output, offset + len(data[:end])))
+            n_new += len(rows)
+        return n_new
+
+    def is_done(self, path, size, mtime):
+        row = self.db.execute("SELECT size, mtime FROM done WHERE path = ?", (path,)).fetchone()
+        return row is not None and tuple(row) == (size, mtime)
+
+    def close(self):
+        self.db.close()
+
 class CondorSubmitter:
-    def __init__(self, chunks, output_base):
+    def __init__(self, chunks, output_base, balance_bytes=False, size_column=None,
+                 target_walltime=3600, throughput=100, parallel=1, index=None):
         self.chunks = chunks
         self.output_base = output_base
+        self.balance_bytes = balance_bytes
+        self.size_column = size_column
+        self.target_walltime = target_walltime
+        self.throughput = throughput
+        self.parallel = parallel
+        self.index = index
 
     def submit_htcondor_jobs(self, run_file):
         output_path = os.getcwd()+"/condor"
@@ -28,44 +91,168 @@ class CondorSubmitter:
         with open(run_file, 'r') as f:
             print("Reading input files")
             files = list(f.readlines())
-            it = iter(files)
-            chunks = []
-            while True:
-                chunks.append([])
-                print("Creating next chunk: {}".format(len(chunks)))
-                try:
-                    for _ in range(self.chunks):
-                        chunks[-1].append(next(it))
-                except StopIteration:
-                    print("Prepared chunks")
-                    break
-                
-            for i, pathes in enumerate(chunks):
-                print("processing {} job".format(i))
-                #arguments = DYB_LUSTRE_P17B + runs
-                # arguments = DYB_LUSTRE_P17B + runs + '*.root'
-                #thousands, hundreds, dozens, _ = [_.lstrip("runs_") for _  in runs.split('/')]
-                output = output_path + "/"+self.output_base.format(i)
-                job = job_path +"/job_{}.sh".format(i)
-                script_begin = '#!/bin/bash\n'
-                script_body="xrdadler32 {} >> {}\n"
-                with open(job, 'w') as j:
-                    j.write(script_begin)
-                    for path in pathes:
-                        path = path.rstrip('\n')
-                        j.write(script_body.format(path, output))
-                os.chmod(job, 0o755)
-
-    
+
+        if self.index:
+            files = self.pending_files(files, output_path)
+            if not files:
+                print("All files have checksums, nothing to submit")
+                return
+
+        if self.balance_bytes:
+            chunks = self.chunks_by_bytes(files)
+        else:
+            chunks = self.chunks_by_count(files)
+
+        # jobs of a previous submission with more jobs would be picked up again
+        stale = glob.glob(job_path + "/job_*.sh")
+        for job in stale:
+            os.remove(job)
+        if stale:
+            print("Removed {} job scripts of the previous submission".format(len(stale)))
+
+        outputs = self.free_outputs(output_path)
+        for i, pathes in enumerate(chunks):
+            print("processing {} job".format(i))
+            #arguments = DYB_LUSTRE_P17B + runs
+            # arguments = DYB_LUSTRE_P17B + runs + '*.root'
+            #thousands, hundreds, dozens, _ = [_.lstrip("runs_") for _  in runs.split('/')]
+            output = next(outputs)
+            job = job_path +"/job_{}.sh".format(i)
+            with open(job, 'w') as j:
+                j.write(self.job_script(pathes, output))
+            os.chmod(job, 0o755)
+
+    def free_outputs(self, output_path):
+        """Output paths not used yet, so a resubmit never appends to outputs of earlier jobs"""
+        n = 0
+        while True:
+            output = output_path + "/" + self.output_base.format(n)
+            n += 1
+            if not os.path.exists(output):
+                yield output
+
+    def pending_files(self, files, output_path):
+        """Files without a checksum in outputs of previous submissions or changed since"""
+        index = DoneIndex(self.index)
+        try:
+            outputs = glob.glob(output_path + "/" + self.output_base.format('*'))
+            print("Indexed {} new checksums from {} outputs".format(index.update(outputs), len(outputs)))
+            pending = []
+            for line in files:
+                path = line.split()[0]
+                if not index.is_done(path, *file_stat(path)):
+                    pending.append(line)
+        finally:
+            index.close()
+        print("{} of {} files need checksums".format(len(pending), len(files)))
+        return pending
+
+    def chunks_by_count(self, files):
+        it = iter(files)
+        chunks = []
+        while True:
+            chunks.append([])
+            print("Creating next chunk: {}".format(len(chunks)))
+            try:
+                for _ in range(self.chunks):
+                    chunks[-1].append(next(it))
+            except StopIteration:
+                print("Prepared chunks")
+                break
+        return chunks
+
+    def chunks_by_bytes(self, files):
+        """Pack files into jobs of about equal total size
+
+        Number of jobs is chosen so a job fits into the target wall time at
+        the given throughput. Files are placed largest first into the least
+        loaded job (LPT), so no job is left with a tail of huge files.
+        """
+        entries = [file_size(line, self.size_column) for line in files]
+        total = sum(size for _, size in entries)
+        job_bytes = self.throughput * 1e6 * self.target_walltime
+        n_jobs = max(1, min(len(entries), int(math.ceil(total / job_bytes))))
+        print("Packing {} files, {:.1f} GB into {} jobs".format(len(entries), total / 1e9, n_jobs))
+
+        loads = [(0, i) for i in range(n_jobs)]
+        chunks = [[] for _ in range(n_jobs)]
+        for path, size in sorted(entries, key=lambda entry: entry[1], reverse=True):
+            load, i = heapq.heappop(loads)
+            chunks[i].append(path)
+            heapq.heappush(loads, (load + size, i))
+
+        largest = max(load for load, _ in loads)
+        print("Largest job has {:.1f} GB, expected wall time {:.0f} s".format(
+            largest / 1e9, largest / (self.throughput * 1e6)))
+        return [chunk for chunk in chunks if chunk]
+
+    def job_script(self, pathes, output):
+        script = '#!/bin/bash\n'
+        if self.parallel > 1:
+            # xargs runs several xrdadler32 at once, all appending to output;
+            # each of them writes a single short line
+            script += "xargs -d '\\n' -n 1 -P {} xrdadler32 >> {} <<'EOF'\n".format(self.parallel, output)
+            for path in pathes:
+                script += path.rstrip('\n') + '\n'
+            return script + 'EOF\n'
+        script_body = "xrdadler32 {} >> {}\n"
+        for path in pathes:
+            path = path.rstrip('\n')
+            script += script_body.format(path, output)
+        return script
+
+
+def file_size(line, size_column=None):
+    """(path, size) of an input line, size is read from a column or stat'ed"""
+    tokens = line.split()
+    path = tokens[0]
+    if size_column is not None:
+        return path, int(tokens[size_column])
+    try:
+        return path, os.stat(path).st_size
+    except OSError as e:
+        print("Can not stat {}: {}".format(path, e))
+        return path, 0
+
+
+def file_stat(path):
+    """(size, mtime) of a file, (None, None) if it is not accessible"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None, None
+    return st.st_size, int(st.st_mtime)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('input_file', type=os.path.abspath,
         help='Path to file with run unique run number ids')
     parser.add_argument("-cs", "--chunk-size", type=int, default=50, help="Number of files per job")
     parser.add_argument("-o", "--output-base", required=True, help="Basename for naming output files")
+    parser.add_argument("--balance-bytes", action="store_true",
+        help="Pack files into jobs by total size instead of a fixed number of files")
+    parser.add_argument("--size-column", type=int,
+        help="Column of input file with file sizes, files are stat'ed if not set")
+    parser.add_argument("--target-walltime", type=float, default=3600,
+        help="Wall time of a job in seconds with --balance-bytes")
+    parser.add_argument("--throughput", type=float, default=100,
+        help="Checksum throughput of a job in MB/s with --balance-bytes")
+    parser.add_argument("-p", "--parallel", type=int, default=1,
+        help="Number of xrdadler32 running in parallel in a job")
+    parser.add_argument("--incremental", action="store_true",
+        help="Create jobs only for files without checksums in existing outputs or changed since")
+    parser.add_argument("--index", type=os.path.abspath, default="done_index.sqlite",
+        help="Index of files with checksums used by --incremental")
     args = parser.parse_args()
 
     submitter = CondorSubmitter(chunks=args.chunk_size,
-                                output_base=args.output_base
+                                output_base=args.output_base,
+                                balance_bytes=args.balance_bytes,
+                                size_column=args.size_column,
+                                target_walltime=args.target_walltime,
+                                throughput=args.throughput,
+                                parallel=args.parallel,
+                                index=args.index if args.incremental else None
                                 )
     submitter.submit_htcondor_jobs(args.input_file)
@@ -2,15 +2,23 @@
 from __future__ import print_function
 
 import os
-from os.path import abspath
+import sys
+from os.path import abspath, dirname
 import glob
+import heapq
+import shutil
+import tempfile
 import argparse
+from multiprocessing import Pool
+
+# manifest format is shared with the server
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
 
 
 def merge_checksums(args):
     checksums_pathes = set()
     checksums_full = set()
-    old, new = args.substitute_path
+    old, new = args.substitute_path or ('', '')
     for  csum_file in glob.glob(args.checksums+'/checksums*'):
         with open(csum_file, 'r') as f:
             for line in f:
@@ -41,6 +49,142 @@ def merge_checksums(args):
                     path = path.replace(old, new) 
                     f.write(f'{path} {cksum}\n')
 
+    if args.manifest:
+        write_goodrun_manifest(args)
+
+
+def write_goodrun_manifest(args):
+    '''Binary manifest of good run checksums for the server to memory-map'''
+    from common.manifest import write_manifest
+    with open(args.goodrun_checksums, 'r') as f:
+        invalid = write_manifest(args.manifest, f, args.groupby_idx, source=args.goodrun_checksums)
+    if invalid:
+        print('Skipped {} malformed lines, e.g. {}'.format(len(invalid), invalid[:3]))
+    print('Manifest of {} is saved to {}'.format(args.goodrun_checksums, args.manifest))
+
+
+def _write_sorted_chunk(lines, tmp_dir):
+    lines.sort()
+    fd, path = tempfile.mkstemp(prefix='chunk_', dir=tmp_dir, text=True)
+    with os.fdopen(fd, 'w') as f:
+        f.writelines(lines)
+    return path
+
+
+def _split_sorted(path, tmp_dir, chunk_lines, to_record):
+    '''Split file into sorted chunk files of at most `chunk_lines` records'''
+    chunks, lines = [], []
+    with open(path, 'r') as f:
+        for line in f:
+            lines.append(to_record(line))
+            if len(lines) >= chunk_lines:
+                chunks.append(_write_sorted_chunk(lines, tmp_dir))
+                lines = []
+    if lines:
+        chunks.append(_write_sorted_chunk(lines, tmp_dir))
+    return chunks
+
+
+def _checksum_record(line):
+    # "cksum path" -> "path\tcksum", tab sorts before any path character, so
+    # records sort the same way as (path, cksum) tuples
+    cksum, path = line.split(' ')
+    return path.rstrip('\n') + '\t' + cksum + '\n'
+
+
+def _path_record(line):
+    return line.rstrip('\n') + '\n'
+
+
+def _split_checksums(job):
+    csum_file, tmp_dir, chunk_lines = job
+    return _split_sorted(csum_file, tmp_dir, chunk_lines, _checksum_record)
+
+
+def _merge_unique(paths):
+    '''Unique lines of sorted chunk files in sorted order, chunks are removed afterwards'''
+    files = [open(path, 'r') for path in paths]
+    try:
+        last = None
+        for line in heapq.merge(*files):
+            if line != last:
+                yield line
+                last = line
+    finally:
+        for f, path in zip(files, paths):
+            f.close()
+            os.remove(path)
+
+
+def _merged(paths, tmp_dir, fan_in):
+    '''Merge chunk files in passes of at most `fan_in` open files'''
+    while len(paths) > fan_in:
+        next_paths = []
+        for i in range(0, len(paths), fan_in):
+            fd, merged = tempfile.mkstemp(prefix='merged_', dir=tmp_dir, text=True)
+            with os.fdopen(fd, 'w') as f:
+                f.writelines(_merge_unique(paths[i:i+fan_in]))
+            next_paths.append(merged)
+        paths = next_paths
+    return _merge_unique(paths)
+
+
+def merge_checksums_external(args):
+    '''Same outputs as merge_checksums with memory bounded by --chunk-lines
+
+    Checksum files are split into sorted chunks in parallel, then good run
+    paths and checksum records are merge-joined as two sorted streams.
+    '''
+    old, new = args.substitute_path or ('', '')
+    tmp_dir = tempfile.mkdtemp(prefix='merge_checksums_', dir=args.tmp_dir)
+    try:
+        jobs = [(csum_file, tmp_dir, args.chunk_lines)
+                for csum_file in glob.glob(args.checksums+'/checksums*')]
+        pool = Pool(args.jobs)
+        try:
+            cksum_chunks = [chunk for chunks in pool.imap_unordered(_split_checksums, jobs)
+                            for chunk in chunks]
+        finally:
+            pool.close()
+            pool.join()
+        goodrun_chunks = _split_sorted(args.good_runs, tmp_dir, args.chunk_lines, _path_record)
+
+        goodruns = _merged(goodrun_chunks, tmp_dir, args.fan_in)
+        records = _merged(cksum_chunks, tmp_dir, args.fan_in)
+        goodrun_checksums = open(args.goodrun_checksums, 'w') if args.goodrun_checksums else None
+        n_missing = 0
+        try:
+            with open(args.missing_files, 'w') as missing:
+                record = next(records, None)
+                for line in goodruns:
+                    path = line.rstrip('\n')
+                    # skip checksums of files outside of good run list
+                    while record is not None and record.split('\t', 1)[0] < path:
+                        record = next(records, None)
+                    found = False
+                    while record is not None and record.split('\t', 1)[0] == path:
+                        found = True
+                        if goodrun_checksums:
+                            cksum = record.split('\t', 1)[1].rstrip('\n')
+                            # same dybfs -> dybfs2 swap as in merge_checksums
+                            goodrun_checksums.write(f'{path.replace(old, new)} {cksum}\n')
+                        record = next(records, None)
+                    if not found:
+                        missing.write(line)
+                        n_missing += 1
+        finally:
+            # streams left unread close and remove their chunks before the directory is removed
+            goodruns.close()
+            records.close()
+            if goodrun_checksums:
+                goodrun_checksums.close()
+        print('Found {} missing files without checksums'.format(n_missing))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    if args.manifest:
+        write_goodrun_manifest(args)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -52,9 +196,28 @@ if __name__ == "__main__":
             help='Path where missing files list will be created')
     parser.add_argument('--goodrun-checksums', type=abspath,
             help='Path to file where checksums and pathes for goodrun list will be stored')
+    parser.add_argument('--manifest', type=abspath,
+            help='Path to binary manifest of good run checksums for the server, requires --goodrun-checksums')
+    parser.add_argument('--groupby-idx', type=int, default=5,
+            help='Index of path component identifying a run, as good_runs_groupby_idx of the server')
+    parser.add_argument('--external-sort', action='store_true',
+            help='Merge through sorted chunk files on disk instead of in-memory sets, for huge lists')
+    parser.add_argument('--chunk-lines', type=int, default=2000000,
+            help='Lines sorted in memory at once per process in --external-sort mode')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(),
+            help='Number of checksum files split in parallel in --external-sort mode')
+    parser.add_argument('--fan-in', type=int, default=128,
+            help='Maximal number of chunk files merged at once in --external-sort mode')
+    parser.add_argument('--tmp-dir', type=abspath,
+            help='Directory for chunk files in --external-sort mode, system default if not set')
     parser.add_argument('--substitute-path', nargs=2, type=abspath, metavar="(OLD_VAL NEW_VAL)",
             help='Subsititute part of file path with new value')
     
     args = parser.parse_args()
-    merge_checksums(args)
+    if args.manifest and not args.goodrun_checksums:
+        parser.error('--manifest requires --goodrun-checksums')
+    if args.external_sort:
+        merge_checksums_external(args)
+    else:
+        merge_checksums(args)
 
@@ -2,8 +2,10 @@
 
 import os
 import sys
-from os.path import join, abspath
+import time
+from os.path import join, abspath, dirname
 import argparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 try:
     from tqdm import tqdm
@@ -11,11 +13,12 @@ except ImportError:
     print('No fancy progress bar support; install tqdm for it')
     tqdm = lambda x: x
 
-try:
-    import XRootD.client as xrdcl
-    xrdcksum = xrdcl.flags.QueryCode.CHECKSUM
-except ImportError:
-    raise SystemError("XRootD python bindings not found")
+# checksum of local files is shared with the client
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+# kXR_NotFound, the file is not in storage and retrying will not help
+XRD_NOT_FOUND = 3011
+
 
 class InputReader:
     def __init__(self, path):
@@ -28,49 +31,179 @@ class InputReader:
     def __iter__(self):
         return iter(tqdm(self.entries))
 
-                
-def main(args):
-    def _get_cksum(path):
-        _, response = eos_fs.query(xrdcksum, path)
-        _, cksum = response.decode("utf-8").rstrip('\x00').split()
-        return cksum
 
+class QueryError(Exception):
+    def __init__(self, message, errno=0):
+        super().__init__(message)
+        self.errno = errno
+
+
+class FakeStatus:
+    '''Subset of XRootDStatus used by the validator'''
+    def __init__(self, ok=True, errno=0, message=''):
+        self.ok = ok
+        self.errno = errno
+        self.message = message
+
+
+class LocalFileSystem:
+    '''Stand-in for XRootD FileSystem answering checksum queries from a local directory
+
+    Paths are taken relative to `root`, so `--data-root` works the same way
+    as in EOS. Used to test the validator without access to EOS.
+    '''
+    def __init__(self, root):
+        self.root = root
+
+    def query(self, code, path):
+        from common.checksum import adler32_file
+        local_path = join(self.root, path.lstrip('/'))
+        if not os.path.isfile(local_path):
+            return FakeStatus(False, XRD_NOT_FOUND, f'[ERROR] No such file {path}'), None
+        try:
+            cksum = adler32_file(local_path)
+        except OSError as e:
+            return FakeStatus(False, e.errno or 0, f'[ERROR] {e}'), None
+        # same shape as the EOS reply
+        return FakeStatus(), f'adler32 {cksum}\x00'.encode('utf-8')
+
+
+def make_filesystem(args):
+    '''(filesystem, checksum query code) of EOS, or of a local directory with --fake-eos'''
+    if args.fake_eos:
+        return LocalFileSystem(args.fake_eos), None
+    # imported only here so the validator can be tested without XRootD
+    try:
+        import XRootD.client as xrdcl
+    except ImportError:
+        raise SystemError("XRootD python bindings not found")
+    return xrdcl.FileSystem(args.eos), xrdcl.flags.QueryCode.CHECKSUM
+
+
+def get_cksum(eos_fs, xrdcksum, path, retries, backoff):
+    '''Checksum of `path` in storage, transient errors are retried with exponential backoff'''
+    for attempt in range(retries + 1):
+        try:
+            status, response = eos_fs.query(xrdcksum, path)
+            if not status.ok:
+                raise QueryError(status.message, status.errno)
+            _, cksum = response.decode("utf-8").rstrip('\x00').split()
+            return cksum
+        except Exception as e:
+            # missing file is an answer, not a failure of the query
+            if getattr(e, 'errno', 0) == XRD_NOT_FOUND or attempt == retries:
+                raise
+            time.sleep(backoff * 2**attempt)
+
+
+def read_checkpoint(path):
+    '''Files already validated by a previous run'''
+    if not path or not os.path.exists(path):
+        return set()
+    with open(path, 'r') as f:
+        return set(line.rstrip('\n') for line in f)
+
+
+def main(args):
     expected: InputReader = args.input_file
-    eos_fs = xrdcl.FileSystem(args.eos)
-    root_folder = args.data_root 
+    eos_fs, xrdcksum = make_filesystem(args)
+    root_folder = args.data_root
     output_file = args.output
 
-    wrong_cksum_files = []
-    for fname, orig_cksum in expected:
+    done = read_checkpoint(args.checkpoint)
+    if done:
+        print(f'Resuming: {len(done)} files are already validated according to {args.checkpoint}')
+    # on resume wrong files of the previous run are kept in the output
+    mode = 'a' if done else 'w'
+    output = open(output_file, mode) if output_file else None
+    checkpoint = open(args.checkpoint, mode) if args.checkpoint else None
+    verified = open(args.verified, mode) if args.verified else None
+
+    n_wrong = 0
+    n_unresolved = 0
+
+    def report(fname, orig_cksum, future):
+        nonlocal n_wrong, n_unresolved
         try:
-            if fname.startswith('/'):
-                fname = fname.lstrip('/')
-            cksum_in_eos = _get_cksum(join(root_folder, fname))
-        except:
-            # really naive handling, many things can cause problems: network,
-            # authentication, storage inaccesibility...
-            print(f'{fname} is not in storage! Adding it to wrong file list')
-            wrong_cksum_files.append(fname)
-        if cksum_in_eos != orig_cksum:
+            cksum_in_eos = future.result()
+        except Exception as e:
+            if getattr(e, 'errno', 0) != XRD_NOT_FOUND and checkpoint:
+                # network, authentication, storage inaccessibility... after all
+                # retries there is still no answer, the next pass asks again
+                print(f'Failed to query {fname} ({e}), it is left for the next pass')
+                n_unresolved += 1
+                return
+            print(f'{fname} is not in storage ({e})! Adding it to wrong file list')
+            cksum_in_eos = None
+        if cksum_in_eos is not None and cksum_in_eos != orig_cksum:
             print(f'Wrong cksum for {fname}: {cksum_in_eos} != {orig_cksum}')
-            wrong_cksum_files.append(fname)
+        if cksum_in_eos != orig_cksum:
+            n_wrong += 1
+            if output:
+                output.write(fname+'\n')
+                output.flush()
+        elif verified:
+            # good run list format, the warden server indexes it with `dedup_seed`
+            verified.write(f'/{fname} {orig_cksum}\n')
+            verified.flush()
+        if checkpoint:
+            checkpoint.write(fname+'\n')
+            checkpoint.flush()
+
+    try:
+        with ThreadPoolExecutor(max_workers=args.window) as pool:
+            in_flight = dict()
+            for fname, orig_cksum in expected:
+                if fname.startswith('/'):
+                    fname = fname.lstrip('/')
+                if fname in done:
+                    continue
+                if len(in_flight) >= args.window:
+                    finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        report(*in_flight.pop(future), future)
+                future = pool.submit(get_cksum, eos_fs, xrdcksum, join(root_folder, fname),
+                                     args.retries, args.backoff)
+                in_flight[future] = (fname, orig_cksum)
+            for future in list(in_flight):
+                report(*in_flight.pop(future), future)
+    finally:
+        if output:
+            output.close()
+        if checkpoint:
+            checkpoint.close()
+        if verified:
+            verified.close()
 
-    if wrong_cksum_files:
-        print(f'''{len(wrong_cksum_files)} files have wrong cksums, list of
+    if n_wrong:
+        print(f'''{n_wrong} files have wrong cksums, list of
         it is saved to {output_file}''')
-        with open(output_file, 'w') as f:
-            for fname in wrong_cksum_files:
-                f.write(fname+'\n')
+    if n_unresolved:
+        print(f'{n_unresolved} files could not be queried, run again with the same --checkpoint to validate them')
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-i", "--input-file", required=True, type=InputReader, help="Help text")
-    parser.add_argument("-e", "--eos", default="root://eos.jinr.ru", 
+    parser.add_argument("-e", "--eos", default="root://eos.jinr.ru",
                         help='EOS storage address')
     parser.add_argument("-d", "--data-root", default="/eos/juno/dirac/juno/lustre-ro",
                         help="Root directory for data in EOS")
     parser.add_argument("-o", "--output", type=abspath, help="Path where to store files with wrong checksums")
+    parser.add_argument("--verified", type=abspath,
+                        help="Path where to store files with matching checksums, in the good run list format")
+    parser.add_argument("-w", "--window", type=int, default=64,
+                        help="Number of checksum queries in flight")
+    parser.add_argument("--retries", type=int, default=3,
+                        help="Retries of a failed query before the file is reported as missing")
+    parser.add_argument("--backoff", type=float, default=1.0,
+                        help="Delay before the first retry in seconds, doubled on every next one")
+    parser.add_argument("-c", "--checkpoint", type=abspath,
+                        help="File of validated files, validation resumes from it if it exists. "
+                             "Files whose queries keep failing are not added to it, so they are "
+                             "queried again on resume instead of being reported as missing")
+    parser.add_argument("--fake-eos", type=abspath, metavar="DIR",
+                        help="Answer checksum queries from local directory DIR instead of EOS, for testing")
 
     args = parser.parse_args()
 
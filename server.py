@@ -3,28 +3,53 @@
 import os
 import sys
 from os.path import abspath
-from typing import List, Dict, Tuple, Optional, Set
-from collections import defaultdict, Counter
+from typing import Any, List, Dict, Iterator, NamedTuple, Tuple, Optional
+from collections import Counter
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 import signal
-import subprocess
+import asyncio
+import json
+import time
 
 from loguru import logger
 import yaml
 import secrets
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, HTTPException, Header, Request, status
+from fastapi.exceptions import RequestValidationError
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
+from fastapi.responses import JSONResponse, PlainTextResponse, Response
+from pydantic import ValidationError
 
-from common.models import Status, ClientMessage
+from common.models import Status, ClientMessage, FileState, ProgressReport
 from common.utils import FailedFiles
+from common.store import RunStore, StoredRun, ContentIndex, QUEUED, DONE, SHARDED
+from common.leases import LeaseTable
+from common.inventory import Inventory, scan_tree, summarize
+from common.goodruns import load_good_run_list, pack_cksum, split_entry
+from common.manifest import Manifest, ManifestError
+from common.scheduler import RunQueue, is_retry
+from common.shards import RunShard, is_shard, parent_run, split_run
+from common.metrics import Registry, CONTENT_TYPE
+from common.checksum import VerificationPool
+from common.reconcile import Reconciler, RunPresence
+from common.snapshot import Snapshot, SnapshotError, SnapshotRun, settings_fingerprint, write_snapshot
+from common import wire
 
 config = None
 
-def count_files():
-    command = f'find {config["EOS_DYBFS"]} -print'
-    out = subprocess.check_output(command.split()).decode()
-    out = out.split('\n')
-    return len(out) - 1
+# seconds a leased run stays with a client without a heartbeat
+DEFAULT_LEASE_TTL = 900
+DEFAULT_LEASE_CHECK_INTERVAL = 30
+# files returned at most by one request to /files/corrupted
+DEFAULT_MAX_PAGE_SIZE = 10000
+# runs saved to the store and queued at once while loading in background
+LOAD_CHUNK = 2000
+# files saved in one transaction of the import, requests wait for at most one of them
+SAVE_BATCH = 5000
+# seconds a client waits before asking for a run again while runs are loading
+LOADING_RETRY_AFTER = 2
+DEFAULT_SNAPSHOT_INTERVAL = 300
 
 app = FastAPI()
 security = HTTPBasic()
@@ -32,10 +57,53 @@ security = HTTPBasic()
 runs = None 
 copied_runs: Dict[str, Status] = dict()
 
-runs_in_process = dict()
+runs_in_process = LeaseTable(timedelta(seconds=DEFAULT_LEASE_TTL))
 
 total_failed_files = FailedFiles()
 
+store: Optional[RunStore] = None
+
+inventory = Inventory()
+
+manifest: Optional[Manifest] = None
+
+# contents of files verified in EOS with `dedup`, shared by all good run lists
+content_index: Optional[ContentIndex] = None
+
+
+class LoadedRuns(NamedTuple):
+    # (run, pathes, priority, group) for RunQueue.restore
+    entries: List[Tuple[str, Any, Tuple[int, int], Optional[str]]]
+    # files of these runs or of restored leases found in EOS
+    presences: List[RunPresence]
+    # runs of copied_runs.yaml
+    copied: Dict[str, Status]
+
+# chunks of runs to queue, None once all runs are queued
+run_loader: Optional[Iterator[LoadedRuns]] = None
+startup_began = time.monotonic()
+startup_timings: Dict[str, float] = dict()
+startup_error: Optional[str] = None
+reconciled_totals: Counter = Counter()
+
+metrics = Registry()
+LEASE_SECONDS = metrics.histogram('warden_lease_seconds', 'Time to lease a run to a client')
+LEASED_RUNS = metrics.counter('warden_leased_runs_total', 'Runs leased to clients')
+QUEUE_DEPTH = metrics.gauge('warden_queue_depth', 'Runs waiting for a client',
+                            callback=lambda: len(runs))
+LEASES_IN_FLIGHT = metrics.gauge('warden_leases_in_flight', 'Runs leased to clients and not finalized',
+                                 callback=lambda: len(runs_in_process))
+FINALIZED_RUNS = metrics.counter('warden_finalized_runs_total', 'Runs finalized by clients', ['status'])
+INTEGRITY_FAILED_FILES = metrics.counter('warden_integrity_failed_files_total',
+                                         'Files reported with wrong checksums')
+EXPIRED_LEASES = metrics.counter('warden_expired_leases_total', 'Leases expired without heartbeat')
+DEDUP_CANDIDATES = metrics.counter('warden_dedup_candidates_total',
+                                   'Files leased with a copy of the same content already in EOS')
+STARTUP_SECONDS = metrics.gauge('warden_startup_phase_seconds', 'Seconds spent in phases of server startup',
+                                ['phase'])
+SPURIOUS_FILES = metrics.gauge('warden_spurious_files', 'Files not resubmitted after repeated checksum failures',
+                               callback=lambda: len(total_failed_files.spurious_files))
+
 
 
 class Auth:
@@ -54,40 +122,158 @@ class Auth:
             )
         return credentials
 
-def task_overdue(submit_date):
-    return (submit_date + timedelta(days=1.5)) < datetime.now()
-
 def reschedule_hanged_tasks():
-    should_remove = []
-    for run, (submit_date, pathes) in runs_in_process.items():
-        if task_overdue(submit_date):
-            should_remove.append(run)
+    expired = runs_in_process.expired()
 
-    total_hanged = len(should_remove)
+    total_hanged = len(expired)
+    EXPIRED_LEASES.inc(total_hanged)
     if total_hanged:
-        logger.warning(f'{total_hanged} tasks are overdue by 2 days, taking them back to queue')
+        logger.warning(f'{total_hanged} leases expired without heartbeat, taking them back to queue')
 
-    for run in should_remove:
-        _, pathes = runs_in_process.pop(run)
-        runs[run] = pathes
+    with store.transaction():
+        for run, pathes in expired:
+            runs[run] = pathes
+            store.requeue(run)
+
+async def expire_leases_periodically():
+    interval = config.get('lease_check_interval', DEFAULT_LEASE_CHECK_INTERVAL)
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            reschedule_hanged_tasks()
+        except Exception:
+            logger.exception('Failed to reschedule expired leases')
+
+@app.post("/runs/{run}/heartbeat")
+async def extend_lease(run: str, credentials: HTTPBasicCredentials = Depends(Auth.get_credentials)):
+    '''Client is still working on the run, extend its lease'''
+    try:
+        deadline = runs_in_process.heartbeat(run)
+    except KeyError:
+        raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"{run} is not leased, lease expired or run is finalized"
+                )
+    return {'run': run, 'deadline': deadline}
+
+@app.post("/runs/{run}/progress")
+async def report_progress(run: str, report: ProgressReport, credentials: HTTPBasicCredentials = Depends(Auth.get_credentials)):
+    '''Save states of files of a run in process, also extends its lease'''
+    store.record_progress(run, ((path, state.value, size) for path, state, size in report.files))
+    if run in runs_in_process:
+        runs_in_process.heartbeat(run)
+    if config.get('dedup'):
+        # clients send checksums of verified files, older ones do not and their files are not indexed
+        content_index.add((report.cksums[path], size, path) for path, state, size in report.files
+                          if state == FileState.Verified and size is not None and path in report.cksums)
+    return run_progress(run)
+
+def index_contents(run, verified):
+    '''Add (path, size) of files of a run verified in EOS to the content index
+
+    Checksums are read from the stored files of the run, once per run
+    reconciled at startup. Progress reports carry their checksums.
+    '''
+    if not verified:
+        return
+    sizes = dict(verified)
+    content_index.add((cksum, sizes[path], path) for path, cksum in stored_files(run) if path in sizes)
+
+def local_sources(files):
+    '''[path, source, size] of files whose content may already be in EOS under another path
+
+    The index knows sizes of verified files only, clients compare them with
+    sizes at IHEP before copying within EOS.
+    '''
+    contents = content_index.find(cksum for _, cksum in files)
+    if not contents:
+        return []
+    limit = config.get('dedup_max_candidates', 4)
+    copies = []
+    for path, cksum in files:
+        candidates = [[path, source, size] for size, source in contents.get(cksum, ()) if source != path]
+        copies.extend(candidates[:limit])
+    DEDUP_CANDIDATES.inc(len(copies))
+    return copies
+
+@app.get("/runs/{run}/progress")
+async def get_progress(run: str, credentials: HTTPBasicCredentials = Depends(Auth.get_credentials)):
+    return run_progress(run)
+
+def run_progress(run):
+    '''Number of files of a run in every state'''
+    progress = store.progress(run)
+    n_files = store.n_files(run)
+    counts = {state.name.lower(): progress.get(state.value, (0, 0))[0] for state in FileState}
+    counts['pending'] = max(0, n_files - sum(counts.values()))
+    return {'run': run, 'files': n_files, **counts,
+            'verified_bytes': progress.get(FileState.Verified.value, (0, 0))[1]}
+
+def reported_totals(message: ClientMessage):
+    '''(files, bytes) verified in all leases of a run, from progress reports if there are any'''
+    n_files, n_bytes = store.progress(message.run).get(FileState.Verified.value, (0, 0))
+    if n_files:
+        return n_files, n_bytes
+    return message.transferred_files, message.transferred_bytes or 0
+
+async def read_message(request: Request) -> ClientMessage:
+    '''ClientMessage from a JSON or, with its content type, compact body'''
+    body = await request.body()
+    try:
+        if wire.MEDIA_TYPE in request.headers.get('content-type', ''):
+            data = wire.loads(body)
+        else:
+            data = json.loads(body)
+        return ClientMessage(**data)
+    except ValidationError as e:
+        raise RequestValidationError(e.errors())
+    except (ValueError, TypeError) as e:
+        raise RequestValidationError([{'loc': ('body',), 'msg': f'Malformed message: {e}', 'type': 'value_error'}])
+
+def encode_response(payload, accept: Optional[str]) -> Response:
+    '''Compact encoding if the client accepts it, JSON otherwise
+
+    Both skip jsonable_encoder, which walks every (path, cksum) pair of a file list.
+    '''
+    if wire.accepts(accept):
+        return Response(wire.dumps(payload, config.get('wire_compress_level', wire.DEFAULT_LEVEL)),
+                        media_type=wire.MEDIA_TYPE)
+    return JSONResponse(payload)
 
 @app.post("/runs/finalize")
-async def add_run_to_completed(message: ClientMessage, credentials: HTTPBasicCredentials = Depends(Auth.get_credentials)):
+async def add_run_to_completed(request: Request, x_warden_client: Optional[str] = Header(None),
+                               credentials: HTTPBasicCredentials = Depends(Auth.get_credentials)):
+    message = await read_message(request)
+    with store.transaction():
+        finalize(message, x_warden_client)
+    reschedule_hanged_tasks()
+
+def finalize(message: ClientMessage, client: Optional[str] = None):
+    FINALIZED_RUNS.inc(status=message.status.name)
     if message.status == Status.IntegrityFailed:
         failed_files_run = "failed_" + str(total_failed_files.integrity_failed_counter)
         total_failed_files.integrity_failed_counter += 1
+        store.set_meta('integrity_failed_counter', total_failed_files.integrity_failed_counter)
         if message.failed_files:
             failed_in_run = message.failed_files
-            total_failed_files.update(failed_in_run)
+            INTEGRITY_FAILED_FILES.inc(len(failed_in_run))
+            reported_at = datetime.now().timestamp()
+            crossed = total_failed_files.report(failed_in_run, message.run, client, reported_at)
+            store.record_failures(failed_in_run, message.run, client, reported_at,
+                                  total_failed_files.history_limit)
+            if crossed:
+                logger.error(f'{len(crossed)} files of {message.run} got reported more than '
+                             f'{total_failed_files.spurious_treshold} times, they are not resubmitted anymore')
             good_failed = [_ for _ in failed_in_run 
                            if  _ not in total_failed_files.spurious_files] 
             n_failed = len(good_failed)
             if good_failed:
                 runs[failed_files_run] = good_failed
+                store.add_run(failed_files_run, good_failed)
                 logger.warning(f'{message.run} reported {n_failed} new files with wrong checksums! Resubmitted new corrupted files')
             else:
                 logger.critical(f'Some files with wrong checksums got reported '
-                        'more then 4 times, stopping resubmitting it. It needs closer look.')
+                        f'more then {total_failed_files.spurious_treshold} times, stopping resubmitting it. It needs closer look.')
         else:
             logger.warning(f'{message.run} reported files with wrong checksums but provided empty list of corrupt files! Need closer look')
 
@@ -99,21 +285,93 @@ async def add_run_to_completed(message: ClientMessage, credentials: HTTPBasicCre
             _ = runs.pop(message.run)
             logger.warning(f'{message.run} was removed from waiting queue.')
         except KeyError:
-            logger.critical(f'{message.run} was not in waiting queue. Data corruption possible!')
-
+            if store.state(message.run) == DONE:
+                logger.info(f'{message.run} was already found in EOS at startup')
+            else:
+                logger.critical(f'{message.run} was not in waiting queue. Data corruption possible!')
+
+    complete_run(message)
+
+def complete_run(message: ClientMessage):
+    '''Mark a run taken out of the queue as done and account its files'''
+    store.done(message.run)
+    if is_shard(message.run):
+        finalize_shard(message)
+        return
+    n_files, n_bytes = reported_totals(message)
+    if n_files is not None:
+        inventory.record(message.run, n_files, n_bytes)
+        store.record_inventory(message.run, n_files, n_bytes)
     if not "failed" in message.run:
         copied_runs.update({message.run: Status.Done})
     logger.success(f'Finished copying {message.run}')
-    reschedule_hanged_tasks()
-    
+
+def finalize_shard(message: ClientMessage):
+    '''Run of a shard is done only when all its shards are'''
+    n_files, n_bytes = reported_totals(message)
+    store.record_shard(message.run, n_files or 0, n_bytes)
+    run = parent_run(message.run)
+    pending = store.pending_shards(run)
+    if pending:
+        logger.success(f'Finished copying {message.run}, {pending} shards of {run} remain')
+        return
+    n_files, n_bytes = store.shard_totals(run)
+    inventory.record(run, n_files, n_bytes)
+    store.record_inventory(run, n_files, n_bytes)
+    store.done(run)
+    copied_runs.update({run: Status.Done})
+    logger.success(f'Finished copying {message.run}, all shards of {run} are done')
+
 
 @app.get("/files/completed")
 async def completed_files(credentials: HTTPBasicCredentials = Depends(Auth.get_credentials)):
-    return count_files()
+    '''Totals of runs, files and bytes transferred to EOS'''
+    return inventory.totals()
+
+@app.get("/files/completed/{run}")
+async def completed_files_in_run(run: str, credentials: HTTPBasicCredentials = Depends(Auth.get_credentials)):
+    try:
+        return inventory.run(run)
+    except KeyError:
+        raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"No transferred files reported for {run}"
+                )
+
+def scan_destination():
+    '''Per-run totals of files present in EOS, walks the whole destination'''
+    groupby_idx = config.get('good_runs_groupby_idx') or 5
+    entries = scan_tree(config['EOS_DYBFS'], config.get('scan_workers', 8))
+    return summarize(entries, groupby_idx)
+
+async def reconcile_inventory_periodically(interval):
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            # scanning EOS must not block the event loop serving clients
+            per_run = await loop.run_in_executor(None, scan_destination)
+            inventory.reconcile(per_run)
+            store.replace_inventory(per_run)
+            logger.info(f'Reconciled inventory with {config["EOS_DYBFS"]}: {inventory.totals()}')
+        except Exception:
+            logger.exception('Failed to reconcile inventory')
+        await asyncio.sleep(interval)
 
 @app.get("/files/corrupted")
-async def files_corrupted(credentials: HTTPBasicCredentials = Depends(Auth.get_credentials)):
-    return total_failed_files.spurious_files
+async def files_corrupted(offset: int = 0, limit: int = 1000, history: bool = False, spurious_only: bool = True,
+                          credentials: HTTPBasicCredentials = Depends(Auth.get_credentials)):
+    '''A page of files reported too often with wrong checksums or, without `spurious_only`, of all failed files'''
+    offset = max(0, offset)
+    limit = max(1, min(limit, config.get('max_page_size', DEFAULT_MAX_PAGE_SIZE)))
+    total = len(total_failed_files.spurious_files) if spurious_only else len(total_failed_files)
+    return {'total': total, 'offset': offset,
+            'files': [total_failed_files.describe(key, history)
+                      for key in total_failed_files.page(offset, limit, spurious_only)]}
+
+@app.get("/metrics")
+async def get_metrics(credentials: HTTPBasicCredentials = Depends(Auth.get_credentials)):
+    '''Metrics in Prometheus text format'''
+    return PlainTextResponse(metrics.render(), media_type=CONTENT_TYPE)
 
 @app.get("/runs/completed")
 async def completed_runs(credentials: HTTPBasicCredentials = Depends(Auth.get_credentials)):
@@ -127,50 +385,100 @@ async def total_runs(credentials: HTTPBasicCredentials = Depends(Auth.get_creden
 async def total_copied_runs(credentials: HTTPBasicCredentials = Depends(Auth.get_credentials)):
     return len(copied_runs)
 
+@app.get("/runs/queue")
+async def queue_order(limit: int = 50, credentials: HTTPBasicCredentials = Depends(Auth.get_credentials)):
+    '''First `limit` queued runs in the order they will be leased'''
+    return [{'run': run, 'retry': is_retry(run), 'weight': -weight}
+            for run, (_, weight) in runs.peek(limit)]
+
+def lease_run(client=None):
+    '''Move next run from the queue to runs in process, raises KeyError if queue is empty'''
+    with LEASE_SECONDS.time():
+        return _lease_run(client)
+
+def _lease_run(client):
+    run, pathes = runs.popitem(client)
+    LEASED_RUNS.inc()
+    start = datetime.now()
+    runs_in_process.add(run, pathes, start)
+    store.lease(run, start)
+    # a run leased again is resumed, files verified in previous leases are skipped
+    states = store.file_states(run)
+    files = [entry for entry in pathes if states.get(entry[0]) != FileState.Verified.value]
+    lease = {'run': run, 'files': files, 'resumed': bool(states)}
+    # in EOS already but not checksummed yet, clients verify them before copying the rest
+    present = [path for path, _ in files if states.get(path) == FileState.Transferred.value]
+    if present:
+        lease['present'] = present
+    if config.get('dedup'):
+        lease['copies'] = local_sources(files)
+    return lease
+
 @app.get("/runs/next")
-async def send_next_run(credentials: HTTPBasicCredentials = Depends(Auth.get_credentials)):
-    try:
-        entry = runs.popitem()
-        run, pathes = entry
-        start = datetime.now()
-        runs_in_process[run] = (start, pathes)
-        return {'run': run, 'files': pathes}
-    except KeyError:
-        raise HTTPException(
-                status_code=status.HTTP_410_GONE,
-                detail="All runs are processed!"
+async def send_next_run(count: Optional[int] = None, x_warden_client: Optional[str] = Header(None),
+                        accept: Optional[str] = Header(None),
+                        credentials: HTTPBasicCredentials = Depends(Auth.get_credentials)):
+    '''Lease one run or, if `count` is given, a batch of up to `count` runs'''
+    if count is None:
+        try:
+            return encode_response(lease_run(x_warden_client), accept)
+        except KeyError:
+            raise no_runs_left()
+
+    count = max(1, min(count, config.get('max_lease_batch', 8)))
+    leased = []
+    for _ in range(count):
+        try:
+            leased.append(lease_run(x_warden_client))
+        except KeyError:
+            break
+    if not leased:
+        raise no_runs_left()
+    return encode_response({'runs': leased}, accept)
+
+def no_runs_left():
+    '''Queue is empty: all runs are handed out or, while loading, not queued yet'''
+    if startup_error is not None:
+        # the rest of runs will never be queued, clients must not wait for them
+        return HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail=f"Failed to load runs: {startup_error}"
+                )
+    if run_loader is not None:
+        return HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Runs are being loaded",
+                headers={'Retry-After': str(LOADING_RETRY_AFTER)}
                 )
+    return HTTPException(
+            status_code=status.HTTP_410_GONE,
+            detail="All runs are processed!"
+            )
+
+@app.get("/startup")
+async def startup_status(credentials: HTTPBasicCredentials = Depends(Auth.get_credentials)):
+    '''Whether runs are still being loaded and seconds spent in phases of startup'''
+    return {'loading': run_loader is not None, 'error': startup_error, 'queued': len(runs),
+            'phases': startup_timings}
 
 
 def get_configuration() -> Dict[str, Optional[str]]:
     try:
         with open(os.path.abspath('server_conf.yaml'), 'r') as f:
-            config = yaml.load(f)
+            config = yaml.safe_load(f)
     except (FileNotFoundError, ValueError):
         logger.warning("No conf.yaml found in {}, rely on environmental vars to get credentials".format(os.getcwd()))
         return None
     return config
 
 
-def parse_good_run_list(good_run_list, groupby_idx=5):
-    good_runs: defaultdict[str: List[Tuple[str,str]]] = defaultdict(list)
-    with open(good_run_list, 'r') as f:
-        run_in_process = None
-        for entry in f:
-            path, cksum = entry.split(' ')
-# trim '/dybfs/', necessary for rsync to read files to copy from list
-            path = path.lstrip('/').split('/')
-            path = '/'.join(path[1:])
-            tokens = path.split('/')
-            current_run = tokens[groupby_idx]
-            good_runs[current_run].append((path, cksum.rstrip('\n')))
-    return good_runs
-
 @app.on_event('startup')
 def init():
-    '''Init configuration'''
+    '''Init configuration and the state store, runs are queued in background by load_runs'''
     logger.add("warden_server.log")
     set_gracefull_shutdown()
+    global startup_began
+    startup_began = time.monotonic()
 
     global config
     config = get_configuration()
@@ -188,47 +496,493 @@ def init():
         Auth.passwd = os.environ.get('CLIENT_PASSWD')
 
     assert Auth.login and Auth.passwd,  "Must provide login and password for clients authentication"
-    good_run_file_path = config['good_runs'] or os.environ.get('GOOD_RUNS')
-
-    assert good_run_file_path, "Must provide a good run list for a server!"
+    good_run_file_path = config.get('good_runs') or os.environ.get('GOOD_RUNS')
+
+    assert good_run_file_path or config.get('manifest'), "Must provide a good run list for a server!"
+
+    runs_in_process.ttl = timedelta(seconds=config.get('lease_ttl', DEFAULT_LEASE_TTL))
+    total_failed_files.spurious_treshold = config.get('spurious_threshold', 4)
+    total_failed_files.history_limit = config.get('failure_history', 10)
+
+    global manifest, store, content_index, runs, run_loader
+    with startup_phase('init'):
+        manifest = open_manifest(good_run_file_path)
+        store = RunStore(abspath(config.get('state_db', 'warden_state.sqlite')))
+        if config.get('dedup'):
+            content_index = ContentIndex(abspath(config.get('dedup_db', 'warden_contents.sqlite')))
+        runs = new_run_queue()
+        if store.populated():
+            known = read_snapshot()
+            restore_state(known)
+            run_loader = restored_runs(known)
+        else:
+            # runs of an import interrupted by a restart may be leased or done already
+            restore_state(dict())
+            run_loader = imported_runs(good_run_file_path)
+    if config.get('reconcile_on_start'):
+        # leases of the previous server are reconciled before queued runs
+        run_loader = reconciled(run_loader, [(run, pathes) for run, (_, pathes) in runs_in_process.items()])
+    if not config.get('background_load', True):
+        for chunk in run_loader:
+            queue_loaded(chunk)
+        loading_done()
+        return
+    logger.info(f'Serving clients after {time.monotonic() - startup_began:.2f} s, runs are queued in background')
+
+@contextmanager
+def startup_phase(name):
+    '''Account time spent in a phase of startup, shown by /startup and metrics'''
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        startup_timings[name] = startup_timings.get(name, 0.0) + time.monotonic() - start
+        STARTUP_SECONDS.set(startup_timings[name], phase=name)
+
+def queue_entry(run, pathes):
+    '''(run, pathes, priority, group) of a run weighed by the queue'''
+    group = runs.group(run, pathes) if runs.group is not None else None
+    return run, pathes, runs.priority(run, pathes), group
+
+def imported_runs(good_run_file_path):
+    '''Runs of the good run list in chunks, each chunk is saved to the store before it is queued'''
+    with startup_phase('parse'):
+        if manifest is not None:
+            good_runs = manifest.runs()
+            logger.info(f'Initialized good run list from manifest {manifest.path}')
+        else:
+            good_runs = load_good_run_list(os.path.abspath(good_run_file_path),
+                                           config.get('good_runs_groupby_idx') or 5)
+            logger.info('Initialized good run list')
 
-    global runs
-    if not config.get('good_runs_groupby_idx'):
-        runs = parse_good_run_list(os.path.abspath(good_run_file_path))
-    else:
-        runs = parse_good_run_list(os.path.abspath(good_run_file_path), config.get('good_runs_groupby_idx'))
-    logger.info('Initialized good run list')
+    with startup_phase('copied'):
+        copied = previously_copied_runs()
+        for run, status in copied.items():
+            if status == Status.Done:
+                good_runs.pop(run, None)
+                logger.debug(f'Removing {run} from run list as it is copied')
 
+    with startup_phase('shard'):
+        sharded = shard_large_runs(good_runs, config.get('shard_max_files'))
+
+    # requests use the store meanwhile, it is saved in small transactions
+    # so they wait for one of them at most
+    with startup_phase('save'):
+        # shards are slices of the file list of their run
+        for run, (pathes, shards) in sharded.items():
+            with store.transaction():
+                # a run leased or copied whole before a restart is not split anymore
+                if (store.add_run(run, pathes, SHARDED, with_files=manifest is None)
+                        or store.state(run) == SHARDED):
+                    store.add_shards(run, ((shard, pathes.start, pathes.stop) for shard, pathes in shards))
+        with store.transaction():
+            for run in copied:
+                store.add_run(run, [])
+                store.done(run)
+        # retry runs of an import interrupted by a restart are not in the good run list
+        retries = [(run, n_files) for run, n_files in store.run_counts(QUEUED) if is_retry(run)]
+
+    items = list(good_runs.items())
+    for i in range(0, len(items), LOAD_CHUNK):
+        chunk = items[i:i + LOAD_CHUNK]
+        with startup_phase('save'):
+            # file lists of manifest runs stay in the manifest
+            store.add_runs(((run, pathes) for run, pathes in chunk if not is_shard(run)),
+                           with_files=manifest is None, batch=SAVE_BATCH)
+            # runs already known to the store keep their state, a run leased or
+            # copied before a restart must not be queued again
+            states = store.states(run for run, _ in chunk)
+        with startup_phase('weigh'):
+            entries = [queue_entry(run, pathes) for run, pathes in chunk if states.get(run) == QUEUED]
+            if i == 0:
+                entries.extend(queue_entry(run, stored_files(run, n_files)) for run, n_files in retries)
+        yield LoadedRuns(entries, [], copied if i == 0 else {})
+    if not items and (copied or retries):
+        yield LoadedRuns([queue_entry(run, stored_files(run, n_files)) for run, n_files in retries],
+                         [], copied)
+    with startup_phase('save'):
+        store.mark_populated()
+    logger.info(f'Saved good run list to {store.path}')
+
+def previously_copied_runs():
+    '''Runs of copied_runs.yaml with `check_previously_copied`'''
     previously_copied = abspath('copied_runs.yaml')
-    if os.path.exists(previously_copied) and config.get('check_previously_copied'):
-        logger.info(f'Found previosly copied runs on {previously_copied}')
-        with open(previously_copied) as f:
-            previously_copied_runs = yaml.load(f)
+    if not (os.path.exists(previously_copied) and config.get('check_previously_copied')):
+        return dict()
+    logger.info(f'Found previosly copied runs on {previously_copied}')
+    with open(previously_copied) as f:
+        # written by dump_copied_runs, holds Status objects; libyaml parses it much faster
+        return yaml.load(f, Loader=getattr(yaml, 'CLoader', yaml.Loader)) or dict()
+
+def restored_runs(known):
+    '''Queued runs of the state store in chunks, weighed by the snapshot if it knows them'''
+    with startup_phase('restore'):
+        queued = store.run_counts(QUEUED)
+    n_known = 0
+    for i in range(0, len(queued), LOAD_CHUNK):
+        entries = []
+        with startup_phase('weigh'):
+            for run, n_files in queued[i:i + LOAD_CHUNK]:
+                saved = known.get(run)
+                if saved is None:
+                    entries.append(queue_entry(run, stored_files(run, n_files)))
+                else:
+                    entries.append((run, stored_files(run, n_files), saved.priority, saved.group))
+                    n_known += 1
+        yield LoadedRuns(entries, [], {})
+    logger.info(f'Restored {len(queued)} queued runs from {store.path}, {n_known} weighed by the snapshot')
+
+def reconciled(chunks, leased):
+    '''Chunks with files of their runs already in EOS, see apply_presences
+
+    Runs are checked before they are queued, so clients never lease runs
+    already copied. Restored leases are checked first, their clients may be
+    gone with the previous server.
+    '''
+    pool = None
+    if config.get('reconcile_verify'):
+        pool = VerificationPool(workers=int(config.get('reconcile_verify_workers', 4)))
+    reconciler = Reconciler(config['EOS_DYBFS'], workers=int(config.get('scan_workers', 8)), pool=pool)
+
+    def check(candidates):
+        # files of retry runs are in EOS with wrong checksums, only verification can clear them
+        candidates = [(run, pathes) for run, pathes in candidates if pool is not None or not is_retry(run)]
+        reconciled_totals['runs'] += len(candidates)
+        with startup_phase('reconcile'):
+            # workers read stored file lists, the store is locked only when presences are applied
+            return list(reconciler.runs(candidates))
 
-        global copied_runs
-        for run, status in previously_copied_runs.items():
-            if status == Status.Done:
-                del runs[run]
-                logger.debug(f'Removing {run} from run list as it is copied')
-            copied_runs[run] = status
+    try:
+        if leased:
+            yield LoadedRuns([], check(leased), {})
+        for chunk in chunks:
+            yield chunk._replace(presences=check((run, pathes) for run, pathes, _, _ in chunk.entries))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+def apply_presences(presences, pending):
+    '''Record files found in EOS and complete runs with all files there verified
+
+    Files with matching checksums are verified. Files only found under their
+    final name are transferred, clients checksum them instead of copying them
+    again. `pending` are runs not queued yet, restored leases are taken back
+    from their clients. Returns names of completed runs.
+    '''
+    completed = set()
+    with store.transaction():
+        for presence in presences:
+            if not presence.verified:
+                # files verified by clients meanwhile stay verified
+                states = store.file_states(presence.run)
+                store.record_progress(presence.run, ((path, FileState.Transferred.value, size)
+                                                     for path, size in presence.present
+                                                     if states.get(path) != FileState.Verified.value))
+                reconciled_totals['present'] += len(presence.present)
+                continue
+            store.record_progress(presence.run, ((path, FileState.Verified.value, size)
+                                                 for path, size in presence.present))
+            if config.get('dedup'):
+                # only checksummed files are known to hold their content
+                index_contents(presence.run, presence.present)
+            reconciled_totals['files'] += len(presence.present)
+            if not presence.complete:
+                reconciled_totals['partial'] += 1
+                continue
+            if presence.run in runs_in_process:
+                # a client still holding it finds the run done when it finalizes
+                runs_in_process.pop(presence.run)
+            elif presence.run not in pending:
+                # finalized by its client meanwhile
+                continue
+            complete_run(ClientMessage(run=presence.run, status=Status.Done,
+                                       transferred_files=presence.n_files,
+                                       transferred_bytes=presence.n_bytes))
+            completed.add(presence.run)
+            reconciled_totals['complete'] += 1
+    return completed
+
+def queue_loaded(chunk: LoadedRuns):
+    '''Queue a chunk of loaded runs, called in the event loop'''
+    copied_runs.update(chunk.copied)
+    completed = set()
+    if chunk.presences:
+        completed = apply_presences(chunk.presences, {run for run, _, _, _ in chunk.entries})
+    runs.restore(entry for entry in chunk.entries if entry[0] not in completed)
+
+async def load_runs():
+    '''Queue runs chunk by chunk in background, clients lease runs of the first chunks meanwhile'''
+    global startup_error
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            # parsing, saving and weighing runs must not block the event loop serving clients
+            chunk = await loop.run_in_executor(None, next, run_loader, None)
+            if chunk is None:
+                break
+            with startup_phase('queue'):
+                queue_loaded(chunk)
+    except Exception as e:
+        startup_error = repr(e)
+        logger.exception('Failed to load runs, clients get 500 once queued runs are handed out')
+        return
+    loading_done()
+    await save_snapshot()
+
+def loading_done():
+    global run_loader
+    run_loader = None
+    startup_timings['total'] = time.monotonic() - startup_began
+    STARTUP_SECONDS.set(startup_timings['total'], phase='total')
+    phases = ', '.join(f'{phase} {seconds:.2f} s' for phase, seconds in startup_timings.items())
+    logger.info(f'Queued {len(runs)} runs, {len(runs_in_process)} in process, {len(copied_runs)} copied: {phases}')
+    if config.get('reconcile_on_start'):
+        logger.info(f'Reconciled {reconciled_totals["runs"]} queued and leased runs with {config["EOS_DYBFS"]}: '
+                    f'{reconciled_totals["complete"]} runs already copied, {reconciled_totals["partial"]} '
+                    f'partially, {reconciled_totals["files"]} files verified and skipped, '
+                    f'{reconciled_totals["present"]} files present to be checksummed by clients')
+
+def open_manifest(good_run_file_path):
+    '''Manifest from config, unless it is missing, corrupted or built from another good run list'''
+    path = config.get('manifest')
+    if not path:
+        return None
+    try:
+        manifest = Manifest(abspath(path))
+        if (good_run_file_path and os.path.exists(good_run_file_path)
+                and manifest.is_stale(good_run_file_path)):
+            raise ManifestError(f'{path} was built from a different version of {good_run_file_path}')
+    except (OSError, ManifestError) as e:
+        logger.error(f'Ignoring manifest: {e}')
+        return None
+    groupby_idx = config.get('good_runs_groupby_idx') or 5
+    if manifest.groupby_idx != groupby_idx:
+        logger.warning(f'Manifest groups runs by path component {manifest.groupby_idx}, '
+                       f'not {groupby_idx}, using the manifest grouping')
+    return manifest
+
+def shard_large_runs(runs, max_files):
+    '''Replace runs of more than `max_files` files in `runs` with their shards'''
+    sharded = dict()
+    if not max_files:
+        return sharded
+    for run, pathes in list(runs.items()):
+        if is_retry(run) or len(pathes) <= max_files:
+            continue
+        del runs[run]
+        shards = split_run(run, pathes, max_files)
+        runs.update(shards)
+        sharded[run] = (pathes, shards)
+    if sharded:
+        n_shards = sum(len(shards) for _, shards in sharded.values())
+        logger.info(f'Split {len(sharded)} runs of more than {max_files} files into {n_shards} shards')
+    return sharded
+
+def load_run_sizes(path):
+    '''Bytes per run from `du -sb` output, run is the last component of a path'''
+    sizes = dict()
+    with open(path, 'r') as f:
+        for line in f:
+            size, run_path = line.split(maxsplit=1)
+            sizes[os.path.basename(run_path.rstrip('\n').rstrip('/'))] = int(size)
+    return sizes
+
+def new_run_queue():
+    '''Run queue ordered by file count or, with `schedule_by: bytes`, by run size'''
+    weight = None
+    if config.get('schedule_by', 'files') == 'bytes':
+        sizes = load_run_sizes(abspath(config['run_sizes']))
+        logger.info(f'Scheduling runs by size from {config["run_sizes"]}, {len(sizes)} runs')
+        # retry runs have no size, they are ahead of all other runs anyway
+        def weight(run, pathes):
+            size = sizes.get(parent_run(run), 0)
+            if isinstance(pathes, RunShard):
+                size = size * len(pathes) // max(1, len(pathes.parent))
+            return size
+    group = None
+    if config.get('client_affinity'):
+        groupby_idx = config.get('good_runs_groupby_idx') or 5
+        def group(run, pathes):
+            # runs of the same parent directory
+            first = next(iter(pathes), None)
+            return '/'.join(first[0].split('/')[:groupby_idx]) if first else ''
+    return RunQueue(weight, group)
+
+def stored_files(run, n_files=None):
+    '''Lazy file list of a run known to the store'''
+    if is_shard(run):
+        return RunShard(stored_files(parent_run(run)), *store.shard_bounds(run))
+    if manifest is not None and run in manifest:
+        return manifest[run]
+    return StoredRun(store, run, n_files)
+
+def restore_state(known):
+    '''Resume from the state store, queued runs are restored in background by restored_runs'''
+    global copied_runs
+    for run, leased_at in store.leases().items():
+        saved = known.get(run)
+        # clients that are still alive will renew restored leases with heartbeats
+        runs_in_process.add(run, stored_files(run, saved.n_files if saved else None), leased_at)
+    copied_runs = {run: Status.Done for run in store.runs(DONE)
+                   if not "failed" in run and not is_shard(run)}
+
+    inventory.reconcile(store.inventory())
+    total_failed_files.restore(store.failures(), store.failure_reports(total_failed_files.history_limit))
+    total_failed_files.integrity_failed_counter = int(store.get_meta('integrity_failed_counter', 0))
+    logger.info(f'Restored state from {store.path}: {len(runs_in_process)} in process, '
+                f'{len(copied_runs)} copied')
+
+def snapshot_path():
+    path = config.get('snapshot', 'warden_snapshot.bin')
+    return abspath(path) if path else None
+
+def scheduling_fingerprint():
+    '''Settings that weigh and group runs, a snapshot made with other ones is ignored'''
+    sizes = config.get('run_sizes')
+    if config.get('schedule_by', 'files') == 'bytes' and sizes and os.path.exists(sizes):
+        stat = os.stat(sizes)
+        sizes = (sizes, stat.st_size, stat.st_mtime)
+    return settings_fingerprint(config.get('schedule_by', 'files'), bool(config.get('client_affinity')),
+                                config.get('good_runs_groupby_idx') or 5, sizes)
+
+def read_snapshot():
+    '''Runs of the scheduler snapshot by name, empty without a usable snapshot'''
+    path = snapshot_path()
+    if not path or not os.path.exists(path):
+        return dict()
+    try:
+        snapshot = Snapshot(path, scheduling_fingerprint())
+    except (OSError, SnapshotError) as e:
+        logger.warning(f'Ignoring scheduler snapshot: {e}')
+        return dict()
+    try:
+        known = {entry.run: entry for entry in snapshot.runs()}
+        runs.client_groups.update(snapshot.client_groups)
+    finally:
+        snapshot.close()
+    logger.info(f'Read scheduler snapshot {path} of {datetime.fromtimestamp(snapshot.created_at)}: '
+                f'{len(known)} runs')
+    return known
+
+def scheduler_state():
+    '''Queued runs and leases with their scheduling keys, taken in the event loop'''
+    state = [SnapshotRun(run, priority, len(runs[run]), group, None) for run, priority, group in runs.keys()]
+    for run, (leased_at, pathes) in runs_in_process.items():
+        _, _, priority, group = queue_entry(run, pathes)
+        state.append(SnapshotRun(run, priority, len(pathes), group, leased_at.timestamp()))
+    return state
+
+async def save_snapshot():
+    path = snapshot_path()
+    if not path:
+        return
+    start = time.monotonic()
+    state, client_groups = scheduler_state(), dict(runs.client_groups)
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(None, write_snapshot, path, state, client_groups,
+                                   scheduling_fingerprint(), time.time())
+    except OSError as e:
+        logger.error(f'Failed to write scheduler snapshot {path}: {e}')
+        return
+    logger.debug(f'Wrote scheduler snapshot of {len(state)} runs to {path} in {time.monotonic() - start:.2f} s')
+
+def seed_contents(path):
+    '''Index files of a list of checksums verified in EOS, e.g. by validate_cksum_adler32.py --verified
+
+    The list is in the good run list format, sizes are taken from EOS_DYBFS
+    and files missing there are skipped. A list is indexed again only if it
+    changed since.
+    '''
+    stat = os.stat(path)
+    fingerprint = f'{stat.st_size} {stat.st_mtime}'
+    if content_index.get_meta(f'seed:{path}') == fingerprint:
+        return
+    n_indexed, n_skipped = 0, 0
+    batch = []
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                _, file_path, cksum = split_entry(line, 0)
+                pack_cksum(cksum)
+                size = os.stat(os.path.join(config['EOS_DYBFS'], file_path)).st_size
+            except (ValueError, IndexError, OSError):
+                n_skipped += 1
+                continue
+            batch.append((cksum, size, file_path))
+            if len(batch) >= SAVE_BATCH:
+                content_index.add(batch)
+                n_indexed += len(batch)
+                batch = []
+    content_index.add(batch)
+    n_indexed += len(batch)
+    content_index.set_meta(f'seed:{path}', fingerprint)
+    logger.info(f'Indexed {n_indexed} files verified in EOS from {path}, skipped {n_skipped} '
+                f'malformed or missing in {config["EOS_DYBFS"]}')
+
+async def seed_contents_in_background(path):
+    loop = asyncio.get_running_loop()
+    try:
+        # stats every file in EOS, must not block the event loop serving clients
+        await loop.run_in_executor(None, seed_contents, path)
+    except Exception:
+        logger.exception(f'Failed to index files of {path}')
+
+async def snapshot_periodically(interval):
+    while True:
+        await asyncio.sleep(interval)
+        # a snapshot of a partially loaded queue is still valid, it is just not needed
+        if run_loader is not None:
+            continue
+        try:
+            await save_snapshot()
+        except Exception:
+            logger.exception('Failed to write scheduler snapshot')
+
+@app.on_event('startup')
+async def start_background_tasks():
+    loop = asyncio.get_running_loop()
+    if run_loader is not None:
+        loop.create_task(load_runs())
+    loop.create_task(expire_leases_periodically())
+    reconcile_interval = config.get('inventory_reconcile_interval')
+    if reconcile_interval:
+        loop.create_task(reconcile_inventory_periodically(reconcile_interval))
+    snapshot_interval = config.get('snapshot_interval', DEFAULT_SNAPSHOT_INTERVAL)
+    if snapshot_interval and snapshot_path():
+        loop.create_task(snapshot_periodically(snapshot_interval))
+    if content_index is not None and config.get('dedup_seed'):
+        loop.create_task(seed_contents_in_background(abspath(config['dedup_seed'])))
 
 def dump_copied_runs():
     '''Save info about runs that were copied'''
     if copied_runs:
         with open('copied_runs.yaml', 'w') as f:
-            yaml.dump(copied_runs, f)
+            yaml.dump(copied_runs, f, Dumper=getattr(yaml, 'CDumper', yaml.Dumper))
+
+def dump_snapshot():
+    '''Save the scheduler snapshot at shutdown, unless runs are still being loaded'''
+    if config is None or runs is None or run_loader is not None or not snapshot_path():
+        return
+    try:
+        write_snapshot(snapshot_path(), scheduler_state(), runs.client_groups, scheduling_fingerprint(),
+                       time.time())
+    except OSError as e:
+        logger.error(f'Failed to write scheduler snapshot: {e}')
 
 def dump_spurious_files():
     '''Save pathes of notorious files with likely wrong checksums'''
     path = abspath('wrong_checksums_files.txt')
     with open(path, 'w') as f:
-        for path in total_failed_files.spurious_files:
-            f.write(os.path.join('/dybfs', path)+"\n")
+        # same format as the good run list
+        for path, cksum in total_failed_files.page(0, len(total_failed_files.spurious_files)):
+            f.write(f'{os.path.join("/dybfs", path)} {cksum}\n')
     
 def gracefull_shutdown(signum=signal.SIGTERM, frame=None):
     '''Shutdown at SIGTERM but dump copied runs'''
     dump_copied_runs()
     dump_spurious_files()
+    dump_snapshot()
     sys.exit(0)
 
 def set_gracefull_shutdown():
@@ -0,0 +1,5 @@
+import sys
+from os.path import abspath, dirname
+
+# common/ is imported from the repository root, as by server.py and client.py
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
@@ -0,0 +1,93 @@
+import os
+import zlib
+
+import pytest
+
+from client import ClientEngine
+from common.checksum import VerificationPool, checksum_matches
+from common.store import ContentIndex
+
+
+def adler(data):
+    return '{:08x}'.format(zlib.adler32(data) & 0xffffffff)
+
+
+def test_content_index(tmp_path):
+    index = ContentIndex(str(tmp_path / 'contents.sqlite'))
+    index.add([('0000000a', 10, 'old/a.root'), ('0000000b', 20, 'old/b.root')])
+    # the first path of a content is kept, the same checksum with another size is another content
+    index.add([('0000000a', 10, 'new/a.root'), ('0000000a', 11, 'new/a2.root')])
+    assert len(index) == 3
+    found = index.find(['0000000a', '0000000c'] * 300)
+    assert sorted(found['0000000a']) == [(10, 'old/a.root'), (11, 'new/a2.root')]
+    assert '0000000c' not in found
+    index.close()
+    # survives a restart
+    index = ContentIndex(str(tmp_path / 'contents.sqlite'))
+    assert index.find(['0000000b']) == {'0000000b': [(20, 'old/b.root')]}
+    index.close()
+
+
+class Progress:
+    '''Results a ProgressReporter would send to the server'''
+    def __init__(self):
+        self.verified, self.failed = [], []
+
+    def checked(self, path, cksum, future):
+        if checksum_matches(future, cksum):
+            self.verified.append(path)
+            return 1
+        self.failed.append(path)
+        return None
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = ClientEngine.__new__(ClientEngine)
+    engine.eos_home = str(tmp_path)
+    engine.local_copy_mode = 'copy'
+    engine.verification_pool = VerificationPool(workers=2)
+    yield engine
+    engine.verification_pool.shutdown()
+
+
+def write(root, path, data):
+    os.makedirs(os.path.dirname(os.path.join(root, path)), exist_ok=True)
+    with open(os.path.join(root, path), 'wb') as f:
+        f.write(data)
+
+
+@pytest.mark.parametrize('mode', ['copy', 'hardlink'])
+def test_copy_local(engine, mode):
+    engine.local_copy_mode = mode
+    root = engine.eos_home
+    for path, data in [('old/a.root', b'aaaa'), ('old/b.root', b'bbbb'), ('old/c.root', b'cccc'),
+                       ('old/d.root', b'xxxx')]:
+        write(root, path, data)
+    pathes = ['new/a.root', 'new/b.root', 'new/c.root', 'new/d.root', 'new/e.root']
+    cksums = [adler(b'aaaa'), adler(b'bbbb'), adler(b'cccc'), adler(b'dddd'), adler(b'eeee')]
+    copies = {'new/a.root': [('old/a.root', 4)],
+              # changed in EOS since it was indexed
+              'new/b.root': [('old/b.root', 5)],
+              'new/c.root': [('old/c.root', 4)],
+              # overwritten in EOS with other content of the same size
+              'new/d.root': [('old/d.root', 4)]}
+    # c.root at IHEP has another size than the indexed content
+    engine.remote_sizes = lambda pathes: {'new/a.root': 4, 'new/b.root': 4, 'new/c.root': 3, 'new/d.root': 4}
+    progress = Progress()
+    left, left_cksums, n_copied, copied_bytes = engine.copy_local('run', pathes, cksums, copies, progress)
+    assert left == ['new/b.root', 'new/c.root', 'new/d.root', 'new/e.root']
+    assert left_cksums == cksums[1:]
+    assert (n_copied, copied_bytes) == (1, 4)
+    assert progress.verified == ['new/a.root'] and progress.failed == ['new/d.root']
+    with open(os.path.join(root, 'new/a.root'), 'rb') as f:
+        assert f.read() == b'aaaa'
+    # the wrong copy is removed for rsync --ignore-existing, no temporary files are left
+    assert sorted(os.listdir(os.path.join(root, 'new'))) == ['a.root']
+    assert os.path.exists(os.path.join(root, 'old/a.root'))
+
+
+def test_copy_local_without_candidates(engine):
+    engine.remote_sizes = lambda pathes: pytest.fail('rsync is not needed')
+    assert engine.copy_local('run', ['new/a.root'], ['0000000a'], {'new/a.root': [('old/a.root', 4)]},
+                             Progress()) == (['new/a.root'], ['0000000a'], 0, 0)
@@ -0,0 +1,56 @@
+from datetime import datetime
+
+from common.utils import FailedFiles
+
+A, B, C = ('a.root', '0000000a'), ('b.root', '0000000b'), ('c.root', '0000000c')
+
+
+def test_files_become_spurious_once_over_threshold():
+    failed = FailedFiles(spurious_treshold=2)
+    assert failed.report([A, B], 'run1') == []
+    assert failed.report([A, B], 'run2') == []
+    assert failed.report([B], 'run3') == [B]
+    # crossed already, not reported again
+    assert failed.report([A, B], 'run4') == [A]
+    assert failed.spurious_files == {A, B}
+    assert A in failed and C not in failed and len(failed) == 2
+
+
+def test_keys_from_json_lists():
+    failed = FailedFiles(spurious_treshold=0)
+    assert failed.report([list(A)]) == [A]
+    assert A in failed
+
+
+def test_pages_keep_order():
+    failed = FailedFiles(spurious_treshold=1)
+    failed.report([C, A, B])
+    failed.report([B])
+    failed.report([A])
+    assert failed.page(0, 10) == [B, A]
+    assert failed.page(1, 10) == [A]
+    assert failed.page(0, 2, spurious_only=False) == [C, A]
+    assert failed.page(2, 2, spurious_only=False) == [B]
+
+
+def test_history_is_bounded():
+    failed = FailedFiles(spurious_treshold=10, history_limit=2)
+    for i in range(3):
+        failed.report([A], f'run{i}', f'node{i}', reported_at=1000.0 + i)
+    info = failed.describe(A, history=True)
+    assert info['count'] == 3 and not info['spurious']
+    assert info['first_reported'] == datetime.fromtimestamp(1000.0)
+    assert info['last_reported'] == datetime.fromtimestamp(1002.0)
+    assert [(entry['run'], entry['client']) for entry in info['history']] == [('run1', 'node1'), ('run2', 'node2')]
+    assert 'history' not in failed.describe(A)
+
+
+def test_restore():
+    failed = FailedFiles(spurious_treshold=2, history_limit=5)
+    failed.restore({A: 3, B: 1}, [(*A, 1000.0, 'node1', 'run1'), (*B, 1001.0, None, None)])
+    assert failed.spurious_files == {A}
+    assert failed.describe(A)['count'] == 3
+    assert failed.describe(B, history=True)['history'] == [
+        {'reported_at': datetime.fromtimestamp(1001.0), 'client': None, 'run': None}]
+    assert failed.report([B]) == []
+    assert failed.report([B]) == [B]
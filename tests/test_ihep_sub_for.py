@@ -0,0 +1,86 @@
+from ihep_cluster_tools.ihep_sub_for import CondorSubmitter, DoneIndex, file_stat
+
+MB = 10**6
+
+
+def submitter(**options):
+    # 10 MB per job at 1 MB/s in 10 s
+    return CondorSubmitter(chunks=2, output_base='checksums_{}', balance_bytes=True, size_column=1,
+                           target_walltime=10, throughput=1, **options)
+
+
+def lines(sizes):
+    return [f'/dybfs/f{i}.root {size}\n' for i, size in enumerate(sizes)]
+
+
+def test_chunks_by_bytes_packs_largest_first():
+    sizes = [3 * MB, 9 * MB, 1 * MB, 6 * MB, 5 * MB, 2 * MB, 4 * MB]
+    chunks = submitter().chunks_by_bytes(lines(sizes))
+    assert chunks == [['/dybfs/f1.root', '/dybfs/f5.root'],
+                      ['/dybfs/f3.root', '/dybfs/f0.root', '/dybfs/f2.root'],
+                      ['/dybfs/f4.root', '/dybfs/f6.root']]
+    size_of = {line.split()[0]: size for line, size in zip(lines(sizes), sizes)}
+    loads = [sum(size_of[path] for path in chunk) for chunk in chunks]
+    assert loads == [11 * MB, 10 * MB, 9 * MB]
+
+
+def test_chunks_by_bytes_bounds():
+    # never more jobs than files
+    assert len(submitter().chunks_by_bytes(lines([100 * MB, 100 * MB]))) == 2
+    # empty files still get a job
+    assert submitter().chunks_by_bytes(lines([0, 0])) == [['/dybfs/f0.root', '/dybfs/f1.root']]
+
+
+def test_done_index(tmp_path):
+    files = []
+    for name in ('a', 'b', 'c'):
+        path = tmp_path / f'{name}.root'
+        path.write_bytes(name.encode())
+        files.append(str(path))
+    a, b, c = files
+    output = tmp_path / 'checksums_0'
+    # the job was killed while writing the last line
+    output.write_text(f'00000001 {a}\n00000002 {b}\n0000')
+    index = DoneIndex(str(tmp_path / 'index.sqlite'))
+    assert index.update([str(output)]) == 2
+    assert index.is_done(a, *file_stat(a)) and not index.is_done(c, *file_stat(c))
+    with open(output, 'a') as f:
+        f.write(f'0003 {c}\n')
+    # only the appended lines are read
+    assert index.update([str(output)]) == 1
+    assert index.update([str(output)]) == 0
+    assert index.is_done(c, *file_stat(c))
+    index.close()
+
+    # a file changed since its checksum was taken is not done
+    with open(b, 'ab') as f:
+        f.write(b'more')
+    index = DoneIndex(str(tmp_path / 'index.sqlite'))
+    assert not index.is_done(b, *file_stat(b))
+    # a recreated output is read from its start
+    output.write_text(f'00000004 {b}\n')
+    assert index.update([str(output)]) == 1
+    assert index.is_done(b, *file_stat(b))
+    index.close()
+
+
+def test_resubmit_skips_done_files_and_used_outputs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    files = []
+    for name in ('a', 'b', 'c'):
+        path = tmp_path / f'{name}.root'
+        path.write_bytes(name.encode())
+        files.append(str(path))
+    (tmp_path / 'input').write_text(''.join(f'{path}\n' for path in files))
+    (tmp_path / 'condor').mkdir()
+    (tmp_path / 'condor' / 'checksums_0').write_text(f'00000001 {files[0]}\n')
+    (tmp_path / 'jobs').mkdir()
+    (tmp_path / 'jobs' / 'job_7.sh').write_text('')
+    CondorSubmitter(chunks=1, output_base='checksums_{}',
+                    index=str(tmp_path / 'index.sqlite')).submit_htcondor_jobs(str(tmp_path / 'input'))
+    assert not (tmp_path / 'jobs' / 'job_7.sh').exists()
+    # checksums_0 is taken by the previous submission
+    assert (tmp_path / 'jobs' / 'job_0.sh').read_text() == \
+        f'#!/bin/bash\nxrdadler32 {files[1]} >> {tmp_path}/condor/checksums_1\n'
+    assert (tmp_path / 'jobs' / 'job_1.sh').read_text() == \
+        f'#!/bin/bash\nxrdadler32 {files[2]} >> {tmp_path}/condor/checksums_2\n'
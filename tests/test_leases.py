@@ -0,0 +1,39 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from common.leases import LeaseTable
+
+
+def files(run):
+    return [(f'd/{run}/0000.root', '00000001')]
+
+
+def test_lease_expiry():
+    leases = LeaseTable(timedelta(seconds=60))
+    leases.add('a', files('a'))
+    leases.add('b', files('b'))
+    now = datetime.now()
+    assert leases.expired(now) == []
+    assert sorted(run for run, _ in leases.expired(now + timedelta(seconds=61))) == ['a', 'b']
+    assert len(leases) == 0
+
+
+def test_heartbeat_extends_lease():
+    leases = LeaseTable(timedelta(seconds=60))
+    leases.add('a', files('a'))
+    leases.add('b', files('b'))
+    leases.ttl = timedelta(seconds=120)
+    leases.heartbeat('a')
+    expired = leases.expired(datetime.now() + timedelta(seconds=61))
+    assert [run for run, _ in expired] == ['b']
+    assert 'a' in leases
+    with pytest.raises(KeyError):
+        leases.heartbeat('b')
+
+
+def test_finalized_lease_does_not_expire():
+    leases = LeaseTable(timedelta(seconds=60))
+    leases.add('a', files('a'))
+    leases.pop('a')
+    assert leases.expired(datetime.now() + timedelta(seconds=61)) == []
@@ -0,0 +1,85 @@
+import struct
+
+import pytest
+
+from common.manifest import HEADER, Manifest, ManifestError, write_manifest
+
+LINES = [f'/dybfs/rec/P17B/rec/runs_0000/runs_00000/000000{run}/recon.{run}.{i:04}.root {run * 16 + i:08x}\n'
+         for run in range(3) for i in range(4)]
+
+
+def good_runs(lines):
+    runs = dict()
+    for line in lines:
+        path, cksum = line.split()
+        path = path.lstrip('/').partition('/')[2]
+        runs.setdefault(path.split('/')[5], []).append((path, cksum))
+    return runs
+
+
+@pytest.fixture
+def manifest_path(tmp_path):
+    path = str(tmp_path / 'goodruns.manifest')
+    assert write_manifest(path, LINES) == []
+    return path
+
+
+def test_round_trip(manifest_path):
+    manifest = Manifest(manifest_path)
+    assert manifest.groupby_idx == 5
+    assert manifest.n_files == len(LINES)
+    assert {run: list(files) for run, files in manifest.runs().items()} == good_runs(LINES)
+    assert '0000001' in manifest and 'missing' not in manifest
+    assert len(manifest['0000002']) == 4
+
+
+def test_malformed_lines_are_left_out(tmp_path):
+    path = str(tmp_path / 'goodruns.manifest')
+    bad = ['/dybfs/rec/P17B/rec/runs_0000/runs_00000/0000009/x.root not-hex\n', 'no checksum\n']
+    assert write_manifest(path, LINES[:4] + bad) == [line.rstrip('\n') for line in bad]
+    assert {run: list(files) for run, files in Manifest(path).runs().items()} == good_runs(LINES[:4])
+
+
+def test_stale_source(tmp_path):
+    source = tmp_path / 'goodruns.txt'
+    source.write_text(''.join(LINES))
+    path = str(tmp_path / 'goodruns.manifest')
+    write_manifest(path, LINES, source=str(source))
+    assert not Manifest(path).is_stale(str(source))
+    source.write_text(''.join(LINES[:-1]))
+    assert Manifest(path).is_stale(str(source))
+
+
+def corrupt(path, offset, data):
+    with open(path, 'r+b') as f:
+        f.seek(offset)
+        f.write(data)
+
+
+def test_rejects_other_files(tmp_path):
+    path = tmp_path / 'other'
+    path.write_bytes(b'x' * 4096)
+    with pytest.raises(ManifestError, match='not a manifest'):
+        Manifest(str(path))
+    path.write_bytes(b'x')
+    with pytest.raises(ManifestError, match='too short'):
+        Manifest(str(path))
+
+
+def test_rejects_other_version(manifest_path):
+    corrupt(manifest_path, 8, struct.pack('<H', 99))
+    with pytest.raises(ManifestError, match='version 99'):
+        Manifest(manifest_path)
+
+
+def test_rejects_corrupted_header(manifest_path):
+    corrupt(manifest_path, 12, b'\xff')
+    with pytest.raises(ManifestError, match='checksum mismatch'):
+        Manifest(manifest_path)
+
+
+def test_rejects_truncated_file(manifest_path):
+    with open(manifest_path, 'r+b') as f:
+        f.truncate(HEADER.size + 8)
+    with pytest.raises(ManifestError, match='truncated'):
+        Manifest(manifest_path)
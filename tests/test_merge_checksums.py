@@ -0,0 +1,58 @@
+from argparse import Namespace
+
+import pytest
+
+from ihep_cluster_tools.merge_checksums import merge_checksums, merge_checksums_external
+
+GOOD_RUNS = ['/dybfs/rec/P19A/a/0001/f{}.root\n'.format(i) for i in range(7)]
+CHECKSUMS = [
+    # shuffled, with a duplicate, a file outside of the good run list and
+    # a file with two different checksums
+    ['0000000c /dybfs/rec/P19A/a/0001/f2.root\n', '0000000a /dybfs/rec/P19A/a/0001/f0.root\n',
+     '0000000f /dybfs/rec/P19A/b/0009/f0.root\n', '0000000e /dybfs/rec/P19A/a/0001/f4.root\n'],
+    ['0000000a /dybfs/rec/P19A/a/0001/f0.root\n', '0000000d /dybfs/rec/P19A/a/0001/f6.root\n',
+     '000000ff /dybfs/rec/P19A/a/0001/f4.root\n'],
+]
+
+
+@pytest.fixture
+def inputs(tmp_path):
+    checksums = tmp_path / 'checksums'
+    checksums.mkdir()
+    for i, lines in enumerate(CHECKSUMS):
+        (checksums / f'checksums_{i}').write_text(''.join(lines))
+    good_runs = tmp_path / 'good_runs'
+    good_runs.write_text(''.join(reversed(GOOD_RUNS)))
+    return tmp_path
+
+
+def run(merge, root, name, **options):
+    args = Namespace(checksums=str(root / 'checksums'), good_runs=str(root / 'good_runs'),
+                     missing_files=str(root / f'{name}_missing'),
+                     goodrun_checksums=str(root / f'{name}_goodrun_checksums'),
+                     substitute_path=('/dybfs/', '/dybfs2/'), manifest=None, **options)
+    merge(args)
+    with open(args.missing_files) as f:
+        missing = sorted(f)
+    with open(args.goodrun_checksums) as f:
+        return missing, f.read()
+
+
+def test_external_merge_equals_in_memory_merge(inputs):
+    expected = run(merge_checksums, inputs, 'memory')
+    # chunks of 2 lines merged 2 at a time take several passes
+    assert run(merge_checksums_external, inputs, 'external', tmp_dir=str(inputs),
+               chunk_lines=2, fan_in=2, jobs=2) == expected
+    missing, goodrun_checksums = expected
+    assert missing == [GOOD_RUNS[i] for i in (1, 3, 5)]
+    assert goodrun_checksums.splitlines() == [
+        '/dybfs2/rec/P19A/a/0001/f0.root 0000000a',
+        '/dybfs2/rec/P19A/a/0001/f2.root 0000000c',
+        '/dybfs2/rec/P19A/a/0001/f4.root 0000000e',
+        '/dybfs2/rec/P19A/a/0001/f4.root 000000ff',
+        '/dybfs2/rec/P19A/a/0001/f6.root 0000000d',
+    ]
+    # chunk files are removed
+    assert sorted(p.name for p in inputs.iterdir()) == [
+        'checksums', 'external_goodrun_checksums', 'external_missing', 'good_runs',
+        'memory_goodrun_checksums', 'memory_missing']
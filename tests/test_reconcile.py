@@ -0,0 +1,63 @@
+import zlib
+
+import pytest
+
+from common.checksum import VerificationPool
+from common.reconcile import Reconciler, RunPresence, list_files
+
+
+def adler(data):
+    return '{:08x}'.format(zlib.adler32(data) & 0xffffffff)
+
+
+RUN = [('r/1/a.root', adler(b'aaaa')), ('r/1/b.root', adler(b'bbbb')), ('r/2/c.root', adler(b'cc'))]
+
+
+@pytest.fixture
+def root(tmp_path):
+    (tmp_path / 'r' / '1').mkdir(parents=True)
+    (tmp_path / 'r/1/a.root').write_bytes(b'aaaa')
+    # copied with other content
+    (tmp_path / 'r/1/b.root').write_bytes(b'xxx')
+    # rsync temporary file of c.root
+    (tmp_path / 'r/1/.c.root.Xyz123').write_bytes(b'c')
+    return tmp_path
+
+
+@pytest.fixture
+def pool():
+    pool = VerificationPool(workers=2)
+    yield pool
+    pool.shutdown()
+
+
+def test_list_files(root):
+    assert list_files(str(root / 'r/1')) == {'a.root': 4, 'b.root': 3}
+    assert list_files(str(root / 'r/2')) == {}
+
+
+def test_present_files_are_not_verified_without_pool(root):
+    presence = Reconciler(str(root)).check('run', RUN)
+    assert presence == RunPresence('run', 3, [('r/1/a.root', 4), ('r/1/b.root', 3)], False)
+    assert not presence.complete and presence.n_bytes == 7
+
+
+def test_checksums_are_compared_with_pool(root, pool):
+    presence = Reconciler(str(root), pool=pool, window=1).check('run', RUN)
+    assert presence == RunPresence('run', 3, [('r/1/a.root', 4)], True)
+
+
+def test_complete_run(root, pool):
+    (root / 'r' / '2').mkdir()
+    (root / 'r/2/c.root').write_bytes(b'cc')
+    (root / 'r/1/b.root').write_bytes(b'bbbb')
+    presence = Reconciler(str(root), pool=pool).check('run', RUN)
+    assert presence.verified and presence.complete and presence.n_bytes == 10
+
+
+def test_runs_without_files_are_skipped(root, pool):
+    runs = [(f'missing{i}', [(f'm/{i}/f.root', '00000001')]) for i in range(10)] + [('run', RUN)]
+    reconciler = Reconciler(str(root), workers=2, pool=pool)
+    assert [presence.run for presence in reconciler.runs(runs)] == ['run']
+    # a run with only wrong files in the destination is not present
+    assert reconciler.check('run', RUN[1:]) is None
@@ -0,0 +1,67 @@
+from datetime import datetime, timedelta
+
+from common.leases import LeaseTable
+from common.scheduler import RunQueue
+from common.snapshot import Snapshot, SnapshotRun, write_snapshot
+from common.store import RunStore, QUEUED, LEASED, DONE
+
+
+def files(directory, n):
+    return [(f'{directory}/{i:04}.root', f'{i:08x}') for i in range(n)]
+
+
+def parent(run, pathes):
+    return pathes[0][0].rpartition('/')[0].rpartition('/')[0]
+
+
+def drain(queue, client=None):
+    order = []
+    while queue:
+        order.append(queue.popitem(client)[0])
+    return order
+
+
+def test_restart(tmp_path):
+    '''Queue order, leases and client groups survive a restart from the store and the snapshot'''
+    state_db, snapshot = str(tmp_path / 'state.sqlite'), str(tmp_path / 'snapshot.bin')
+    good_runs = {'x1': files('x/1', 9), 'x2': files('x/2', 2), 'y1': files('y/1', 8),
+                 'y2': files('y/2', 7), 'y3': files('y/3', 1)}
+    store = RunStore(state_db)
+    store.add_runs(good_runs.items())
+    store.mark_populated()
+    queue = RunQueue(group=parent)
+    queue.update(good_runs)
+    leases = LeaseTable(timedelta(seconds=60))
+
+    run, pathes = queue.popitem('node1')
+    leased_at = datetime.now()
+    leases.add(run, pathes, leased_at)
+    store.lease(run, leased_at)
+    store.done(queue.popitem('node2')[0])
+    expected_order = [run for run, _, _ in queue.keys()]
+    write_snapshot(snapshot, [SnapshotRun(run, priority, len(queue[run]), group, None)
+                              for run, priority, group in queue.keys()],
+                   queue.client_groups, 0, 0.0)
+    client_groups = dict(queue.client_groups)
+    store.close()
+
+    store = RunStore(state_db)
+    assert store.populated()
+    # a re-import of the good run list keeps the state of every run
+    store.add_runs(good_runs.items())
+    assert store.states(good_runs) == {'x1': LEASED, 'x2': QUEUED, 'y1': DONE, 'y2': QUEUED, 'y3': QUEUED}
+    assert list(store.leases()) == ['x1']
+
+    saved = Snapshot(snapshot)
+    known = {entry.run: entry for entry in saved.runs()}
+    restored = RunQueue(group=parent)
+    restored.restore((run, store.files(run), known[run].priority, known[run].group)
+                     for run, _ in store.run_counts(QUEUED))
+    restored.client_groups.update(saved.client_groups)
+    saved.close()
+
+    assert [run for run, _, _ in restored.keys()] == expected_order
+    assert restored.client_groups == client_groups
+    assert restored.popitem('node1')[0] == 'x2'
+    assert drain(restored, 'node2') == ['y2', 'y3']
+    store.close()
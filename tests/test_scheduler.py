@@ -0,0 +1,58 @@
+import pytest
+
+from common.scheduler import RunQueue
+
+
+def files(directory, n):
+    return [(f'{directory}/{i:04}.root', f'{i:08x}') for i in range(n)]
+
+
+def parent(run, pathes):
+    return pathes[0][0].rpartition('/')[0].rpartition('/')[0]
+
+
+def drain(queue, client=None):
+    order = []
+    while queue:
+        order.append(queue.popitem(client)[0])
+    return order
+
+
+def test_heavier_runs_and_retries_first():
+    queue = RunQueue()
+    queue.update({'small': files('a/small', 1), 'large': files('a/large', 5),
+                  'failed_0': files('a/large', 1), 'medium': files('a/medium', 3)})
+    assert drain(queue) == ['failed_0', 'large', 'medium', 'small']
+    with pytest.raises(KeyError):
+        queue.popitem()
+
+
+def test_removed_and_requeued_runs():
+    queue = RunQueue()
+    queue.update({'a': files('d/a', 3), 'b': files('d/b', 2), 'c': files('d/c', 1)})
+    queue.pop('a')
+    # requeued with fewer files left, weighed again
+    queue['b'] = files('d/b', 1)
+    queue['a'] = files('d/a', 2)
+    # runs of the same weight keep the order they were queued in
+    assert drain(queue) == ['a', 'c', 'b']
+
+
+def test_client_affinity():
+    queue = RunQueue(group=parent)
+    queue.update({'x1': files('x/1', 9), 'x2': files('x/2', 2),
+                  'y1': files('y/1', 8), 'y2': files('y/2', 7)})
+    assert queue.popitem('node1')[0] == 'x1'
+    assert queue.popitem('node2')[0] == 'y1'
+    # the heaviest run is y2, but node1 stays in x while it has runs there
+    assert queue.popitem('node1')[0] == 'x2'
+    assert queue.popitem('node1')[0] == 'y2'
+    assert queue.client_groups == {'node1': 'y', 'node2': 'y'}
+
+
+def test_retries_ignore_affinity():
+    queue = RunQueue(group=parent)
+    queue.update({'x1': files('x/1', 9), 'x2': files('x/2', 2)})
+    assert queue.popitem('node1')[0] == 'x1'
+    queue['failed_0'] = files('y/1', 1)
+    assert queue.popitem('node1')[0] == 'failed_0'
@@ -0,0 +1,86 @@
+import struct
+
+import pytest
+
+from common.snapshot import HEADER, Snapshot, SnapshotError, SnapshotRun, settings_fingerprint, write_snapshot
+
+RUNS = [SnapshotRun('0000001', (1, -120), 120, 'runs_00000', None),
+        SnapshotRun('failed_3', (0, -2), 2, None, 1700000000.5),
+        SnapshotRun('0000002#1', (1, -50), 50, 'runs_00001', None),
+        SnapshotRun('ünïcode', (1, 0), 0, 'runs_00000', 1700000100.0)]
+CLIENT_GROUPS = {'node1': 'runs_00000', 'node2': 'runs_00001'}
+FINGERPRINT = settings_fingerprint('files', True, 5, None)
+
+
+@pytest.fixture
+def snapshot_path(tmp_path):
+    path = str(tmp_path / 'snapshot.bin')
+    write_snapshot(path, RUNS, CLIENT_GROUPS, FINGERPRINT, 1700000200.0)
+    return path
+
+
+def test_round_trip(snapshot_path):
+    snapshot = Snapshot(snapshot_path, FINGERPRINT)
+    try:
+        assert list(snapshot.runs()) == RUNS
+        assert snapshot.client_groups == CLIENT_GROUPS
+        assert snapshot.created_at == 1700000200.0
+    finally:
+        snapshot.close()
+
+
+def test_empty_snapshot(tmp_path):
+    path = str(tmp_path / 'snapshot.bin')
+    write_snapshot(path, [], {}, FINGERPRINT, 0.0)
+    snapshot = Snapshot(path)
+    assert list(snapshot.runs()) == [] and snapshot.client_groups == {}
+    snapshot.close()
+
+
+def test_overwrite_is_atomic(snapshot_path, tmp_path):
+    write_snapshot(snapshot_path, RUNS[:1], {}, FINGERPRINT, 0.0)
+    snapshot = Snapshot(snapshot_path)
+    assert list(snapshot.runs()) == RUNS[:1]
+    snapshot.close()
+    assert [p.name for p in tmp_path.iterdir()] == ['snapshot.bin']
+
+
+def test_rejects_other_settings(snapshot_path):
+    assert settings_fingerprint('bytes', True, 5, None) != FINGERPRINT
+    with pytest.raises(SnapshotError, match='other scheduling settings'):
+        Snapshot(snapshot_path, settings_fingerprint('bytes', True, 5, None))
+
+
+def corrupt(path, offset, data):
+    with open(path, 'r+b') as f:
+        f.seek(offset)
+        f.write(data)
+
+
+def test_rejects_other_files(tmp_path):
+    path = tmp_path / 'other'
+    path.write_bytes(b'x' * 4096)
+    with pytest.raises(SnapshotError, match='not a snapshot'):
+        Snapshot(str(path))
+    path.write_bytes(b'')
+    with pytest.raises(SnapshotError, match='too short'):
+        Snapshot(str(path))
+
+
+def test_rejects_other_version(snapshot_path):
+    corrupt(snapshot_path, 8, struct.pack('<H', 2))
+    with pytest.raises(SnapshotError, match='version 2'):
+        Snapshot(snapshot_path)
+
+
+def test_rejects_corrupted_header(snapshot_path):
+    corrupt(snapshot_path, 14, b'\xff')
+    with pytest.raises(SnapshotError, match='checksum mismatch'):
+        Snapshot(snapshot_path)
+
+
+def test_rejects_truncated_file(snapshot_path):
+    with open(snapshot_path, 'r+b') as f:
+        f.truncate(HEADER.size + 8)
+    with pytest.raises(SnapshotError, match='truncated'):
+        Snapshot(snapshot_path)
@@ -0,0 +1,86 @@
+from common.tuning import RsyncTuner, parse_stats
+
+GiB = 1024**3
+
+STATS = '''
+Number of files: 3 (reg: 2, dir: 1)
+Number of created files: 2 (reg: 2)
+Total file size: 2,147,483,648 bytes
+Total transferred file size: 2,147,483,648 bytes
+Literal data: 2,147,483,648 bytes
+Total bytes sent: 1,234
+Total bytes received: 1,073,741,824
+
+sent 1,234 bytes  received 1,073,741,824 bytes  12,345,678.00 bytes/sec
+total size is 2,147,483,648  speedup is 2.00
+'''.splitlines()
+
+
+def test_parse_stats():
+    assert parse_stats(STATS) == {'transferred': 2 * GiB, 'sent': 1234, 'received': GiB}
+
+
+def test_parse_stats_ignores_rounded_values():
+    # rsync -h without --no-human-readable
+    assert parse_stats(['Total bytes received: 1.07G', 'Total bytes sent: 1.23K']) == {}
+
+
+def observe(tuner, n_streams, seconds, transferred=2 * GiB, received=None):
+    tuner.observe('run', [{'transferred': transferred, 'received': received or transferred}],
+                  seconds, n_streams)
+
+
+def test_streams_climb_while_throughput_grows():
+    tuner = RsyncTuner(min_streams=1, max_streams=3, compress=False)
+    assert tuner.acquire(10) == 1
+    tuner.release(1)
+    observe(tuner, 1, 20)
+    assert tuner.streams == 2
+    observe(tuner, 2, 10)
+    assert tuner.streams == 3
+    observe(tuner, 3, 5)
+    assert tuner.streams == 3
+    # same throughput within tolerance, nothing changes
+    observe(tuner, 3, 5)
+    assert tuner.streams == 3
+
+
+def test_streams_step_back_when_throughput_drops():
+    tuner = RsyncTuner(min_streams=1, max_streams=4, compress=False)
+    tuner.streams = 2
+    observe(tuner, 2, 10)
+    assert tuner.streams == 3
+    observe(tuner, 3, 20)
+    assert tuner.streams == 2
+
+
+def test_small_runs_do_not_tune_streams():
+    tuner = RsyncTuner(compress=False)
+    observe(tuner, 1, 1, transferred=1024)
+    assert tuner.streams == 1 and tuner.throughput is None
+
+
+def test_incompressible_data_disables_compression_and_probes_again():
+    tuner = RsyncTuner(probe_every=2)
+    assert '-z' in tuner.options().split()
+    # ROOT files barely shrink
+    observe(tuner, 1, 10, received=2 * GiB - 1)
+    assert not tuner.compress and '-z' not in tuner.options().split()
+    for _ in range(2):
+        tuner.release(tuner.acquire(1))
+        observe(tuner, 1, 10)
+    tuner.acquire(1)
+    assert '-z' in tuner.options().split()
+    observe(tuner, 1, 10, received=GiB)
+    assert tuner.compress and tuner.compress_ratio == 2
+
+
+def test_host_streams_and_bwlimit_are_shared():
+    tuner = RsyncTuner(max_streams=4, host_streams=3, bwlimit=3000, compress=False)
+    tuner.streams = 2
+    assert tuner.acquire(10) == 2
+    assert tuner.acquire(10) == 1
+    assert '--bwlimit=1000' in tuner.options().split()
+    tuner.release(2)
+    assert tuner.state()['active_streams'] == 1
+    assert '--bwlimit=3000' in tuner.options().split()
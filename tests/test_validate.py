@@ -0,0 +1,70 @@
+import zlib
+from argparse import Namespace
+
+import pytest
+
+from ihep_cluster_tools import validate_cksum_adler32 as validate
+
+
+def adler(data):
+    return '{:08x}'.format(zlib.adler32(data) & 0xffffffff)
+
+
+class FlakyFileSystem(validate.LocalFileSystem):
+    '''Fails queries of `broken` files, as an unreachable storage node would'''
+    def __init__(self, root, broken):
+        super().__init__(root)
+        self.broken = broken
+        self.queried = []
+
+    def query(self, code, path):
+        self.queried.append(path)
+        if path.rpartition('/')[2] in self.broken:
+            return validate.FakeStatus(False, 3005, '[ERROR] Operation expired'), None
+        return super().query(code, path)
+
+
+@pytest.fixture
+def layout(tmp_path):
+    data = tmp_path / 'eos' / 'data' / 'run1'
+    data.mkdir(parents=True)
+    (data / 'a.root').write_bytes(b'aaaa')
+    (data / 'b.root').write_bytes(b'xxxx')
+    (data / 'd.root').write_bytes(b'dddd')
+    (tmp_path / 'input').write_text(f'/run1/a.root {adler(b"aaaa")}\n/run1/b.root {adler(b"bbbb")}\n'
+                                    f'/run1/c.root {adler(b"cccc")}\nrun1/d.root {adler(b"dddd")}\n')
+    return tmp_path
+
+
+def arguments(root, **options):
+    args = Namespace(input_file=validate.InputReader(str(root / 'input')), eos=None, data_root='/data',
+                     output=str(root / 'wrong'), verified=str(root / 'verified'), window=2, retries=1,
+                     backoff=0.0, checkpoint=str(root / 'checkpoint'), fake_eos=str(root / 'eos'))
+    vars(args).update(options)
+    return args
+
+
+def test_fake_eos(layout):
+    validate.main(arguments(layout, checkpoint=None))
+    assert sorted((layout / 'wrong').read_text().splitlines()) == ['run1/b.root', 'run1/c.root']
+    assert sorted((layout / 'verified').read_text().splitlines()) == [
+        f'/run1/a.root {adler(b"aaaa")}', f'/run1/d.root {adler(b"dddd")}']
+
+
+def test_unresolved_files_are_queried_again_on_resume(layout, monkeypatch):
+    filesystem = FlakyFileSystem(str(layout / 'eos'), {'d.root'})
+    monkeypatch.setattr(validate, 'make_filesystem', lambda args: (filesystem, None))
+    validate.main(arguments(layout))
+    # one retry, then left for the next pass instead of being reported as missing
+    assert filesystem.queried.count('/data/run1/d.root') == 2
+    assert sorted((layout / 'checkpoint').read_text().splitlines()) == ['run1/a.root', 'run1/b.root',
+                                                                        'run1/c.root']
+
+    filesystem = FlakyFileSystem(str(layout / 'eos'), set())
+    validate.main(arguments(layout))
+    assert filesystem.queried == ['/data/run1/d.root']
+    # wrong files of the first pass are kept
+    assert sorted((layout / 'wrong').read_text().splitlines()) == ['run1/b.root', 'run1/c.root']
+    assert sorted((layout / 'verified').read_text().splitlines()) == [
+        f'/run1/a.root {adler(b"aaaa")}', f'/run1/d.root {adler(b"dddd")}']
+    assert len((layout / 'checkpoint').read_text().splitlines()) == 4
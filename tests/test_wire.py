@@ -0,0 +1,75 @@
+import json
+import zlib
+
+import pytest
+
+from common import wire
+
+FILES = [('rec/P17B/runs_00000/0000001/recon.0001.root', '9c056081'),
+         ('rec/P17B/runs_00000/0000001/recon.0002.root', '00000000'),
+         ('rec/P17B/runs_00000/0000002/recon.0001.root', 'ffffffff'),
+         ('other/ünïcode.root', '14470ebd')]
+
+
+@pytest.mark.parametrize('level', [0, 1, 9])
+def test_round_trip(level):
+    document = {'run': '0000001', 'files': FILES, 'resumed': False,
+                'leases': [{'run': 'failed_3', 'files': FILES[:1]}]}
+    decoded = wire.loads(wire.dumps(document, level))
+    assert decoded == {'run': '0000001', 'files': FILES, 'resumed': False,
+                       'leases': [{'run': 'failed_3', 'files': FILES[:1]}]}
+
+
+def test_round_trip_of_unpacked_checksums():
+    # not 8 lowercase hex digits, sent as text
+    files = [('a/b', 'ABCDEF01'), ('a/c', '123'), ('a/d', '')]
+    assert wire.decode_files(wire.encode_files(files)) == files
+
+
+def test_round_trip_of_empty_and_long_paths():
+    long_path = 'd/' * 40000 + 'file'
+    files = [(long_path, '00000001'), (long_path + '2', '00000002')]
+    assert wire.loads(wire.dumps({'files': []})) == {'files': []}
+    assert wire.decode_files(wire.encode_files(files)) == files
+
+
+def test_shared_directories_shrink_payload():
+    files = [(f'rec/P17B/runs_00000/0000001/recon.{i:04}.root', f'{i:08x}') for i in range(1000)]
+    assert len(wire.dumps({'files': files}, 0)) < len(json.dumps({'files': files})) / 2
+
+
+def test_accepts():
+    assert wire.accepts(f'{wire.MEDIA_TYPE}, application/json')
+    assert not wire.accepts('application/json')
+    assert not wire.accepts(None)
+
+
+@pytest.mark.parametrize('payload', [b'', b'WRD1', b'JSON{}', wire.MAGIC + b'\x07body'])
+def test_rejects_foreign_payloads(payload):
+    with pytest.raises(wire.WireError):
+        wire.loads(payload)
+
+
+def test_rejects_corrupted_deflate():
+    payload = bytearray(wire.dumps({'files': FILES}))
+    payload[len(wire.MAGIC) + 3] ^= 0xff
+    with pytest.raises(wire.WireError):
+        wire.loads(bytes(payload))
+
+
+@pytest.mark.parametrize('cut', [1, 5, 20, -10, -1])
+def test_rejects_truncated_body(cut):
+    body = wire.dumps({'run': 'r', 'files': FILES}, 0)[len(wire.MAGIC) + 1:]
+    truncated = wire.MAGIC + bytes([wire.DEFLATE]) + zlib.compress(body[:cut])
+    with pytest.raises(wire.WireError):
+        wire.loads(truncated)
+
+
+def test_rejects_missing_block():
+    body = bytearray()
+    for part in (b'{"files":{"$files":1}}', wire.encode_files(FILES)):
+        wire._write_varint(body, len(part))
+        body += part
+    assert wire.loads(wire.MAGIC + bytes([wire.RAW]) + bytes(body).replace(b'1}}', b'0}}')) == {'files': FILES}
+    with pytest.raises(wire.WireError):
+        wire.loads(wire.MAGIC + bytes([wire.RAW]) + bytes(body))